@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import threading
+from datetime import datetime
+
+from results_writer import RESULTS_STORE
+
+
+# Batch ingestion configuration
+DOCUMENT_QUEUE_NAME = os.environ.get("DOCUMENT_QUEUE_NAME", "document-ingestion")
+# Workers of LocalBatchRunner; in Azure the queues settings in host.json bound concurrency
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "4"))
+# Must match maxDequeueCount in host.json: after that many attempts a message goes to the poison queue
+BATCH_MAX_DEQUEUE_COUNT = int(os.environ.get("BATCH_MAX_DEQUEUE_COUNT", "5"))
+# Throttled documents are queued again with a growing visibility delay, up to BATCH_MAX_DEFERRALS times
+BATCH_DEFER_SECONDS = float(os.environ.get("BATCH_DEFER_SECONDS", "30"))
+BATCH_DEFER_MAX_SECONDS = float(os.environ.get("BATCH_DEFER_MAX_SECONDS", "600"))
+BATCH_MAX_DEFERRALS = int(os.environ.get("BATCH_MAX_DEFERRALS", "10"))
+# Queue every document uploaded to the documents container, from Event Grid BlobCreated events.
+# Off by default: clients that upload and then call document_processing would pay twice
+BATCH_UPLOAD_TRIGGER_ENABLED = os.environ.get("BATCH_UPLOAD_TRIGGER_ENABLED", "false").lower() == "true"
+# Statuses must be shared by every instance, so by default they sit next to the results
+BATCH_STATUS_STORE = os.environ.get("BATCH_STATUS_STORE", "cosmos" if RESULTS_STORE == "cosmos" else "memory")
+
+# Per-document states, in the order a document moves through them
+QUEUED = "queued"
+PROCESSING = "processing"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def queue_message(document_name, deferrals=0):
+    message = {"document_name": document_name}
+    if deferrals:
+        message["deferrals"] = deferrals
+    return json.dumps(message)
+
+
+def parse_queue_message(body):
+    # Returns (document_name, deferrals); accepts both JSON messages and bare document names
+    try:
+        message = json.loads(body)
+    except json.JSONDecodeError:
+        return body.strip(), 0
+    if isinstance(message, dict):
+        return message.get("document_name"), int(message.get("deferrals") or 0)
+    return str(message), 0
+
+
+def defer_delay_seconds(deferrals, retry_after=None):
+    # Exponential backoff from BATCH_DEFER_SECONDS, never sooner than the service asked for
+    return min(max(BATCH_DEFER_SECONDS * 2 ** deferrals, retry_after or 0), BATCH_DEFER_MAX_SECONDS)
+
+
+def defer_document(document_name, deferrals, delay_seconds):
+    """Queue a document again, invisible for ``delay_seconds``.
+
+    The new message starts with a dequeue count of zero, so a throttled
+    document does not move towards the poison queue the way it would if the
+    trigger raised.
+    """
+    from clients import get_queue_client
+    get_queue_client(DOCUMENT_QUEUE_NAME).send_message(
+        queue_message(document_name, deferrals), visibility_timeout=math.ceil(delay_seconds)
+    )
+
+
+def uploaded_document_name(event_type, subject, container="documents"):
+    # Blob events have subjects like "/blobServices/default/containers/<container>/blobs/<name>";
+    # None for other events and containers
+    prefix = f"/blobServices/default/containers/{container}/blobs/"
+    if event_type != "Microsoft.Storage.BlobCreated" or not subject or not subject.startswith(prefix):
+        return None
+    return subject[len(prefix):] or None
+
+
+def _status_item(document_name, state, details):
+    item = {
+        "document_name": document_name,
+        "state": state,
+        "updated_at": datetime.utcnow().isoformat()
+    }
+    item.update(details)
+    return item
+
+
+class InMemoryStatusStore:
+    """Per-document state for a single worker; used locally and when Cosmos DB is not configured."""
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def set_state(self, document_name, state, **details):
+        item = _status_item(document_name, state, details)
+        with self._lock:
+            self._items[document_name] = item
+        return item
+
+    def get(self, document_name):
+        with self._lock:
+            item = self._items.get(document_name)
+            return dict(item) if item is not None else None
+
+    def list(self, state=None):
+        with self._lock:
+            return [dict(item) for item in self._items.values() if state is None or item["state"] == state]
+
+
+class CosmosStatusStore:
+    """Per-document state shared by all workers, one item per document."""
+
+    def __init__(self, container):
+        self.container = container
+
+    @staticmethod
+    def _item_id(document_name):
+        # Blob names may contain "/", which Cosmos DB does not allow in ids; the name is kept in document_name
+        return f"status-{hashlib.sha256(document_name.encode('utf-8')).hexdigest()}"
+
+    def set_state(self, document_name, state, **details):
+        item = _status_item(document_name, state, details)
+        item["id"] = self._item_id(document_name)
+        item["type"] = "document_status"
+        self.container.upsert_item(item)
+        return item
+
+    def get(self, document_name):
+        from azure.cosmos import exceptions
+        try:
+            # Status items share the results container, partitioned by document name
+            return self.container.read_item(item=self._item_id(document_name), partition_key=document_name)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def list(self, state=None):
+        query = "SELECT * FROM c WHERE c.type = 'document_status'"
+        parameters = []
+        if state is not None:
+            query += " AND c.state = @state"
+            parameters.append({"name": "@state", "value": state})
+        return list(self.container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+
+
+def build_status_store():
+    if BATCH_STATUS_STORE == "cosmos":
+        from clients import get_cosmos_container
+        return CosmosStatusStore(get_cosmos_container())
+    return InMemoryStatusStore()
+
+
+_status_store = None
+_status_store_lock = threading.Lock()
+
+
+def get_status_store():
+    # Built on first use so importing the app does not connect to Cosmos DB
+    global _status_store
+    if _status_store is None:
+        with _status_store_lock:
+            if _status_store is None:
+                _status_store = build_status_store()
+    return _status_store
+
+
+class LocalBatchRunner:
+    """In-process stand-in for the queue trigger.
+
+    Documents are submitted to a bounded queue, so ``submit`` blocks once
+    ``max_queue_size`` documents are waiting, and processed by
+    ``max_workers`` threads with ``process(document_name)``.
+    """
+
+    def __init__(self, process, max_workers=BATCH_MAX_CONCURRENCY, max_queue_size=100):
+        self.process = process
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"batch-worker-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, document_name, timeout=None):
+        self._queue.put(document_name, timeout=timeout)
+
+    def join(self):
+        self._queue.join()
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            document_name = self._queue.get()
+            try:
+                if document_name is None:
+                    return
+                self.process(document_name)
+            except Exception as e:
+                logging.error(f"Batch processing of document {document_name} failed: {e}")
+            finally:
+                self._queue.task_done()
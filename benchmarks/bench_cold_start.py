@@ -0,0 +1,172 @@
+"""Cold-start cost of the function app: import time and first-request latency.
+
+Every run is a fresh interpreter, like a new worker on a consumption plan.
+It times ``import function_app``, records which heavy packages the import
+loaded, then serves --requests documents through the document_processing
+handler (document_processing_response, shared by both route variants)
+against the stand-ins in benchmarks/fakes.py (with no service latency). The
+first request pays for the packages and clients loaded on first use; the
+median of the others is the warm cost. One extra run under
+``python -X importtime`` lists the modules with the largest cumulative
+import time.
+
+Usage:
+    python benchmarks/bench_cold_start.py --repeat 5
+    python benchmarks/bench_cold_start.py --pdf --http-streaming true --output cold_start.json
+    python benchmarks/bench_cold_start.py --baseline cold_start.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Packages that should only load when a request needs them
+HEAVY_MODULES = [
+    "fitz",
+    "openai",
+    "requests",
+    "azure.cosmos",
+    "azure.ai.documentintelligence",
+    "azure.storage.blob",
+    "azure.core",
+    "azurefunctions.extensions.http.fastapi",
+]
+
+
+def run_child(args):
+    start = time.perf_counter()
+    import function_app
+    import_ms = (time.perf_counter() - start) * 1000
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fakes
+
+    services = fakes.install(fakes.Fixtures.synthetic(args.pages), fakes.Latency())
+    names = []
+    for path in args.documents:
+        with open(path, "rb") as f:
+            services.blob_service.blobs[("documents", os.path.basename(path))] = f.read()
+        names.append(os.path.basename(path))
+
+    request_ms = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in names:
+            start = time.perf_counter()
+            response = function_app.document_processing_response(name)
+            request_ms.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"document_processing returned {response.status_code} for {name}")
+    services.results_writer.close()
+    print(json.dumps({
+        "import_ms": round(import_ms, 1),
+        "first_request_ms": round(request_ms[0], 1),
+        "warm_request_ms": round(statistics.median(request_ms[1:]), 1),
+        "loaded_at_import": loaded,
+    }))
+
+
+def child_env(args):
+    # No Cosmos DB or service settings: the app must import and serve requests without them
+    env = {name: value for name, value in os.environ.items() if not name.startswith("COSMOS_DB_")}
+    env.update(RESULT_CACHE_ENABLED="false", PYTHONPATH=APP_DIR)
+    if args.http_streaming is not None:
+        env["HTTP_STREAMING_ENABLED"] = args.http_streaming
+    return env
+
+
+def import_profile(args, top):
+    # Largest cumulative import times, in microseconds, from python -X importtime
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import function_app"],
+        cwd=APP_DIR, env=child_env(args), capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    # Keep the indentation so nested modules stay readable
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in sorted(rows, reverse=True)[:top]]
+
+
+def summarize(values):
+    return {"median": round(statistics.median(values), 1), "min": round(min(values), 1), "max": round(max(values), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes to measure")
+    parser.add_argument("--pdf", action="store_true", help="Serve born-digital PDFs (PyMuPDF path) instead of Document Intelligence")
+    parser.add_argument("--requests", type=int, default=6, help="Documents served by each process, at least 2")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--http-streaming", choices=["true", "false"], help="HTTP_STREAMING_ENABLED for the runs")
+    parser.add_argument("--top", type=int, default=15, help="Modules listed from the -X importtime profile")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with a report written by an earlier --output")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--documents", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from bench_pipeline import make_documents
+
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name, content in make_documents(max(2, args.requests), 256, args.pages, args.pdf).items():
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], "wb") as f:
+                f.write(content)
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--pages", str(args.pages), "--documents", *paths]
+        for _ in range(args.repeat):
+            output = subprocess.run(command, cwd=APP_DIR, env=child_env(args), capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {
+        "config": vars(args),
+        "import_ms": summarize([run["import_ms"] for run in runs]),
+        "first_request_ms": summarize([run["first_request_ms"] for run in runs]),
+        "warm_request_ms": summarize([run["warm_request_ms"] for run in runs]),
+        "loaded_at_import": runs[0]["loaded_at_import"],
+        "import_profile": import_profile(args, args.top),
+        "runs": runs,
+    }
+
+    print(f"{'':20}{'median ms':>11}{'min ms':>9}{'max ms':>9}")
+    for key in ("import_ms", "first_request_ms", "warm_request_ms"):
+        row = report[key]
+        print(f"{key[:-3]:20}{row['median']:>11.1f}{row['min']:>9.1f}{row['max']:>9.1f}")
+    print(f"heavy packages loaded at import: {', '.join(report['loaded_at_import']) or 'none'}")
+    print("largest cumulative import times (-X importtime):")
+    for row in report["import_profile"]:
+        print(f"  {row['cumulative_ms']:>9.1f} ms  {row['module']}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("Against baseline (median, current / baseline):")
+        for key in ("import_ms", "first_request_ms", "warm_request_ms"):
+            previous = baseline[key]["median"]
+            print(f"  {key[:-3]:20}x{report[key]['median'] / previous:.2f}" if previous else f"  {key[:-3]:20}n/a")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
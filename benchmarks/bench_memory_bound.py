@@ -0,0 +1,152 @@
+"""Peak memory of document_processing for one large document.
+
+A document of --document-mib is written to a temporary file and served by
+the Blob Storage stand-in from disk (see benchmarks/fakes.py), so only the
+memory the pipeline itself uses is measured. Each mode runs in a fresh
+process, which processes a small warm-up document first and then the large
+one, and reports its peak RSS above the RSS after the warm-up:
+
+    streaming  the document is downloaded range by range into a temporary
+               file and streamed to Document Intelligence
+    in_memory  LARGE_DOCUMENT_MIN_BYTES is raised above the document size,
+               so it is held in memory and sent inline as base64
+
+The benchmark exits with status 1 when the streaming run goes over
+--max-rss-mib, so it can guard the bound in CI.
+
+Usage:
+    python benchmarks/bench_memory_bound.py --document-mib 256 --max-rss-mib 96
+    python benchmarks/bench_memory_bound.py --pdf --modes streaming --output memory.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["streaming", "in_memory"]
+
+
+def peak_rss():
+    # ru_maxrss survives exec, so it may be the parent's peak; VmHWM belongs to this process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write_document(path, size, pdf):
+    # Incompressible content, so neither the PDF writer nor the page cache shrinks it
+    block = os.urandom(1024 * 1024)
+    if pdf:
+        import fitz
+        from bench_pipeline import make_pdf
+        pdf_doc = fitz.open(stream=make_pdf(os.path.basename(path), 20), filetype="pdf")
+        # The bulk of the file is an attachment the pipeline never reads, like the scans in a large PDF
+        pdf_doc.embfile_add("payload.bin", block * max(1, size // len(block)))
+        pdf_doc.save(path)
+        pdf_doc.close()
+        return
+    with open(path, "wb") as f:
+        f.write(b"bench-large-document\n")
+        for _ in range(max(1, size // len(block))):
+            f.write(block)
+
+
+def run_child(args):
+    os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+    if args.child == "in_memory":
+        os.environ["LARGE_DOCUMENT_MIN_BYTES"] = str(os.path.getsize(args.document) + 1)
+
+    import azure.functions as func
+    import fakes
+    import function_app
+    from bench_pipeline import current_rss, make_documents
+
+    services = fakes.install(fakes.Fixtures.synthetic(args.pages), fakes.Latency())
+    name = os.path.basename(args.document)
+    warmup_name, warmup_content = next(iter(make_documents(1, 64, args.pages, args.pdf).items()))
+    services.blob_service.blobs[("documents", warmup_name)] = warmup_content
+    services.blob_service.blobs[("documents", name)] = fakes.FileBlob(args.document)
+
+    def process(document_name):
+        request = func.HttpRequest(
+            method="GET", url="/api/document_processing", params={"document_name": document_name}, body=b""
+        )
+        return function_app.document_processing(request).status_code
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        process(warmup_name)
+        baseline = current_rss()
+        status = process(name)
+    services.results_writer.close()
+    print(json.dumps({
+        "mode": args.child,
+        "status_code": status,
+        "document_mib": round(os.path.getsize(args.document) / 2**20, 1),
+        "baseline_rss_mib": round(baseline / 2**20, 1),
+        "peak_rss_mib": round(peak_rss() / 2**20, 1),
+        "peak_rss_delta_mib": round(max(0, peak_rss() - baseline) / 2**20, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--document-mib", type=int, default=256)
+    parser.add_argument("--pdf", action="store_true", help="Use a PDF (local fast path) instead of an opaque document")
+    parser.add_argument("--pages", type=int, default=20, help="Pages of the synthetic layout result")
+    parser.add_argument("--max-rss-mib", type=float, default=96, help="Allowed peak RSS growth of the streaming run")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--document", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"bench-large.{'pdf' if args.pdf else 'bin'}")
+        write_document(path, args.document_mib * 2**20, args.pdf)
+        runs = []
+        for mode in args.modes:
+            command = [sys.executable, os.path.abspath(__file__), "--child", mode, "--document", path, "--pages", str(args.pages)]
+            if args.pdf:
+                command.append("--pdf")
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'mode':12}{'status':>8}{'doc MiB':>10}{'base MiB':>10}{'peak MiB':>10}{'delta MiB':>11}")
+    for row in runs:
+        print(
+            f"{row['mode']:12}{row['status_code']:>8}{row['document_mib']:>10.1f}{row['baseline_rss_mib']:>10.1f}"
+            f"{row['peak_rss_mib']:>10.1f}{row['peak_rss_delta_mib']:>11.1f}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "runs": runs}, f, indent=2)
+
+    failed = [
+        row for row in runs
+        if row["mode"] == "streaming" and (row["status_code"] != 200 or row["peak_rss_delta_mib"] > args.max_rss_mib)
+    ]
+    if failed:
+        print(f"Streaming run exceeded the bound of {args.max_rss_mib} MiB or failed.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
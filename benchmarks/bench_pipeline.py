@@ -0,0 +1,346 @@
+"""Offline throughput benchmark of the document_processing pipeline.
+
+Blob Storage, Document Intelligence, Azure OpenAI and Cosmos DB are
+replaced by the stand-ins in benchmarks/fakes.py, which replay recorded (or
+synthetic) payloads with a configurable latency. Two runs are measured:
+
+    pipeline  document_processing end to end, with every stage it calls
+              timed in place
+    stages    download_document, process_document_DI, generate_prompt_url,
+              call_openai_api and store_response_in_cosmos driven one at a
+              time
+
+Each stage reports p50/p95/p99 latency, docs/sec and peak RSS; --output
+writes the report as JSON and --baseline compares against an earlier one.
+
+Usage:
+    python benchmarks/bench_pipeline.py --documents 50 --concurrency 8 --pages 40 \\
+        --openai-latency 2 --di-latency 5 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Stages timed in place during the pipeline run, in call order
+PIPELINE_STAGES = [
+    "download_document",
+    "process_document_routed",
+    "process_document_pages_DI",
+    "generate_prompt_url",
+    "call_openai_api",
+    "store_response_in_cosmos",
+]
+
+
+def current_rss():
+    # Resident set size in bytes; falls back to the process peak where /proc is unavailable
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class StageRecorder:
+    """Collects call latencies per stage and the peak RSS seen while each stage was running.
+
+    A sampler thread reads the RSS every ``interval`` seconds and charges it
+    to every stage with a call in flight; each call also samples on exit so
+    short calls are not missed.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.durations = {}
+        self.intervals = {}
+        self.peak_rss = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self._sampler.start()
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            with self._lock:
+                self._active[name] = self._active.get(name, 0) + 1
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                rss = current_rss()
+                with self._lock:
+                    self._active[name] -= 1
+                    self.durations.setdefault(name, []).append(end - start)
+                    self.intervals.setdefault(name, []).append((start, end))
+                    self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+        timed.__wrapped__ = fn
+        return timed
+
+    def close(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            rss = current_rss()
+            with self._lock:
+                for name, active in self._active.items():
+                    if active:
+                        self.peak_rss[name] = max(self.peak_rss.get(name, 0), rss)
+
+    def stats(self, name, documents=None):
+        # A stage may run several times per document (one OpenAI call per chunk)
+        durations = sorted(self.durations.get(name, []))
+        # Throughput over the time the stage had at least one call in flight
+        busy = 0.0
+        busy_until = None
+        for start, end in sorted(self.intervals.get(name, [])):
+            if busy_until is None or start > busy_until:
+                busy += end - start
+                busy_until = end
+            elif end > busy_until:
+                busy += end - busy_until
+                busy_until = end
+        return {
+            "calls": len(durations),
+            "p50_ms": round(percentile(durations, 50) * 1000, 3),
+            "p95_ms": round(percentile(durations, 95) * 1000, 3),
+            "p99_ms": round(percentile(durations, 99) * 1000, 3),
+            "mean_ms": round(sum(durations) / len(durations) * 1000, 3) if durations else 0.0,
+            "max_ms": round(durations[-1] * 1000, 3) if durations else 0.0,
+            "calls_per_sec": round(len(durations) / busy, 3) if busy else 0.0,
+            "docs_per_sec": round((documents or len(durations)) / busy, 3) if busy else 0.0,
+            "peak_rss_mib": round(self.peak_rss.get(name, 0) / 2**20, 1),
+        }
+
+
+def make_documents(count, size_kb, pages, pdf):
+    # Every document has distinct content so no result is served from the cache
+    documents = {}
+    for index in range(count):
+        name = f"bench-{index:05d}.{'pdf' if pdf else 'bin'}"
+        if pdf:
+            documents[name] = make_pdf(name, pages)
+        else:
+            header = f"{name}\n".encode()
+            documents[name] = header + b"\0" * max(0, size_kb * 1024 - len(header))
+    return documents
+
+
+def make_pdf(name, pages):
+    import fitz
+    pdf_doc = fitz.open()
+    for page_number in range(1, pages + 1):
+        page = pdf_doc.new_page()
+        text = f"{page_number}. Section {page_number} of {name}\n" + "\n".join(
+            f"{page_number}.{line} Please provide a detailed breakdown of the fuel procurement costs."
+            for line in range(1, 40)
+        )
+        page.insert_textbox(fitz.Rect(36, 36, page.rect.width - 36, page.rect.height - 36), text, fontsize=8)
+    content = pdf_doc.tobytes()
+    pdf_doc.close()
+    return content
+
+
+def run_concurrently(fn, inputs, concurrency):
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for ok in executor.map(fn, inputs):
+            errors += 0 if ok else 1
+    return errors
+
+
+def run_pipeline(function_app, func, documents, concurrency, recorder):
+    def process(document_name):
+        request = func.HttpRequest(
+            method="GET", url="/api/document_processing", params={"document_name": document_name}, body=b""
+        )
+        return function_app.document_processing(request).status_code == 200
+
+    start = time.perf_counter()
+    errors = run_concurrently(recorder.wrap("document_processing", process), documents, concurrency)
+    wall = time.perf_counter() - start
+    return {
+        "documents": len(documents),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "docs_per_sec": round(len(documents) / wall, 3) if wall else 0.0,
+        "document_processing": recorder.stats("document_processing"),
+        "stages": {name: recorder.stats(name, len(documents)) for name in PIPELINE_STAGES if name in recorder.durations},
+    }
+
+
+def run_stages(function_app, documents, concurrency, recorder):
+    from chunking import iter_chunks
+    # Inputs of each stage are the outputs of the previous one, computed up front
+    sample_name = documents[0]
+    sample_content = function_app.download_document(sample_name)
+    sample_pages = function_app.process_document_pages_DI(sample_name, sample_content)
+    chunk_text = next(iter_chunks(sample_pages, function_app.OPENAI_CHUNK_MAX_TOKENS), "")
+    payload = function_app.generate_prompt_url(chunk_text)
+    response_json = function_app.parse_openai_response(function_app.call_openai_api(payload)).data
+    text_content = "".join(sample_pages)
+
+    def call(fn, *args):
+        def run(_):
+            fn(*args)
+            return True
+        return run
+
+    stage_calls = {
+        "download_document": lambda name: function_app.download_document(name) is not None,
+        "process_document_DI": lambda name: function_app.process_document_DI(name, sample_content) is not None,
+        "generate_prompt_url": call(function_app.generate_prompt_url, chunk_text),
+        "call_openai_api": call(function_app.call_openai_api, payload),
+        "store_response_in_cosmos": lambda name: function_app.store_response_in_cosmos(
+            "success", 200, name, text_content, response_json, document_hash=name
+        ) is None,
+    }
+    report = {}
+    for name, fn in stage_calls.items():
+        errors = run_concurrently(recorder.wrap(name, fn), documents, concurrency)
+        report[name] = dict(recorder.stats(name), errors=errors)
+    return report
+
+
+def print_stats(title, stages):
+    print(title)
+    print(f"  {'stage':28}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'docs/s':>12}{'RSS MiB':>10}")
+    for name, row in stages.items():
+        print(
+            f"  {name:28}{row['calls']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['p99_ms']:>10.2f}{row['docs_per_sec']:>12.1f}{row['peak_rss_mib']:>10.1f}"
+        )
+
+
+def print_comparison(report, baseline):
+    print("Against baseline (p95 latency and docs/sec, current / baseline):")
+    for run in ("pipeline", "stages"):
+        current_stages = report.get(run) or {}
+        baseline_stages = baseline.get(run) or {}
+        if run == "pipeline":
+            current_stages = current_stages.get("stages", {})
+            baseline_stages = baseline_stages.get("stages", {})
+        for name, row in current_stages.items():
+            previous = baseline_stages.get(name)
+            if not previous:
+                continue
+            p95_ratio = row["p95_ms"] / previous["p95_ms"] if previous["p95_ms"] else float("nan")
+            rate_ratio = row["docs_per_sec"] / previous["docs_per_sec"] if previous["docs_per_sec"] else float("nan")
+            print(f"  {run:9}{name:28}p95 x{p95_ratio:.2f}  docs/s x{rate_ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=2, help="Documents processed before measuring")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per document (recorded results are repeated)")
+    parser.add_argument("--lines", type=int, default=40, help="Lines per synthetic page")
+    parser.add_argument("--figures", type=int, default=1, help="Figures per synthetic page")
+    parser.add_argument("--items", type=int, default=10, help="extracted_data items per synthetic completion")
+    parser.add_argument("--document-kb", type=int, default=512, help="Size of each non-PDF document")
+    parser.add_argument("--pdf", action="store_true", help="Use generated born-digital PDFs (local fast path)")
+    parser.add_argument("--fixtures", help="Directory with recorded payloads, see benchmarks/fakes.py")
+    parser.add_argument("--blob-latency", type=float, default=0.0)
+    parser.add_argument("--di-latency", type=float, default=0.0)
+    parser.add_argument("--figure-latency", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.0)
+    parser.add_argument("--cosmos-latency", type=float, default=0.0)
+    parser.add_argument("--run", choices=["pipeline", "stages", "both"], default="both")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with a report written by an earlier --output")
+    args = parser.parse_args()
+
+    # Repeated documents would otherwise be served from the cache
+    os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+
+    import azure.functions as func
+    import fakes
+    import function_app
+
+    if args.fixtures:
+        fixtures = fakes.Fixtures.load(args.fixtures, args.pages, args.lines, args.figures, args.items)
+    else:
+        fixtures = fakes.Fixtures.synthetic(args.pages, args.lines, args.figures, args.items)
+    latency = fakes.Latency(
+        blob=args.blob_latency, document_intelligence=args.di_latency, figure=args.figure_latency,
+        openai=args.openai_latency, cosmos=args.cosmos_latency
+    )
+    services = fakes.install(fixtures, latency)
+    documents = make_documents(args.warmup + args.documents, args.document_kb, args.pages, args.pdf)
+    for name, content in documents.items():
+        services.blob_service.blobs[("documents", name)] = content
+    names = list(documents)
+
+    report = {"config": vars(args)}
+    # The pipeline prints progress to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_concurrently(
+            lambda name: function_app.document_processing(func.HttpRequest(
+                method="GET", url="/api/document_processing", params={"document_name": name}, body=b""
+            )) is not None,
+            names[:args.warmup], args.concurrency
+        )
+        if args.run in ("pipeline", "both"):
+            recorder = StageRecorder()
+            originals = {name: getattr(function_app, name) for name in PIPELINE_STAGES}
+            for name, fn in originals.items():
+                setattr(function_app, name, recorder.wrap(name, fn))
+            try:
+                report["pipeline"] = run_pipeline(function_app, func, names[args.warmup:], args.concurrency, recorder)
+            finally:
+                for name, fn in originals.items():
+                    setattr(function_app, name, fn)
+                recorder.close()
+        if args.run in ("stages", "both"):
+            recorder = StageRecorder()
+            try:
+                report["stages"] = run_stages(function_app, names[args.warmup:], args.concurrency, recorder)
+            finally:
+                recorder.close()
+        services.results_writer.close()
+    report["stored_results"] = len(services.container.items)
+
+    if "pipeline" in report:
+        pipeline = report["pipeline"]
+        print(
+            f"pipeline: {pipeline['documents']} documents, {pipeline['errors']} errors, "
+            f"{pipeline['wall_seconds']:.2f}s, {pipeline['docs_per_sec']:.2f} docs/s"
+        )
+        print_stats("pipeline stages:", dict(document_processing=pipeline["document_processing"], **pipeline["stages"]))
+    if "stages" in report:
+        print_stats("isolated stages:", report["stages"])
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Throughput of call_openai_api against mock deployments that return 429s.
+
+Starts one mock Azure OpenAI deployment per --rpm value (see
+mock_openai_server.py), points the OpenAI clients at them and calls
+call_openai_api from --concurrency threads for --duration seconds. The run
+is repeated with the client-side limiter off (retries and Retry-After
+only) and on (token buckets at the quota), and reports completed requests
+per minute against the quota, the 429s the server returned, retries and
+latency. With several --rpm values the extra deployments take spillover.
+
+Usage:
+    python benchmarks/bench_rate_limiting.py --rpm 600 --tpm 2000000 --concurrency 32 --duration 30
+    python benchmarks/bench_rate_limiting.py --rpm 300 300 --output rate_limiting.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Every call has to reach the mock deployments
+os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+
+import openai  # noqa: E402
+
+import clients  # noqa: E402
+import function_app  # noqa: E402
+import rate_limiting  # noqa: E402
+from bench_pipeline import percentile  # noqa: E402
+from mock_openai_server import MockOpenAIServer  # noqa: E402
+
+
+def run(servers, args, limited):
+    deployments = []
+    for index, (server, rpm) in enumerate(zip(servers, args.rpm)):
+        deployment = rate_limiting.Deployment(
+            "primary" if index == 0 else f"spillover-{index}",
+            model="gpt-4o-mini",
+            rpm=rpm if limited else 0,
+            tpm=args.tpm if limited else 0,
+            primary=index == 0
+        )
+        deployments.append(deployment)
+        clients.set_client(
+            "openai" if index == 0 else f"openai:{deployment.name}",
+            openai.AzureOpenAI(
+                api_key="bench", api_version=clients.OPENAI_API_VERSION, azure_endpoint=server.url, max_retries=0
+            )
+        )
+    scheduler = rate_limiting.RetryScheduler(
+        deployments, max_attempts=args.max_attempts, base_delay=args.base_delay,
+        usage=rate_limiting.completion_tokens_used
+    )
+    rate_limiting.set_scheduler("openai", scheduler)
+    # Let the quota window of the previous run drain
+    time.sleep(args.window)
+    for server in servers:
+        server.stats.update(requests=0, ok=0, throttled=0, errors=0, tokens=0)
+
+    payload = function_app.generate_prompt_url("Please provide the fuel cost breakdown. " * (args.prompt_chars // 40))
+    latencies = []
+    outcomes = {"ok": 0, "busy": 0, "failed": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker(_):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                function_app.call_openai_api(payload)
+                outcome = "ok"
+            except rate_limiting.ServiceBusyError:
+                outcome = "busy"
+            except Exception:
+                outcome = "failed"
+            with lock:
+                outcomes[outcome] += 1
+                if outcome == "ok":
+                    latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    quota_rpm = sum(args.rpm)
+    return {
+        "limited": limited,
+        "seconds": round(elapsed, 2),
+        "completed": outcomes["ok"],
+        "busy": outcomes["busy"],
+        "failed": outcomes["failed"],
+        "requests_per_minute": round(outcomes["ok"] / elapsed * 60, 1),
+        "quota_requests_per_minute": quota_rpm,
+        "quota_share": round(outcomes["ok"] / elapsed * 60 / quota_rpm, 3) if quota_rpm else None,
+        "server_requests": sum(server.stats["requests"] for server in servers),
+        "server_throttled": sum(server.stats["throttled"] for server in servers),
+        "per_deployment_ok": [server.stats["ok"] for server in servers],
+        "scheduler": dict(scheduler.stats),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rpm", type=int, nargs="+", default=[600], help="Quota of each mock deployment")
+    parser.add_argument("--tpm", type=int, default=2000000)
+    parser.add_argument("--latency", type=float, default=0.1, help="Mock response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock requests failing with 500")
+    parser.add_argument("--window", type=float, default=10, help="Mock quota window in seconds")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--prompt-chars", type=int, default=2000)
+    parser.add_argument("--max-attempts", type=int, default=rate_limiting.RETRY_MAX_ATTEMPTS)
+    parser.add_argument("--base-delay", type=float, default=0.5)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    servers = [
+        MockOpenAIServer(rpm, args.tpm, args.latency, args.error_rate, args.window).start()
+        for rpm in args.rpm
+    ]
+    try:
+        report = {"config": vars(args), "runs": [run(servers, args, limited) for limited in (False, True)]}
+    finally:
+        for server in servers:
+            server.stop()
+
+    print(f"{'limiter':10}{'req/min':>10}{'quota %':>10}{'429s':>8}{'retries':>9}{'busy':>6}{'p50 ms':>9}{'p95 ms':>9}")
+    for row in report["runs"]:
+        print(
+            f"{'on' if row['limited'] else 'off':10}{row['requests_per_minute']:>10.1f}"
+            f"{(row['quota_share'] or 0) * 100:>10.1f}{row['server_throttled']:>8}"
+            f"{row['scheduler']['retries']:>9}{row['busy']:>6}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
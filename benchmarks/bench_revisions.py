@@ -0,0 +1,116 @@
+"""Cost of re-processing revised documents, with and without the page index.
+
+A generated PDF is processed, followed by --revisions revisions of it
+("<name>_v2.pdf", ...) that each amend --changed of its pages. The sequence
+runs twice against the stand-ins in benchmarks/fakes.py: once with the page
+index disabled, where every revision is processed in full, and once with an
+in-memory page index, where only changed pages are analyzed and sent to
+OpenAI. Each submission reports its time, OpenAI requests, prompt tokens and
+pages analyzed by Document Intelligence (--scanned sends every page there,
+otherwise pages are extracted locally).
+
+Usage:
+    python benchmarks/bench_revisions.py --pages 100 --changed 0.1 --revisions 3 --openai-latency 1
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_revisions(name, pages, revisions, changed, seed):
+    import fitz
+    from bench_pipeline import make_pdf
+    rng = random.Random(seed)
+    content = make_pdf(name, pages)
+    documents = [(f"{name}.pdf", content)]
+    for revision in range(2, revisions + 2):
+        pdf_doc = fitz.open(stream=content, filetype="pdf")
+        for page_number in rng.sample(range(pages), max(1, round(pages * changed))):
+            pdf_doc[page_number].insert_text((40, 800), f"Amended in revision {revision}", fontsize=8)
+        content = pdf_doc.tobytes()
+        pdf_doc.close()
+        documents.append((f"{name}_v{revision}.pdf", content))
+    return documents
+
+
+def run(function_app, func, services, documents, incremental):
+    import revisions
+    revisions.set_page_index_store(revisions.InMemoryPageIndexStore() if incremental else None)
+    document_intelligence = services.document_intelligence
+    rows = []
+    for name, content in documents:
+        services.blob_service.blobs[("documents", name)] = content
+        pages_before = document_intelligence.pages_analyzed
+        start = time.perf_counter()
+        response = function_app.document_processing(func.HttpRequest(
+            method="GET", url="/api/document_processing", params={"document_name": name}, body=b""
+        ))
+        rows.append({
+            "incremental": incremental,
+            "document": name,
+            "status_code": response.status_code,
+            "seconds": round(time.perf_counter() - start, 3),
+            "openai_requests": int(response.headers.get("X-OpenAI-Requests", 0)),
+            "prompt_tokens": int(response.headers.get("X-Prompt-Tokens", 0)),
+            "di_pages": document_intelligence.pages_analyzed - pages_before,
+            "items": len(json.loads(response.get_body()).get("extracted_data", [])) if response.status_code == 200 else None,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--changed", type=float, default=0.1, help="Share of pages amended by each revision")
+    parser.add_argument("--revisions", type=int, default=3)
+    parser.add_argument("--scanned", action="store_true", help="Disable the local fast path so every page goes to Document Intelligence")
+    parser.add_argument("--chunk-tokens", type=int, default=4000, help="OPENAI_CHUNK_MAX_TOKENS for the run")
+    parser.add_argument("--di-latency", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Settings for the run; no service is contacted by this benchmark
+    for name, value in {
+        "RESULT_CACHE_ENABLED": "false",
+        "OPENAI_CHUNK_MAX_TOKENS": str(args.chunk_tokens),
+        "FAST_PATH_ENABLED": "false" if args.scanned else "true",
+    }.items():
+        os.environ.setdefault(name, value)
+
+    import azure.functions as func
+    import clients
+    import fakes
+    import function_app
+
+    latency = fakes.Latency(document_intelligence=args.di_latency, openai=args.openai_latency)
+    services = fakes.install(fakes.Fixtures.synthetic(args.pages), latency)
+    services.document_intelligence = clients.get_document_intelligence_client()
+    documents = make_revisions("bench-filing", args.pages, args.revisions, args.changed, args.seed)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = run(function_app, func, services, documents, False) + run(function_app, func, services, documents, True)
+    services.results_writer.close()
+
+    print(f"{'page index':12}{'document':26}{'status':>7}{'seconds':>9}{'requests':>10}{'tokens':>9}{'DI pages':>10}{'items':>7}")
+    for row in rows:
+        print(
+            f"{'on' if row['incremental'] else 'off':12}{row['document']:26}{row['status_code']:>7}{row['seconds']:>9.2f}"
+            f"{row['openai_requests']:>10}{row['prompt_tokens']:>9}{row['di_pages']:>10}{row['items'] or 0:>7}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "runs": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
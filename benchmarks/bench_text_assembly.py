@@ -0,0 +1,147 @@
+"""Text assembly benchmark on a synthetic Document Intelligence layout result.
+
+Compares the original string-concatenating assembly of process_document_DI
+with the page-iterator pipeline (iter_layout_page_segments / render_page,
+one join per page), first on their own and then each followed by
+chunking. Prompt compaction of the assembled pages is reported on its own
+row, since the original code had no equivalent. The document text is only
+joined for the comparison, outside the measurement.
+
+Usage:
+    python benchmarks/bench_text_assembly.py --pages 1000 --lines 60
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+
+import function_app  # noqa: E402
+from chunking import iter_chunks  # noqa: E402
+from prompts import iter_compact_pages  # noqa: E402
+
+
+def synthetic_layout_result(page_count, lines_per_page, figures_per_page):
+    pages = []
+    page_figures = {}
+    for page_number in range(1, page_count + 1):
+        lines = []
+        for line_number in range(lines_per_page):
+            if line_number == 0:
+                content = f"{page_number}. {line_number} Section heading for page {page_number}"
+            else:
+                content = (
+                    f"Line {line_number} of page {page_number}: please provide a detailed breakdown "
+                    f"of the cost structure associated with fuel procurement."
+                )
+            lines.append(SimpleNamespace(content=content))
+        figures = []
+        for figure_number in range(figures_per_page):
+            caption = f"Figure {page_number}.{figure_number}"
+            lines.append(SimpleNamespace(content=caption))
+            figures.append({
+                "caption": caption,
+                "image_url": f"https://localhost/images/{page_number}_{figure_number}.png"
+            })
+        page_figures[page_number] = figures
+        pages.append(SimpleNamespace(page_number=page_number, lines=lines, words=None))
+    return SimpleNamespace(pages=pages), page_figures
+
+
+def assemble_before(result, page_figures):
+    # The original implementation: one growing string for the whole document
+    extracted_content = ""
+    for page in result.pages:
+        figures_on_page = page_figures.get(page.page_number, [])
+        caption_to_image = {fig['caption']: fig['image_url'] for fig in figures_on_page}
+        for line in page.lines:
+            line_text = line.content
+            extracted_content += line_text + "\n"
+            if line_text in caption_to_image:
+                extracted_content += f"Image URL: {caption_to_image[line_text]}\n"
+    return extracted_content
+
+
+def assemble_after(result, page_figures):
+    # One string per page, which is all process_document_pipeline keeps
+    return [
+        function_app.render_page(segments)
+        for segments in function_app.iter_layout_page_segments(result, page_figures)
+    ]
+
+
+def with_chunks(assemble):
+    # Assembly followed by chunking; chunks are consumed one at a time, as extract_document_data does
+    def run(result, page_figures):
+        text = assemble(result, page_figures)
+        pages = [text] if isinstance(text, str) else text
+        return text, sum(1 for _ in iter_chunks(pages, function_app.OPENAI_CHUNK_MAX_TOKENS))
+    return run
+
+
+def compact_and_chunk(pages):
+    return pages, sum(1 for _ in iter_chunks(iter_compact_pages(pages), function_app.OPENAI_CHUNK_MAX_TOKENS))
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    text, chunks = output if isinstance(output, tuple) else (output, None)
+    txt_content = text if isinstance(text, str) else "".join(text)
+    return {
+        "seconds": round(elapsed, 4),
+        "peak_bytes": peak,
+        "text_bytes": len(txt_content.encode("utf-8")),
+        "chunks": chunks,
+    }, txt_content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--figures", type=int, default=2)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    result, page_figures = synthetic_layout_result(args.pages, args.lines, args.figures)
+    rows = {}
+    rows["before"], before_text = measure(assemble_before, result, page_figures)
+    rows["after"], after_text = measure(assemble_after, result, page_figures)
+    if before_text != after_text:
+        raise SystemExit("Assembled text differs between implementations.")
+    rows["before+chunks"], _ = measure(with_chunks(assemble_before), result, page_figures)
+    rows["after+chunks"], _ = measure(with_chunks(assemble_after), result, page_figures)
+    # Compaction (PROMPT_COMPACTION_ENABLED) runs on the assembled pages, which are built outside the measurement
+    pages = assemble_after(result, page_figures)
+    rows["compaction+chunks"], _ = measure(compact_and_chunk, pages)
+    del pages
+
+    report = {
+        "pages": args.pages,
+        "lines_per_page": args.lines,
+        "figures_per_page": args.figures,
+        **rows,
+    }
+    print(f"{'':20}{'seconds':>10}{'peak MiB':>12}{'chunks':>8}")
+    for name, row in rows.items():
+        chunks = "-" if row["chunks"] is None else row["chunks"]
+        print(f"{name:20}{row['seconds']:>10.4f}{row['peak_bytes'] / 2**20:>12.1f}{chunks:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""Local stand-ins for Blob Storage, Document Intelligence and Azure OpenAI.
+
+The stand-ins replay recorded payloads, sleeping for a configurable latency
+on every call, so the pipeline can be driven offline. A fixtures directory
+may contain:
+
+    analyze_result.json   AnalyzeResult JSON as returned by the layout model
+                          (the "analyzeResult" object of the REST response)
+    completion.json       a chat.completion response
+    figures/*.png         figure images, handed out round-robin
+
+Anything missing is generated synthetically by ``Fixtures.synthetic``.
+"""
+import copy
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+
+def synthetic_analyze_result(page_count, lines_per_page, figures_per_page):
+    pages = []
+    figures = []
+    for page_number in range(1, page_count + 1):
+        lines = []
+        for line_number in range(lines_per_page):
+            if line_number == 0:
+                content = f"{page_number}. Section {page_number}: fuel procurement"
+            else:
+                content = (
+                    f"{page_number}.{line_number} Please provide a detailed breakdown of the cost "
+                    f"structure associated with fuel procurement for period {line_number}."
+                )
+            lines.append({"content": content, "polygon": []})
+        for figure_number in range(1, figures_per_page + 1):
+            figure_id = f"{page_number}.{figure_number}"
+            caption = f"Figure {figure_id}"
+            lines.append({"content": caption, "polygon": []})
+            figures.append({
+                "id": figure_id,
+                "boundingRegions": [{"pageNumber": page_number, "polygon": []}],
+                "caption": {"content": caption}
+            })
+        pages.append({"pageNumber": page_number, "lines": lines, "words": [], "spans": []})
+    return {"modelId": "prebuilt-layout", "content": "", "pages": pages, "figures": figures}
+
+
+def synthetic_completion(item_count):
+    items = [
+        {"section": f"{number}.", "number": str(number), "question": f"Question {number} about fuel procurement?"}
+        for number in range(1, item_count + 1)
+    ]
+    content = "```json\n" + json.dumps({"extracted_data": items}) + "\n```"
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(content) // 4, "total_tokens": len(content) // 4}
+    }
+
+
+def resize_analyze_result(data, page_count):
+    # Repeats (or truncates) the recorded pages so any document size can be replayed
+    data = copy.deepcopy(data)
+    recorded_pages = data.get("pages") or []
+    recorded_figures = data.get("figures") or []
+    if not recorded_pages:
+        return data
+    pages = []
+    figures = []
+    for index in range(page_count):
+        source = recorded_pages[index % len(recorded_pages)]
+        page_number = index + 1
+        page = copy.deepcopy(source)
+        page["pageNumber"] = page_number
+        pages.append(page)
+        for figure in recorded_figures:
+            regions = figure.get("boundingRegions") or [{"pageNumber": 1}]
+            if regions[0].get("pageNumber") != source.get("pageNumber"):
+                continue
+            figure = copy.deepcopy(figure)
+            figure["id"] = f"{page_number}.{len(figures) + 1}"
+            for region in figure.get("boundingRegions") or []:
+                region["pageNumber"] = page_number
+            figures.append(figure)
+    data["pages"] = pages
+    data["figures"] = figures
+    return data
+
+
+class Fixtures:
+    def __init__(self, analyze_result, completion, figure_images):
+        self.analyze_result = analyze_result
+        self.completion = completion
+        self.figure_images = figure_images
+
+    @classmethod
+    def synthetic(cls, pages=20, lines_per_page=40, figures_per_page=1, items=10):
+        return cls(
+            synthetic_analyze_result(pages, lines_per_page, figures_per_page),
+            synthetic_completion(items),
+            [bytes([index]) * 20000 for index in range(8)]
+        )
+
+    @classmethod
+    def load(cls, directory, pages=None, lines_per_page=40, figures_per_page=1, items=10):
+        fixtures = cls.synthetic(pages or 20, lines_per_page, figures_per_page, items)
+        analyze_path = os.path.join(directory, "analyze_result.json")
+        if os.path.exists(analyze_path):
+            with open(analyze_path) as f:
+                data = json.load(f)
+            # Whole REST responses carry the result under "analyzeResult"
+            data = data.get("analyzeResult", data)
+            fixtures.analyze_result = resize_analyze_result(data, pages) if pages else data
+        completion_path = os.path.join(directory, "completion.json")
+        if os.path.exists(completion_path):
+            with open(completion_path) as f:
+                fixtures.completion = json.load(f)
+        figure_paths = sorted(glob.glob(os.path.join(directory, "figures", "*")))
+        if figure_paths:
+            fixtures.figure_images = []
+            for path in figure_paths:
+                with open(path, "rb") as f:
+                    fixtures.figure_images.append(f.read())
+        return fixtures
+
+
+class Latency:
+    """Per-service latency in seconds; every stand-in call sleeps this long."""
+
+    def __init__(self, blob=0.0, document_intelligence=0.0, figure=0.0, openai=0.0, cosmos=0.0):
+        self.blob = blob
+        self.document_intelligence = document_intelligence
+        self.figure = figure
+        self.openai = openai
+        self.cosmos = cosmos
+
+
+class FakeDownloader:
+    def __init__(self, content, offset=0, total_size=None, etag=None):
+        self._content = content
+        total_size = len(content) if total_size is None else total_size
+        self.properties = SimpleNamespace(
+            size=total_size, content_range=f"bytes {offset}-{offset + len(content) - 1}/{total_size}", etag=etag
+        )
+
+    def readall(self):
+        return self._content
+
+    def chunks(self):
+        yield self._content
+
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.url = f"https://localhost/{container}/{blob}"
+        self.account_name = "localhost"
+        self.credential = None
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        time.sleep(self._service.latency.blob)
+        content = self._service.get(self.container_name, self.blob_name)
+        if content is None:
+            from azure.core.exceptions import ResourceNotFoundError
+            raise ResourceNotFoundError(f"Blob {self.container_name}/{self.blob_name} not found.")
+        # Every upload stores a new bytes object, which stands in for a new blob version
+        etag = f'"0x{id(content):X}"'
+        if kwargs.get("etag") is not None and kwargs["etag"] != etag:
+            from azure.core.exceptions import ResourceModifiedError
+            raise ResourceModifiedError(f"Blob {self.container_name}/{self.blob_name} was modified.")
+        if offset is None:
+            return FakeDownloader(content[:], etag=etag)
+        if offset >= len(content):
+            from azure.core.exceptions import HttpResponseError
+            error = HttpResponseError("The range specified is invalid for the current size of the resource.")
+            error.status_code = 416
+            raise error
+        end = len(content) if length is None else offset + length
+        return FakeDownloader(content[offset:end], offset, len(content), etag)
+
+    def exists(self):
+        time.sleep(self._service.latency.blob)
+        return self._service.get(self.container_name, self.blob_name) is not None
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        time.sleep(self._service.latency.blob)
+        if not isinstance(data, bytes):
+            data = b"".join(data) if not hasattr(data, "read") else data.read()
+        with self._service.lock:
+            key = (self.container_name, self.blob_name)
+            if not overwrite and key in self._service.blobs:
+                from azure.core.exceptions import ResourceExistsError
+                raise ResourceExistsError(f"Blob {self.container_name}/{self.blob_name} already exists.")
+            self._service.blobs[key] = data
+        return {}
+
+
+class FakeContainerClient:
+    def __init__(self, service, container):
+        self._service = service
+        self.container_name = container
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self._service, self.container_name, blob)
+
+    def create_container(self):
+        return self
+
+
+class FileBlob:
+    """Blob content served from a file, so large blobs do not count towards the process memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self._size = os.path.getsize(path)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self._size)
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(max(0, stop - start))
+
+
+class FakeBlobServiceClient:
+    """In-memory Blob Storage, keyed by ``(container, blob)``; values are bytes or a ``FileBlob``."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def get(self, container, blob):
+        with self.lock:
+            return self.blobs.get((container, blob))
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+
+class FakePoller:
+    def __init__(self, result, operation_id, latency):
+        self._result = result
+        self._latency = latency
+        self.details = {"operation_id": operation_id}
+
+    def result(self):
+        time.sleep(self._latency)
+        return self._result
+
+
+class FakeDocumentIntelligenceClient:
+    """Replays one recorded layout result for every document."""
+
+    def __init__(self, fixtures, latency):
+        self.fixtures = fixtures
+        self.latency = latency
+        self._operations = itertools.count(1)
+        self._figure_index = itertools.count()
+        self.pages_analyzed = 0
+        self._lock = threading.Lock()
+
+    def begin_analyze_document(self, model_id, analyze_request=None, pages=None, **kwargs):
+        # Build the request body the way it is sent: streamed from a file, or inline base64 JSON
+        if hasattr(analyze_request, "read"):
+            while analyze_request.read(1024 * 1024):
+                pass
+        elif analyze_request is not None:
+            json.dumps(dict(analyze_request)).encode("utf-8")
+        analyze_result = self.fixtures.analyze_result
+        if pages:
+            # Only the requested pages, e.g. "1-3,7", and their figures are returned
+            wanted = set()
+            for part in pages.split(","):
+                first, _, last = part.partition("-")
+                wanted.update(range(int(first), int(last or first) + 1))
+            analyze_result = dict(
+                analyze_result,
+                pages=[page for page in analyze_result.get("pages", []) if page["pageNumber"] in wanted],
+                figures=[
+                    figure for figure in analyze_result.get("figures", [])
+                    if (figure.get("boundingRegions") or [{"pageNumber": 1}])[0].get("pageNumber") in wanted
+                ]
+            )
+        with self._lock:
+            self.pages_analyzed += len(analyze_result.get("pages", []))
+        # Imported here, like the SDK in the app, so it is part of the first request's cost
+        from azure.ai.documentintelligence.models import AnalyzeResult
+        result = AnalyzeResult(analyze_result)
+        return FakePoller(result, f"bench-{next(self._operations)}", self.latency.document_intelligence)
+
+    def get_analyze_result_figure(self, model_id, result_id, figure_id, **kwargs):
+        time.sleep(self.latency.figure)
+        images = self.fixtures.figure_images
+        return iter([images[next(self._figure_index) % len(images)]])
+
+
+class FakeCompletions:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, model, messages, stream=False, **kwargs):
+        from openai.types.chat import ChatCompletion, ChatCompletionChunk
+        time.sleep(self._client.latency.openai)
+        completion = self._client.fixtures.completion
+        if not stream:
+            return ChatCompletion.model_validate(completion)
+        content = completion["choices"][0]["message"]["content"] or ""
+        # About four characters per streamed token
+        return (
+            ChatCompletionChunk.model_validate({
+                "id": completion["id"],
+                "object": "chat.completion.chunk",
+                "created": completion["created"],
+                "model": completion["model"],
+                "choices": [{"index": 0, "delta": {"content": content[start:start + 4]}, "finish_reason": None}]
+            })
+            for start in range(0, len(content), 4)
+        )
+
+
+class FakeOpenAIClient:
+    """Replays one recorded chat completion for every request."""
+
+    def __init__(self, fixtures, latency):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=FakeCompletions(self))
+
+
+class SlowContainer:
+    """Wraps a results container so every write takes ``latency`` seconds."""
+
+    def __init__(self, container, latency):
+        self.container = container
+        self.latency = latency
+
+    def upsert_item(self, body):
+        time.sleep(self.latency)
+        return self.container.upsert_item(body)
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        time.sleep(self.latency)
+        return self.container.execute_item_batch(batch_operations, partition_key)
+
+    def read_item(self, item, partition_key):
+        return self.container.read_item(item, partition_key)
+
+
+def install(fixtures, latency):
+    """Register the stand-ins as the shared clients used by function_app."""
+    import clients
+    from results_writer import InMemoryContainer, InMemoryTextStore, ResultsWriter, set_results_writer
+
+    clients.reset_clients()
+    blob_service = FakeBlobServiceClient(latency)
+    clients.set_client("blob", blob_service)
+    clients.set_client("document_intelligence", FakeDocumentIntelligenceClient(fixtures, latency))
+    clients.set_client("openai", FakeOpenAIClient(fixtures, latency))
+    container = InMemoryContainer()
+    writer = ResultsWriter(SlowContainer(container, latency.cosmos), InMemoryTextStore())
+    set_results_writer(writer)
+    return SimpleNamespace(blob_service=blob_service, container=container, results_writer=writer)
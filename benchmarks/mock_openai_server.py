@@ -0,0 +1,154 @@
+"""Local stand-in for an Azure OpenAI deployment that enforces a quota.
+
+Requests per minute and tokens per minute are enforced over a sliding
+window, the way Azure OpenAI does, and requests over quota get a 429 with
+``retry-after-ms`` and ``retry-after`` headers. Optionally a share of
+requests fails with a 500. Prompt tokens are estimated as four characters
+per token.
+
+Usage:
+    python benchmarks/mock_openai_server.py --port 8089 --rpm 600 --tpm 1000000
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Quota:
+    """Sliding-window request and token quota, scaled to ``window_seconds``."""
+
+    def __init__(self, rpm, tpm, window_seconds=10):
+        self.window_seconds = window_seconds
+        self.max_requests = rpm * window_seconds / 60 if rpm else None
+        self.max_tokens = tpm * window_seconds / 60 if tpm else None
+        self._entries = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def admit(self, tokens):
+        # Returns 0 when admitted, otherwise the seconds until there is room
+        with self._lock:
+            now = time.monotonic()
+            while self._entries and self._entries[0][0] <= now - self.window_seconds:
+                self._tokens -= self._entries.popleft()[1]
+            over_requests = self.max_requests is not None and len(self._entries) + 1 > self.max_requests
+            over_tokens = self.max_tokens is not None and self._tokens + tokens > self.max_tokens
+            if over_requests or over_tokens:
+                if not self._entries:
+                    return self.window_seconds
+                return max(0.001, self._entries[0][0] + self.window_seconds - now)
+            self._entries.append((now, tokens))
+            self._tokens += tokens
+            return 0
+
+
+class MockOpenAIServer:
+    def __init__(self, rpm=0, tpm=0, latency=0.0, error_rate=0.0, window_seconds=10, port=0):
+        self.quota = Quota(rpm, tpm, window_seconds)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "tokens": 0}
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+                server._count("requests")
+                text = "".join(
+                    part.get("text", "") if isinstance(part, dict) else str(part)
+                    for message in body.get("messages", [])
+                    for part in (message["content"] if isinstance(message.get("content"), list) else [message.get("content") or ""])
+                )
+                prompt_tokens = len(text) // 4 + 4 * len(body.get("messages", []))
+
+                retry_after = server.quota.admit(prompt_tokens)
+                if retry_after:
+                    server._count("throttled")
+                    self._send(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {
+                        "retry-after-ms": str(int(retry_after * 1000)),
+                        "retry-after": str(math.ceil(retry_after)),
+                    })
+                    return
+                if server.error_rate and random.random() < server.error_rate:
+                    server._count("errors")
+                    self._send(500, {"error": {"code": "InternalServerError", "message": "Mock failure."}})
+                    return
+
+                time.sleep(server.latency)
+                server._count("ok")
+                server._count("tokens", prompt_tokens)
+                content = "```json\n" + json.dumps({"extracted_data": [{"section": "1.", "number": "1"}]}) + "\n```"
+                self._send(200, {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "gpt-4o-mini"),
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+                })
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--tpm", type=int, default=1000000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--window", type=float, default=10, help="Quota window in seconds")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.rpm, args.tpm, args.latency, args.error_rate, args.window, args.port)
+    print(f"Serving a mock Azure OpenAI deployment on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import re
+
+
+# Rough characters-per-token ratio for GPT-4o family models on English text
+CHARS_PER_TOKEN = 4
+
+# Lines that open a numbered section, e.g. "10. 1", "10.2.1 Page 5 states: ..." or "3. Responses ..."
+SECTION_HEADING_PATTERN = re.compile(r"^\s*\d+\s?\.(\s?\d+(\s?\.\s?\d+)*)?(\s|$)")
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def split_sections(page_text):
+    """Split a page into segments that each start at a numbered section heading."""
+    sections = []
+    current = []
+    for line in page_text.splitlines(keepends=True):
+        if current and SECTION_HEADING_PATTERN.match(line):
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return sections
+
+
+def _split_oversized(text, max_tokens):
+    # Last resort for a single section over budget: cut on line boundaries
+    pieces = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = estimate_tokens(line)
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append("".join(current))
+            current = []
+            current_tokens = 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+
+def iter_budget_segments(pages, max_tokens):
+    # Whole pages where they fit the budget, otherwise their sections, otherwise line runs
+    for page_text in pages:
+        if estimate_tokens(page_text) <= max_tokens:
+            yield page_text
+            continue
+        for section in split_sections(page_text):
+            if estimate_tokens(section) <= max_tokens:
+                yield section
+            else:
+                yield from _split_oversized(section, max_tokens)
+
+
+def iter_chunks(pages, max_tokens):
+    """Lazily pack page texts into chunks of at most ``max_tokens`` estimated tokens.
+
+    ``pages`` may be any iterable, including a generator, and is consumed
+    once. Whole pages are kept together where possible. Pages that do not
+    fit in a single chunk are split on section headings, then on line
+    boundaries. Chunks are yielded in document order.
+    """
+    current = []
+    current_tokens = 0
+    for segment in iter_budget_segments(pages, max_tokens):
+        segment_tokens = estimate_tokens(segment)
+        if current and current_tokens + segment_tokens > max_tokens:
+            yield "".join(current)
+            current = []
+            current_tokens = 0
+        current.append(segment)
+        current_tokens += segment_tokens
+    if current:
+        yield "".join(current)
+
+
+def chunk_pages(pages, max_tokens):
+    return list(iter_chunks(pages, max_tokens))
+
+
+def group_pages(pages, max_tokens):
+    """Pack whole pages into groups of at most ``max_tokens`` estimated tokens.
+
+    Returns ``(start, end)`` index ranges, end exclusive, in document order.
+    A page over budget forms a group of its own; ``iter_chunks`` splits it
+    further when the group is extracted.
+    """
+    groups = []
+    start = 0
+    group_tokens = 0
+    for index, page_text in enumerate(pages):
+        page_tokens = estimate_tokens(page_text)
+        if index > start and group_tokens + page_tokens > max_tokens:
+            groups.append((start, index))
+            start = index
+            group_tokens = 0
+        group_tokens += page_tokens
+    if len(pages) > start:
+        groups.append((start, len(pages)))
+    return groups
+
+
+def dedupe_key(item):
+    if not isinstance(item, dict):
+        return None
+    section = item.get("section", item.get("section_name"))
+    number = item.get("number")
+    if not number:
+        # Without a number there is nothing reliable to match on
+        return None
+    return (str(section or "").strip().lower(), str(number).strip().lower())
+
+
+def merge_extracted_data(chunk_results):
+    """Merge per-chunk model responses, given in document order.
+
+    ``extracted_data`` entries are concatenated in order and deduplicated on
+    their ``section``/``number`` pair, keeping the first occurrence.
+    """
+    merged = []
+    seen = set()
+    for result in chunk_results:
+        if result is None:
+            continue
+        if isinstance(result, dict):
+            items = result.get("extracted_data", [])
+        else:
+            items = result
+        for item in items:
+            key = dedupe_key(item)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            merged.append(item)
+    return {"extracted_data": merged}
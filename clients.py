@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+
+
+# Connection pool and timeout settings shared by every outbound client
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "300"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "120"))
+
+OPENAI_API_VERSION = "2024-02-15-preview"
+
+COSMOS_DATABASE = "bpadocumentdb"
+COSMOS_CONTAINER = "bpadocumentcontainer"
+
+_lock = threading.RLock()
+_clients = {}
+
+# Test hooks: when set, these replace the real network transports
+_azure_transport_factory = None
+_openai_http_client = None
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+                logging.info(f"Created shared {name} client.")
+    return client
+
+
+def get_http_session():
+    """Process-wide requests session; its pool also backs the Azure SDK clients."""
+    def create():
+        # requests is only loaded once a client or the raw REST path needs it
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _get_or_create("http_session", create)
+
+
+def _azure_transport():
+    if _azure_transport_factory is not None:
+        return _azure_transport_factory()
+
+    from azure.core.pipeline.transport import RequestsTransport
+    # The session is shared, so no client may close it
+    return RequestsTransport(
+        session=get_http_session(),
+        session_owner=False,
+        connection_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT
+    )
+
+
+def get_blob_service_client():
+    def create():
+        from azure.storage.blob import BlobServiceClient
+        return BlobServiceClient.from_connection_string(
+            os.environ['BLOB_CONNECTION_STRING'], transport=_azure_transport()
+        )
+    return _get_or_create("blob", create)
+
+
+def get_document_intelligence_client():
+    def create():
+        from azure.ai.documentintelligence import DocumentIntelligenceClient
+        from azure.core.credentials import AzureKeyCredential
+        return DocumentIntelligenceClient(
+            endpoint=os.environ["FORM_RECOGNIZER_ENDPOINT"],
+            credential=AzureKeyCredential(os.environ["FORM_RECOGNIZER_KEY"]),
+            transport=_azure_transport()
+        )
+    return _get_or_create("document_intelligence", create)
+
+
+def get_queue_client(queue_name):
+    def create():
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+        # The queue trigger reads base64 messages, as the queue output binding writes them
+        return QueueClient.from_connection_string(
+            os.environ['BLOB_CONNECTION_STRING'], queue_name,
+            message_encode_policy=TextBase64EncodePolicy(), transport=_azure_transport()
+        )
+    return _get_or_create(f"queue:{queue_name}", create)
+
+
+def get_cosmos_container():
+    def create():
+        from azure.cosmos import CosmosClient
+        cosmos_client = CosmosClient(
+            os.environ["COSMOS_DB_URI"], credential=os.environ["COSMOS_DB_KEY"], transport=_azure_transport()
+        )
+        database = cosmos_client.get_database_client(COSMOS_DATABASE)
+        return database.get_container_client(COSMOS_CONTAINER)
+    return _get_or_create("cosmos", create)
+
+
+def get_openai_client(deployment=None):
+    # Each deployment uses its own endpoint and key when it has them, and the app settings otherwise
+    name = "openai" if deployment is None or deployment.primary else f"openai:{deployment.name}"
+    endpoint = deployment.endpoint if deployment is not None else None
+    api_key = deployment.api_key if deployment is not None else None
+
+    def create():
+        import httpx
+        import openai
+        http_client = _openai_http_client
+        if http_client is None:
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_MAXSIZE,
+                    max_keepalive_connections=HTTP_POOL_MAXSIZE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+            )
+        return openai.AzureOpenAI(
+            api_key=api_key or os.environ["OPENAI_API_KEY"],
+            api_version=OPENAI_API_VERSION,
+            azure_endpoint=endpoint or os.environ["AZURE_OPENAI_API_ENDPOINT"],
+            http_client=http_client,
+            # Retries are scheduled by rate_limiting.RetryScheduler
+            max_retries=0
+        )
+    return _get_or_create(name, create)
+
+
+def get_openai_settings():
+    # Endpoint and key for the raw REST path, read once per process
+    def create():
+        return {
+            "endpoint": os.environ["AZURE_OPENAI_API_ENDPOINT"],
+            "api_key": os.environ["OPENAI_API_KEY"],
+        }
+    return _get_or_create("openai_settings", create)
+
+
+def set_client(name, client):
+    """Register a prebuilt client, e.g. a local fake, under ``name``."""
+    with _lock:
+        _clients[name] = client
+
+
+def configure_transports(azure_transport_factory=None, openai_http_client=None):
+    """Route clients created from now on through local transports.
+
+    ``azure_transport_factory`` returns an ``azure.core`` ``HttpTransport`` and
+    ``openai_http_client`` is an ``httpx.Client`` (e.g. with ``httpx.MockTransport``).
+    Call ``reset_clients()`` first so existing clients are rebuilt.
+    """
+    global _azure_transport_factory, _openai_http_client
+    with _lock:
+        _azure_transport_factory = azure_transport_factory
+        _openai_http_client = openai_http_client
+
+
+def reset_clients():
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+
+# Documents are downloaded in ranges of this size; larger ones are spooled to a temporary file
+DOCUMENT_DOWNLOAD_CHUNK_BYTES = int(os.environ.get("DOCUMENT_DOWNLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+LARGE_DOCUMENT_MIN_BYTES = int(os.environ.get("LARGE_DOCUMENT_MIN_BYTES", str(32 * 1024 * 1024)))
+# How spooled documents reach Document Intelligence: "stream" (raw request body) or "url" (blob SAS URL)
+DOCUMENT_SUBMIT_MODE = os.environ.get("DOCUMENT_SUBMIT_MODE", "stream")
+DOCUMENT_SAS_EXPIRY_MINUTES = int(os.environ.get("DOCUMENT_SAS_EXPIRY_MINUTES", "60"))
+DOCUMENT_SPOOL_DIR = os.environ.get("DOCUMENT_SPOOL_DIR") or None
+# Figure images larger than this are buffered on disk on their way to blob storage
+FIGURE_SPOOL_MAX_MEMORY_BYTES = int(os.environ.get("FIGURE_SPOOL_MAX_MEMORY_BYTES", str(1024 * 1024)))
+
+# Bytes looked at to recognise the file type
+HEAD_BYTES = 1024
+
+
+class SpooledDocument:
+    """A downloaded document kept in a temporary file instead of memory.
+
+    The content hash and the first bytes are recorded while downloading, so
+    the document is never read back in one piece. ``close`` removes the file.
+    """
+
+    def __init__(self, name, path, size, sha256, head, blob_client=None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.head = head
+        self.blob_client = blob_client
+
+    def __len__(self):
+        return self.size
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def document_head(document):
+    return document.head if isinstance(document, SpooledDocument) else document[:HEAD_BYTES]
+
+
+def document_content_hash(document):
+    if isinstance(document, SpooledDocument):
+        return document.sha256
+    return hashlib.sha256(document).hexdigest()
+
+
+def open_pdf(document):
+    import fitz  # PyMuPDF
+    if isinstance(document, SpooledDocument):
+        # MuPDF reads the file on demand instead of holding it in memory
+        return fitz.open(document.path, filetype="pdf")
+    return fitz.open(stream=document, filetype="pdf")
+
+
+def close_document(document):
+    if isinstance(document, SpooledDocument):
+        document.close()
+
+
+def download_blob_ranges(blob_client, document_name, chunk_bytes=DOCUMENT_DOWNLOAD_CHUNK_BYTES,
+                         spool_min_bytes=LARGE_DOCUMENT_MIN_BYTES):
+    """Download a blob one range at a time.
+
+    Returns the content as bytes when the blob is smaller than
+    ``spool_min_bytes`` and a ``SpooledDocument`` otherwise, so at most one
+    range of a large document is held in memory.
+    """
+    from azure.core import MatchConditions
+    from azure.core.exceptions import HttpResponseError
+    try:
+        first = blob_client.download_blob(offset=0, length=chunk_bytes)
+    except HttpResponseError as e:
+        # A range request on an empty blob is rejected
+        if e.status_code == 416:
+            return b""
+        raise
+    # "bytes <start>-<end>/<total size>"
+    total_size = int(first.properties.content_range.rsplit("/", 1)[-1])
+    first_chunk = first.readall()
+    if len(first_chunk) >= total_size:
+        return first_chunk
+    # The other ranges must come from the same version of the blob: if it is overwritten
+    # meanwhile, the download fails with ResourceModifiedError instead of mixing two versions
+    same_version = {"etag": first.properties.etag, "match_condition": MatchConditions.IfNotModified}
+
+    if total_size < spool_min_bytes:
+        content = bytearray(first_chunk)
+        while len(content) < total_size:
+            content += blob_client.download_blob(offset=len(content), length=chunk_bytes, **same_version).readall()
+        return bytes(content)
+
+    digest = hashlib.sha256(first_chunk)
+    head = first_chunk[:HEAD_BYTES]
+    handle, path = tempfile.mkstemp(prefix="document-", suffix=os.path.splitext(document_name)[1], dir=DOCUMENT_SPOOL_DIR)
+    try:
+        with os.fdopen(handle, "wb") as spool:
+            spool.write(first_chunk)
+            offset = len(first_chunk)
+            del first_chunk
+            while offset < total_size:
+                chunk = blob_client.download_blob(
+                    offset=offset, length=min(chunk_bytes, total_size - offset), **same_version
+                ).readall()
+                if not chunk:
+                    raise IOError(f"Download of {document_name} stopped at byte {offset} of {total_size}.")
+                digest.update(chunk)
+                spool.write(chunk)
+                offset += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    logging.info(f"Document {document_name} ({total_size} bytes) spooled to {path}.")
+    return SpooledDocument(document_name, path, total_size, digest.hexdigest(), head, blob_client)
+
+
+def blob_sas_url(blob_client, expiry_minutes=DOCUMENT_SAS_EXPIRY_MINUTES):
+    # Read-only SAS for the blob; None when the client has no account key to sign with
+    account_key = getattr(blob_client.credential, "account_key", None)
+    if not account_key:
+        return None
+    from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+    sas_token = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.now(timezone.utc) + timedelta(minutes=expiry_minutes)
+    )
+    return f"{blob_client.url}?{sas_token}"
+
+
+def spool_chunks(chunks, max_memory_bytes=FIGURE_SPOOL_MAX_MEMORY_BYTES):
+    """Write an iterable of byte chunks to a spooled file; returns ``(file, sha256, size)`` rewound to the start."""
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes, dir=DOCUMENT_SPOOL_DIR)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
@@ -1,43 +1,90 @@
-import uuid
+import asyncio
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from itertools import chain
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from azure.cosmos import CosmosClient, exceptions
 import json
 import logging
+import math
 import os
-import requests
 import azure.functions as func
-from azure.storage.blob import BlobServiceClient
-import fitz  # PyMuPDF
-from urllib.parse import urljoin
-import openai
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeOutputOption, AnalyzeDocumentRequest
-from azure.core.credentials import AzureKeyCredential
-from azure.core.exceptions import HttpResponseError
+# The Cosmos DB, Document Intelligence, OpenAI, requests and PyMuPDF packages are imported
+# by the stage that first needs them, so a cold start only pays for what a request uses
 
+from clients import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, get_blob_service_client, get_document_intelligence_client, get_http_session, get_openai_client, get_openai_settings
+from batch import BATCH_MAX_DEFERRALS, BATCH_MAX_DEQUEUE_COUNT, BATCH_UPLOAD_TRIGGER_ENABLED, DOCUMENT_QUEUE_NAME, FAILED, PROCESSING, QUEUED, SUCCEEDED, defer_delay_seconds, defer_document, get_status_store, parse_queue_message, queue_message, uploaded_document_name
+from chunking import dedupe_key, estimate_tokens, iter_chunks, merge_extracted_data
+from page_routing import EXTRACTION_VERSION, FAST_PATH_ENABLED, LOCAL, classify_page, is_pdf, page_ranges
+from prompts import COMPACTION_VERSION, DEFAULT_TEMPLATE, PROMPT_COMPACTION_ENABLED, URL_TEMPLATE, compact_pages, iter_compact_pages
+from results_writer import get_results_writer, result_item_id
+from revisions import PageRevision, document_fingerprints, get_page_index_store, lineage_key
+from stream_parser import ExtractedDataParser, parse_model_output
+from telemetry import current_span, in_current_context, span
+from document_io import DOCUMENT_SUBMIT_MODE, SpooledDocument, blob_sas_url, close_document, document_content_hash, document_head, download_blob_ranges, open_pdf, spool_chunks
+from rate_limiting import RETRY_BASE_DELAY_SECONDS, ServiceBusyError, get_document_intelligence_scheduler, get_openai_scheduler
+from result_cache import RESULT_CACHE_ENABLED, LRUCache, build_result_cache, content_hash, extraction_key, response_key
 
+# The FastAPI extension takes a large share of the import time, and importing it switches
+# every HTTP route of the app to HTTP streams, so it is only loaded when asked for
+HTTP_STREAMING_ENABLED = os.environ.get("HTTP_STREAMING_ENABLED", "false").lower() == "true"
+HTTP_STREAMING_AVAILABLE = False
+if HTTP_STREAMING_ENABLED:
+    try:
+        # Optional: lets document_processing_stream flush events as they are produced;
+        # the other HTTP routes then take and return the FastAPI types too
+        from azurefunctions.extensions.http.fastapi import Request as StreamingRequest, Response as FastAPIResponse, StreamingResponse
+        HTTP_STREAMING_AVAILABLE = True
+    except ImportError:
+        pass
 
-# Initialize Cosmos DB client
-COSMOS_URI = os.environ["COSMOS_DB_URI"]
-COSMOS_KEY = os.environ["COSMOS_DB_KEY"]
-COSMOS_DATABASE = "bpadocumentdb"
-COSMOS_CONTAINER = "bpadocumentcontainer"
 
-#cosmos_client = CosmosClient(COSMOS_URI, DefaultAzureCredential())
-#database = cosmos_client.get_database_client(COSMOS_DATABASE)
-#container = database.get_container_client(COSMOS_CONTAINER)
+# SDK clients are created on first use and shared across invocations, see clients.py
 
-blob_service_client = BlobServiceClient.from_connection_string(
-            os.environ['BLOB_CONNECTION_STRING']
-        )
+# Results keyed by document content hash, shared by all invocations on this worker
+result_cache = build_result_cache() if RESULT_CACHE_ENABLED else None
+
+# Documents longer than one chunk are extracted in parallel, chunk by chunk
+OPENAI_CHUNK_MAX_TOKENS = int(os.environ.get("OPENAI_CHUNK_MAX_TOKENS", "8000"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "4"))
+
+# Figures are fetched from Document Intelligence and uploaded to Blob Storage in parallel
+FIGURE_MAX_CONCURRENCY = int(os.environ.get("FIGURE_MAX_CONCURRENCY", "8"))
+
+# Content hashes of figure images known to be in the images container
+uploaded_figure_hashes = LRUCache(max_entries=10000, ttl_seconds=0)
+timings_lock = threading.Lock()
+token_usage_lock = threading.Lock()
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-@app.route(route="document_processing")
-def document_processing(req: func.HttpRequest) -> func.HttpResponse:
+def fastapi_response(response):
+    # Routes served over HTTP streams share the handlers of the func.HttpRequest routes
+    return FastAPIResponse(
+        content=response.get_body(),
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.mimetype
+    )
+
+if HTTP_STREAMING_AVAILABLE:
+    @app.route(route="document_processing")
+    async def document_processing(req: StreamingRequest) -> FastAPIResponse:
+        # The pipeline blocks on I/O, so it runs on a worker thread
+        response = await asyncio.to_thread(document_processing_response, req.query_params.get('document_name'))
+        return fastapi_response(response)
+else:
+    @app.route(route="document_processing")
+    def document_processing(req: func.HttpRequest) -> func.HttpResponse:
+        return document_processing_response(req.params.get('document_name'))
+
+def document_processing_response(document_name):
     logging.info('Python HTTP trigger function processed a request.')
 
-    document_name = req.params.get('document_name')
     if not document_name:
         store_response_in_cosmos(
             status="failed",
@@ -51,41 +98,106 @@ def document_processing(req: func.HttpRequest) -> func.HttpResponse:
             status_code=400
         )
 
+    return process_document_request(document_name)
+
+def process_document_request(document_name):
+    # Runs the full pipeline for one document; shared by the HTTP route and the batch worker
+    with span("document_processing", document_name=document_name) as request_span:
+        response = process_document_pipeline(document_name)
+        request_span.set_attribute("http.status_code", response.status_code)
+    return response
+
+def process_document_pipeline(document_name):
+    # The document text is kept once, as its pages; it is only joined for the results writer
+    pages = []
+    document_hash = None
+    document_content = None
+    request_span = current_span()
     try:
         document_content = download_document(document_name)
-        txt_content = process_document_DI(document_name, document_content)
-        payload = generate_prompt_url(txt_content)
-        json_response = call_openai_api(payload)
-        cleaned_content = json_response.choices[0].message.content.strip("```json\n").strip("```") 
-
-        if cleaned_content:
-            try:
-                response_data = json.loads(cleaned_content)
-                store_response_in_cosmos(
-                    status="success",
-                    http_status_code=200,
-                    document_name=document_name,
-                    text_content=txt_content,
-                    response_json=response_data
-                )
+        document_hash = document_content_hash(document_content)
+        request_span.set_attributes(document_bytes=len(document_content))
+
+        if result_cache is not None:
+            cached_response = result_cache.get(document_response_key(document_hash))
+            if cached_response is not None:
+                logging.info(f"Returning cached result for document {document_name}.")
+                request_span.set_attributes(cache_status="HIT")
                 return func.HttpResponse(
-                    json.dumps(response_data),
+                    json.dumps(cached_response),
                     mimetype="application/json",
-                    status_code=200
+                    status_code=200,
+                    headers=result_cache.headers("HIT")
                 )
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON decode error: {e}")
+
+        revision = load_page_revision(document_name, document_content)
+        pages = process_document_cached(document_name, document_content, document_hash, revision)
+        if revision is not None and len(pages) != len(revision.fingerprints):
+            logging.warning(f"Page count of document {document_name} does not match its fingerprints, processing all pages.")
+            revision = None
+        request_span.set_attributes(document_pages=len(pages))
+        if request_span.recording:
+            request_span.set_attributes(text_bytes=sum(len(page.encode("utf-8")) for page in pages))
+        prompt_pages = pages
+        if PROMPT_COMPACTION_ENABLED:
+            # Compacted page by page as chunks are built; page groups of a revision need them all at once
+            prompt_pages = compact_pages(pages) if revision is not None else iter_compact_pages(pages)
+            logging.info(
+                f"Prompt compaction for document {document_name}: "
+                f"~{sum(map(estimate_tokens, pages))} document tokens before compaction."
+            )
+
+        try:
+            token_usage = new_token_usage()
+            response_data, incomplete_chunks = extract_document_data(prompt_pages, token_usage, revision)
+            logging.info(
+                f"OpenAI usage for document {document_name}: {token_usage['requests']} requests, "
+                f"{token_usage['prompt_tokens']} prompt tokens, {token_usage['completion_tokens']} completion tokens."
+            )
+            request_span.set_attributes(
+                openai_prompt_tokens=token_usage["prompt_tokens"],
+                openai_completion_tokens=token_usage["completion_tokens"],
+                openai_requests=token_usage["requests"],
+                incomplete_chunks=incomplete_chunks
+            )
+            if response_data is not None:
+                if incomplete_chunks:
+                    logging.warning(f"Document {document_name}: {incomplete_chunks} chunks returned no content or incomplete output.")
                 store_response_in_cosmos(
-                    status="failed",
-                    http_status_code=500,
+                    status="incomplete" if incomplete_chunks else "success",
+                    http_status_code=200,
                     document_name=document_name,
-                    text_content=txt_content,
-                    response_json={"error": str(e)}
+                    text_content=pages,
+                    response_json=response_data,
+                    document_hash=document_hash
                 )
+                # A result with missing chunks is returned but not reused; the next request extracts it again
+                if result_cache is not None and not incomplete_chunks:
+                    result_cache.set(document_response_key(document_hash), response_data)
+                if revision is not None:
+                    store_page_revision(document_name, document_hash, revision, pages)
+                headers = response_headers("MISS", token_usage)
+                headers["X-Incomplete-Chunks"] = str(incomplete_chunks)
                 return func.HttpResponse(
-                    "Failed to parse the response from OpenAI.",
-                    status_code=500
+                    json.dumps(response_data),
+                    mimetype="application/json",
+                    status_code=200,
+                    headers=headers
                 )
+        except json.JSONDecodeError as e:
+            logging.error(f"JSON decode error: {e}")
+            store_response_in_cosmos(
+                status="failed",
+                http_status_code=500,
+                document_name=document_name,
+                text_content=pages,
+                response_json={"error": str(e)},
+                document_hash=document_hash
+            )
+            return func.HttpResponse(
+                "Failed to parse the response from OpenAI.",
+                status_code=500
+            )
 
         logging.error("No content in the OpenAI response.")
         
@@ -94,123 +206,497 @@ def document_processing(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500
         )
 
+    except ServiceBusyError as e:
+        # Throttling is not a property of the document: nothing is stored and the caller retries
+        logging.warning(f"Processing of document {document_name} deferred: {e}")
+        return func.HttpResponse(
+            "The service is busy, please retry later.",
+            status_code=503,
+            headers={"Retry-After": str(math.ceil(e.retry_after or RETRY_BASE_DELAY_SECONDS))}
+        )
     except Exception as e:
         logging.error(f"An internal server error occurred: {e}")
         store_response_in_cosmos(
             status="failed",
             http_status_code=500,
             document_name=document_name,
-            text_content=txt_content,
-            response_json={"error": str(e)}
+            text_content=pages,
+            response_json={"error": str(e)},
+            document_hash=document_hash
         )
 
         return func.HttpResponse(
             "An internal server error occurred.",
             status_code=500
         )
+    finally:
+        # Spooled documents live in a temporary file until the request is done
+        close_document(document_content)
         
 
+if HTTP_STREAMING_AVAILABLE:
+    @app.route(route="document_processing_stream", methods=[func.HttpMethod.GET])
+    async def document_processing_stream(req: StreamingRequest) -> StreamingResponse:
+        document_name = req.query_params.get('document_name')
+        if not document_name:
+            return StreamingResponse(
+                iter([format_event({"type": "error", "error": "Missing 'document_name' parameter."}, "ndjson")]),
+                media_type=STREAM_MEDIA_TYPES["ndjson"],
+                status_code=400
+            )
+        event_format = req.query_params.get('format', 'ndjson')
+        if event_format not in STREAM_MEDIA_TYPES:
+            event_format = "ndjson"
+        # The generator blocks on I/O, so the response runs it on a worker thread
+        return StreamingResponse(
+            (format_event(event, event_format) for event in iter_document_events(document_name)),
+            media_type=STREAM_MEDIA_TYPES[event_format]
+        )
+else:
+    @app.route(route="document_processing_stream")
+    def document_processing_stream(req: func.HttpRequest) -> func.HttpResponse:
+        # Without the HTTP streaming extension the same events are returned in one body
+        document_name = req.params.get('document_name')
+        if not document_name:
+            return func.HttpResponse(
+                "Please provide a 'document_name' parameter in the query string.",
+                status_code=400
+            )
+        event_format = req.params.get('format', 'ndjson')
+        if event_format not in STREAM_MEDIA_TYPES:
+            event_format = "ndjson"
+        return func.HttpResponse(
+            "".join(format_event(event, event_format) for event in iter_document_events(document_name)),
+            mimetype=STREAM_MEDIA_TYPES[event_format],
+            status_code=200
+        )
+
+if HTTP_STREAMING_AVAILABLE:
+    @app.route(route="batch_submit", methods=["POST"])
+    @app.queue_output(arg_name="messages", queue_name=DOCUMENT_QUEUE_NAME, connection="BLOB_CONNECTION_STRING")
+    async def batch_submit(req: StreamingRequest, messages: func.Out[list]) -> FastAPIResponse:
+        try:
+            body = json.loads(await req.body())
+        except ValueError:
+            body = None
+        return fastapi_response(await asyncio.to_thread(batch_submit_response, body, messages))
+else:
+    @app.route(route="batch_submit", methods=["POST"])
+    @app.queue_output(arg_name="messages", queue_name=DOCUMENT_QUEUE_NAME, connection="BLOB_CONNECTION_STRING")
+    def batch_submit(req: func.HttpRequest, messages: func.Out[list]) -> func.HttpResponse:
+        try:
+            body = req.get_json()
+        except ValueError:
+            body = None
+        return batch_submit_response(body, messages)
+
+def batch_submit_response(body, messages):
+    document_names = body.get("document_names") if isinstance(body, dict) else None
+    if (
+        not document_names or not isinstance(document_names, list)
+        or not all(isinstance(document_name, str) and document_name.strip() for document_name in document_names)
+    ):
+        return func.HttpResponse(
+            "Please provide a JSON body with a 'document_names' list of non-empty strings.",
+            status_code=400
+        )
+
+    messages.set([queue_message(document_name) for document_name in document_names])
+    for document_name in document_names:
+        get_status_store().set_state(document_name, QUEUED)
+    logging.info(f"Queued {len(document_names)} documents for batch processing.")
+
+    return func.HttpResponse(
+        json.dumps({"queued": len(document_names)}),
+        mimetype="application/json",
+        status_code=202
+    )
+
+if BATCH_UPLOAD_TRIGGER_ENABLED:
+    @app.event_grid_trigger(arg_name="event")
+    @app.queue_output(arg_name="message", queue_name=DOCUMENT_QUEUE_NAME, connection="BLOB_CONNECTION_STRING")
+    def document_uploaded(event: func.EventGridEvent, message: func.Out[str]):
+        # Only the BlobCreated event is delivered, so the document is never read into the worker here
+        document_name = uploaded_document_name(event.event_type, event.subject)
+        if document_name is None:
+            logging.info(f"Ignoring Event Grid event {event.event_type} for {event.subject}.")
+            return
+        message.set(queue_message(document_name))
+        get_status_store().set_state(document_name, QUEUED)
+        logging.info(f"Queued uploaded document {document_name} for batch processing.")
+
+@app.queue_trigger(arg_name="msg", queue_name=DOCUMENT_QUEUE_NAME, connection="BLOB_CONNECTION_STRING")
+def document_worker(msg: func.QueueMessage):
+    # Concurrency is bounded by the queues settings in host.json; per-document state is kept by get_status_store()
+    document_name, deferrals = parse_queue_message(msg.get_body().decode("utf-8"))
+    if not document_name:
+        logging.error(f"Discarding queue message {msg.id} without a document name.")
+        return
+
+    try:
+        response = process_queued_document(document_name, dequeue_count=msg.dequeue_count)
+        if response.status_code == 503:
+            if deferrals >= BATCH_MAX_DEFERRALS:
+                get_status_store().set_state(
+                    document_name, FAILED, http_status_code=503,
+                    error=f"Still throttled after {deferrals} deferrals."
+                )
+                return
+            # Queued again with a delay instead of raising, which would use up a dequeue of this message
+            retry_after = response.headers.get("Retry-After")
+            delay_seconds = defer_delay_seconds(deferrals, float(retry_after) if retry_after else None)
+            defer_document(document_name, deferrals + 1, delay_seconds)
+            logging.warning(f"Document {document_name} was throttled, queued again in {delay_seconds:.0f}s.")
+    except Exception as e:
+        # The host retries the message; after the last attempt it goes to the poison queue
+        # and nothing else would update the document's state
+        if (msg.dequeue_count or 0) >= BATCH_MAX_DEQUEUE_COUNT:
+            get_status_store().set_state(
+                document_name, FAILED, error=str(e), dequeue_count=msg.dequeue_count
+            )
+        raise
+
+if HTTP_STREAMING_AVAILABLE:
+    @app.route(route="document_status")
+    async def document_status(req: StreamingRequest) -> FastAPIResponse:
+        response = await asyncio.to_thread(
+            document_status_response, req.query_params.get('document_name'), req.query_params.get('state')
+        )
+        return fastapi_response(response)
+else:
+    @app.route(route="document_status")
+    def document_status(req: func.HttpRequest) -> func.HttpResponse:
+        return document_status_response(req.params.get('document_name'), req.params.get('state'))
+
+def document_status_response(document_name, state=None):
+    if document_name:
+        item = get_status_store().get(document_name)
+        if item is None:
+            return func.HttpResponse(
+                f"No status found for document '{document_name}'.",
+                status_code=404
+            )
+        return func.HttpResponse(json.dumps(item), mimetype="application/json", status_code=200)
+
+    items = get_status_store().list(state=state)
+    return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
+
+def process_queued_document(document_name, dequeue_count=None):
+    get_status_store().set_state(document_name, PROCESSING, dequeue_count=dequeue_count)
+    response = process_document_request(document_name)
+    if response.status_code == 200:
+        get_status_store().set_state(document_name, SUCCEEDED, http_status_code=200)
+    elif response.status_code == 503:
+        # Throttled: document_worker queues the document again with a delay
+        get_status_store().set_state(document_name, QUEUED, http_status_code=503, dequeue_count=dequeue_count)
+    else:
+        get_status_store().set_state(
+            document_name, FAILED,
+            http_status_code=response.status_code,
+            error=response.get_body().decode("utf-8")
+        )
+    return response
+
 def download_document(document_name):
     try:
         container_name = 'documents'
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=document_name)
+        with span("download_document", document_name=document_name) as download_span:
+            blob_client = get_blob_service_client().get_blob_client(container=container_name, blob=document_name)
 
-        stream_downloader = blob_client.download_blob()
-        document_content = stream_downloader.readall()
+            # Bytes for ordinary documents; large ones are spooled to a temporary file range by range
+            document_content = download_blob_ranges(blob_client, document_name)
+            download_span.set_attributes(document_bytes=len(document_content), document_spooled=isinstance(document_content, SpooledDocument))
         logging.info(f"Document {document_name} downloaded successfully.")
         return document_content
     except Exception as e:
         logging.error(f"Failed to download document {document_name}: {e}")
         raise e
 
+def document_response_key(document_hash):
+    # Cached OpenAI results are only reused under the same template, extraction and compaction settings
+    return response_key(document_hash, URL_TEMPLATE.version, EXTRACTION_VERSION, COMPACTION_VERSION)
+
+def process_document_cached(document_name, document_content, document_hash, revision=None):
+    # Document Intelligence output is reusable across prompt template versions
+    with span("process_document", document_name=document_name, document_bytes=len(document_content)) as process_span:
+        if result_cache is None:
+            pages = process_document_revised(document_name, document_content, revision)
+            process_span.set_attributes(document_pages=len(pages))
+            return pages
+
+        key = extraction_key(document_hash, EXTRACTION_VERSION)
+        cached_extraction = result_cache.get(key)
+        if cached_extraction is not None:
+            logging.info(f"Using cached Document Intelligence output for document {document_name}.")
+            process_span.set_attributes(cache_status="HIT", document_pages=len(cached_extraction["pages"]))
+            return cached_extraction["pages"]
+
+        pages = process_document_revised(document_name, document_content, revision)
+        result_cache.set(key, {"pages": pages})
+        process_span.set_attributes(cache_status="MISS", document_pages=len(pages))
+        return pages
+
+def load_page_revision(document_name, document_content):
+    # Fingerprints the pages of a PDF and looks up the previous revision of its lineage;
+    # None when there is no page index or the document is not a PDF
+    page_index_store = get_page_index_store()
+    if page_index_store is None or not is_pdf(document_head(document_content)):
+        return None
+    lineage = lineage_key(document_name)
+    with span("page_fingerprints", document_name=document_name, lineage=lineage) as revision_span:
+        try:
+            fingerprints = document_fingerprints(document_content)
+            previous = page_index_store.get(lineage)
+        except Exception as e:
+            logging.warning(f"No page fingerprints for document {document_name}, processing all pages: {e}")
+            return None
+        # Items are only reused from a revision processed under the same prompt and compaction settings
+        revision = PageRevision(lineage, fingerprints, previous, f"{URL_TEMPLATE.version}:{COMPACTION_VERSION}")
+        revision_span.set_attributes(document_pages=len(fingerprints), pages_changed=len(revision.changed_pages))
+    if revision.has_previous:
+        logging.info(
+            f"Document {document_name}: {len(revision.changed_pages)} of {len(fingerprints)} pages changed "
+            f"since {revision.previous_document_name}."
+        )
+    return revision
+
+def process_document_revised(document_name, document_content, revision=None):
+    # Pages unchanged since the previous revision keep their text; only the others are analyzed
+    if revision is None or not revision.has_previous:
+        return process_document_routed(document_name, document_content)
+    changed_pages = revision.changed_pages
+    analyzed = dict(zip(changed_pages, process_document_routed(document_name, document_content, changed_pages))) if changed_pages else {}
+    return [
+        analyzed[page_number] if page_number in analyzed else revision.previous_text(page_number)
+        for page_number in range(1, len(revision.fingerprints) + 1)
+    ]
+
+def store_page_revision(document_name, document_hash, revision, pages):
+    # The next revision of the document is compared against this one; failures only cost reuse
+    with span("store_page_index", document_name=document_name, lineage=revision.lineage):
+        try:
+            get_page_index_store().put(revision.lineage, revision.record(document_name, document_hash, pages))
+        except Exception as e:
+            logging.error(f"Failed to store the page index of document {document_name}: {e}")
+
 def process_document_DI(document_name, document_content):
-    try:
-        FORM_RECOGNIZER_ENDPOINT = os.environ["FORM_RECOGNIZER_ENDPOINT"]
-        FORM_RECOGNIZER_KEY = os.environ["FORM_RECOGNIZER_KEY"]
+    return "".join(process_document_pages_DI(document_name, document_content))
+
+def upload_figure(document_intelligence_client, model_id, operation_id, figure_id, timings):
+    # Fetches one figure image and stores it under its content hash; returns the image URL
+    fetch_start = time.perf_counter()
+    with span("figure_fetch", figure_id=figure_id) as fetch_span:
+        response = document_intelligence_client.get_analyze_result_figure(
+            model_id=model_id,
+            result_id=operation_id,
+            figure_id=figure_id
+        )
+        # Stream the content from the response; large images are buffered on disk, not in memory
+        image_file, image_hash, image_size = spool_chunks(response)
+        fetch_span.set_attributes(figure_bytes=image_size)
+    with timings_lock:
+        timings["figure_fetch"] += time.perf_counter() - fetch_start
 
-        document_intelligence_client = DocumentIntelligenceClient(
-        endpoint=FORM_RECOGNIZER_ENDPOINT, credential=AzureKeyCredential(FORM_RECOGNIZER_KEY)
+    with image_file:
+        return store_figure_image(image_file, "png", timings, image_hash=image_hash, image_size=image_size)
+
+def store_figure_image(image, image_ext, timings, image_hash=None, image_size=None):
+    # Identical images (logos, repeated charts) are only stored once; returns the image URL.
+    # image is bytes, or a file object when its hash and size are given
+    from azure.core.exceptions import ResourceExistsError
+    if image_hash is None:
+        image_hash = content_hash(image)
+        image_size = len(image)
+    blob_client = get_blob_service_client().get_blob_client(container="images", blob=f"{image_hash}.{image_ext}")
+
+    upload_start = time.perf_counter()
+    uploaded = False
+    with span("figure_upload", figure_bytes=image_size) as upload_span:
+        if uploaded_figure_hashes.get(image_hash) is None:
+            if not blob_client.exists():
+                try:
+                    blob_client.upload_blob(image, length=image_size, overwrite=False)
+                    uploaded = True
+                except ResourceExistsError:
+                    # Another worker uploaded the same image in the meantime
+                    pass
+            uploaded_figure_hashes.set(image_hash, True)
+        upload_span.set_attributes(figure_uploaded=uploaded)
+    upload_seconds = time.perf_counter() - upload_start
+
+    with timings_lock:
+        timings["figure_upload"] += upload_seconds
+        timings["figures_uploaded" if uploaded else "figures_skipped"] += 1
+
+    return blob_client.url
+
+# Placeholder for a figure's image URL inside the segments of a page
+ImageSegment = namedtuple("ImageSegment", ["image_url"])
+
+def iter_page_segments(page, caption_to_image):
+    # Yields the text of one layout page line by line; a figure caption is followed by its image URL
+    if hasattr(page, 'lines') and page.lines:
+        for line in page.lines:
+            line_text = line.content
+            yield line_text + "\n"
+
+            # Check if the line matches any figure caption
+            if line_text in caption_to_image:
+                # Insert the image URL after the caption
+                yield ImageSegment(caption_to_image[line_text])
+    elif hasattr(page, 'words') and page.words:
+        # Fallback if lines are not available
+        yield ' '.join(word.content for word in page.words) + "\n"
+    else:
+        print(f"No text content found on page {page.page_number}.")
+
+def iter_layout_page_segments(result, page_figures):
+    # Yields one list of segments per page of a layout result, in page order
+    for page in result.pages or []:
+        # Get figures for the current page
+        figures_on_page = page_figures.get(page.page_number, [])
+
+        # Build a list of captions to image URLs for matching
+        caption_to_image = {fig['caption']: fig['image_url'] for fig in figures_on_page}
+
+        yield list(iter_page_segments(page, caption_to_image))
+
+def render_segment(segment):
+    if not isinstance(segment, ImageSegment):
+        return segment
+    # Pending figure upload, or a plain URL when the figure was resolved up front
+    image_url = segment.image_url
+    if isinstance(image_url, Future):
+        image_url = image_url.result()
+    return f"Image URL: {image_url}\n"
+
+def render_page(segments):
+    # Joined once, so assembly stays linear in the page size
+    return "".join(map(render_segment, segments))
+
+def process_document_pages_DI(document_name, document_content, page_numbers=None):
+    # Returns the extracted text of each page, or of the given pages, in page order
+    extracted_pages = analyze_document_layout(document_name, document_content, page_numbers)
+    if page_numbers is None:
+        return list(extracted_pages.values())
+    return [extracted_pages.get(page_number, "") for page_number in page_numbers]
+
+def new_timings():
+    return {
+        "analyze": 0.0,
+        "figure_fetch": 0.0,
+        "figure_upload": 0.0,
+        "figures_uploaded": 0,
+        "figures_skipped": 0,
+        "text": 0.0,
+        "figure_wait": 0.0,
+    }
+
+def submit_layout_analysis(document_intelligence_client, document_content, page_numbers=None):
+    # Small documents are sent inline. Spooled ones are passed by SAS URL or streamed from
+    # their temporary file as the raw request body, instead of being read and base64-encoded
+    from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeOutputOption
+    from azure.core.polling.base_polling import LROBasePolling
+    options = {
+        "output": [AnalyzeOutputOption.FIGURES],
+        "pages": page_ranges(page_numbers) if page_numbers else None,
+        # A throttled submit goes back to the scheduler instead of being resent by azure-core's
+        # RetryPolicy. The SDK would pass retry_total on to its polling method as well, so the
+        # polling method is built here and polls keep their retries
+        "retry_total": 0,
+        "polling": LROBasePolling()
+    }
+    if not isinstance(document_content, SpooledDocument):
+        return document_intelligence_client.begin_analyze_document(
+            "prebuilt-layout", analyze_request=AnalyzeDocumentRequest(bytes_source=document_content), **options
         )
 
-        poller = document_intelligence_client.begin_analyze_document(
-            "prebuilt-layout", analyze_request=AnalyzeDocumentRequest(bytes_source=document_content), output=[AnalyzeOutputOption.FIGURES]
+    sas_url = blob_sas_url(document_content.blob_client) if DOCUMENT_SUBMIT_MODE == "url" else None
+    if sas_url is not None:
+        return document_intelligence_client.begin_analyze_document(
+            "prebuilt-layout", analyze_request=AnalyzeDocumentRequest(url_source=sas_url), **options
         )
+    # Reopened on every attempt, so a retry sends the whole file again
+    with document_content.open() as document_file:
+        return document_intelligence_client.begin_analyze_document(
+            "prebuilt-layout", analyze_request=document_file, content_type="application/octet-stream", **options
+        )
+
+def analyze_document_layout(document_name, document_content, page_numbers=None):
+    # Returns {page_number: text} for the analyzed pages, in page order; all pages unless page_numbers is given
+    from azure.ai.documentintelligence.models import AnalyzeResult
+    from azure.core.exceptions import HttpResponseError
+    timings = new_timings()
+    document_start = time.perf_counter()
+    try:
+        document_intelligence_client = get_document_intelligence_client()
+
+        with span("di_submit", document_name=document_name, document_bytes=len(document_content)):
+            poller = get_document_intelligence_scheduler().call(
+                lambda deployment: submit_layout_analysis(document_intelligence_client, document_content, page_numbers)
+            )
 
-        result: AnalyzeResult = poller.result()
+        with span("di_poll", document_name=document_name) as poll_span:
+            result: AnalyzeResult = poller.result()
+            poll_span.set_attributes(document_pages=len(result.pages or []), document_figures=len(result.figures or []))
         operation_id = poller.details["operation_id"]
-        
-        # Dictionary to store figures per page
+        timings["analyze"] = time.perf_counter() - document_start
+
+        # Dictionary to store figures per page; image URLs are futures until the upload finishes
         page_figures = {}
 
-        if result.figures:
-            for figure in result.figures:
-                if figure.id:
-                    # Retrieve the figure image
-                    response = document_intelligence_client.get_analyze_result_figure(
-                        model_id=result.model_id,
-                        result_id=operation_id,
-                        figure_id=figure.id
-                    )
-                    # Read the content from response
-                    image_bytes = b''.join(response)
-
-                    # Upload the image to Blob Storage
-                    blob_name = f"{document_name}_{figure.id}.png"
-                    blob_client = blob_service_client.get_blob_client(container="images", blob=blob_name)
-                    blob_client.upload_blob(image_bytes, overwrite=True)
-
-                    # Get the image URL
-                    image_url = blob_client.url
-
-                    # Get the page number
-                    if figure.bounding_regions:
-                        page_number = figure.bounding_regions[0].page_number
-                    else:
-                        page_number = 1  # Default or handle appropriately
-
-                    # Collect the figure data per page
-                    if page_number not in page_figures:
-                        page_figures[page_number] = []
-                    page_figures[page_number].append({
-                        'caption': figure.caption.content if figure.caption else '',
-                        'image_url': image_url
-                    })
-
-        if not result.pages:
-            print("No pages detected in the document.")
-            extracted_content = ""
-        else:
-            # Extract content from the result
-            extracted_content = ""
-
-            for page in result.pages:
-                page_number = page.page_number
-
-                # Get figures for the current page
-                figures_on_page = page_figures.get(page_number, [])
-
-                # Build a list of captions to image URLs for matching
-                caption_to_image = {fig['caption']: fig['image_url'] for fig in figures_on_page}
-
-                # Process the page lines
-                if hasattr(page, 'lines') and page.lines:
-                    for line in page.lines:
-                        line_text = line.content
-                        extracted_content += line_text + "\n"
-                        
-                        # Check if the line matches any figure caption
-                        if line_text in caption_to_image:
-                            # Insert the image URL after the caption
-                            image_url = caption_to_image[line_text]
-                            extracted_content += f"Image URL: {image_url}\n"
-                elif hasattr(page, 'words') and page.words:
-                    # Fallback if lines are not available
-                    page_text = ' '.join(word.content for word in page.words)
-                    extracted_content += page_text + "\n"
-                else:
-                    print(f"No text content found on page {page_number}.")
-            
+        with ThreadPoolExecutor(max_workers=FIGURE_MAX_CONCURRENCY) as executor:
+            if result.figures:
+                for figure in result.figures:
+                    if figure.id:
+                        # Retrieve and upload the figure image in the background
+                        image_url = executor.submit(
+                            in_current_context(upload_figure), document_intelligence_client, result.model_id, operation_id, figure.id, timings
+                        )
+
+                        # Get the page number
+                        if figure.bounding_regions:
+                            page_number = figure.bounding_regions[0].page_number
+                        else:
+                            page_number = 1  # Default or handle appropriately
+
+                        # Collect the figure data per page
+                        if page_number not in page_figures:
+                            page_figures[page_number] = []
+                        page_figures[page_number].append({
+                            'caption': figure.caption.content if figure.caption else '',
+                            'image_url': image_url
+                        })
+
+            # Page text is assembled while the figures are still being transferred;
+            # each page is a list of text segments and pending image URLs
+            text_start = time.perf_counter()
+            if not result.pages:
+                print("No pages detected in the document.")
+            page_segments = list(iter_layout_page_segments(result, page_figures))
+            timings["text"] = time.perf_counter() - text_start
+
+            wait_start = time.perf_counter()
+            extracted_pages = {
+                page.page_number: render_page(segments) for page, segments in zip(result.pages or [], page_segments)
+            }
+            # Uploads of figures whose caption never matched a line still have to finish
+            for figures_on_page in page_figures.values():
+                for fig in figures_on_page:
+                    fig['image_url'].result()
+            timings["figure_wait"] = time.perf_counter() - wait_start
+
+        if result.pages:
             print(f"Extracted text from document '{document_name}' with images inserted.")
+
+        timings["total"] = time.perf_counter() - document_start
+        logging.info(
+            f"Document '{document_name}' timings: total={timings['total']:.3f}s analyze={timings['analyze']:.3f}s "
+            f"text={timings['text']:.3f}s figure_wait={timings['figure_wait']:.3f}s "
+            f"figure_fetch={timings['figure_fetch']:.3f}s figure_upload={timings['figure_upload']:.3f}s "
+            f"(cumulative over {FIGURE_MAX_CONCURRENCY} workers), "
+            f"figures uploaded={timings['figures_uploaded']} skipped={timings['figures_skipped']}"
+        )
     except HttpResponseError as e:
         print(f"HTTP error during document analysis: {e.message}")
         raise e
@@ -218,198 +704,445 @@ def process_document_DI(document_name, document_content):
         print(f"Unexpected error analyzing document: {e}")
         raise e
 
-    return extracted_content
+    return extracted_pages
 
-def process_document(document_name, document_content):
+def iter_pdf_page_segments(pdf_doc, page, executor, timings):
+    # Yields the text blocks of a born-digital PDF page in reading order; each embedded
+    # image becomes an image URL placed after the text block closest below its top edge
+    text_blocks = [
+        block for block in page.get_text("blocks", sort=True)
+        if block[6] == 0 and block[4].strip()
+    ]
+    images_after_block = {}
+    seen_xrefs = set()
+    for info in page.get_image_info(xrefs=True):
+        xref = info.get("xref")
+        if not xref or xref in seen_xrefs:
+            continue
+        seen_xrefs.add(xref)
+
+        # PyMuPDF documents are not thread-safe, so only the upload runs in the pool
+        base_image = pdf_doc.extract_image(xref)
+        image_url = executor.submit(in_current_context(store_figure_image), base_image["image"], base_image["ext"], timings)
+
+        image_top = info["bbox"][1]
+        below = [i for i, block in enumerate(text_blocks) if block[1] >= image_top]
+        block_index = min(below, key=lambda i: text_blocks[i][1] - image_top) if below else len(text_blocks) - 1
+        images_after_block.setdefault(block_index, []).append(ImageSegment(image_url))
+
+    # Images on a page without text
+    yield from images_after_block.pop(-1, [])
+    for i, block in enumerate(text_blocks):
+        block_text = block[4]
+        yield block_text if block_text.endswith("\n") else block_text + "\n"
+        yield from images_after_block.get(i, [])
+
+def extract_pdf_pages(document_name, pdf_doc, page_numbers, timings):
+    # Returns {page_number: text} for the given 1-based page numbers, extracted locally
+    with ThreadPoolExecutor(max_workers=FIGURE_MAX_CONCURRENCY) as executor:
+        page_segments = [
+            (page_number, list(iter_pdf_page_segments(pdf_doc, pdf_doc.load_page(page_number - 1), executor, timings)))
+            for page_number in page_numbers
+        ]
+        return {page_number: render_page(segments) for page_number, segments in page_segments}
+
+def process_document_pages(document_name, document_content):
+    # Returns the text of each page extracted locally with PyMuPDF, in page order
     try:
         # Open the PDF document
-        pdf_doc = fitz.open(stream=document_content, filetype="pdf")
-        txt_content = ""
-        for page_num in range(len(pdf_doc)):
-            page = pdf_doc.load_page(page_num)
-            txt_content += page.get_text()
-
-            # Handle images within the PDF
-            image_list = page.get_images(full=True)
-            for img_index, img in enumerate(image_list, start=1):
-                xref = img[0]
-                base_image = pdf_doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                image_ext = base_image["ext"]
-                unique_id = uuid.uuid4().hex
-                image_filename = f"image_{unique_id}.{image_ext}"
-
-                try:
-                    blob_client_image = blob_service_client.get_blob_client(container="images", blob=image_filename)
-                    
-                    # Upload the image
-                    blob_client_image.upload_blob(image_bytes, overwrite=True)
-                    logging.info(f"Uploaded image '{image_filename}' to container 'images'.")
-                    
-                    # Construct the image URL
-                    image_url = urljoin(os.environ["BLOB_BASE_URL"], image_filename)
-                    # Insert image URL as placeholder
-                    txt_content += f"![Image]({image_url})\n"
-                except Exception as e:
-                    logging.error(f"Error uploading image '{image_filename}': {e}")
-                    store_response_in_cosmos(
-                        status=f"failed",
-                        http_status_code=500,
-                        document_name=document_name,
-                        text_content=txt_content,
-                        response_json={"error": f"Error uploading image '{image_filename}': {e}"}
-                    )
-                    raise e
-
-        pdf_doc.close()
+        pdf_doc = open_pdf(document_content)
+        try:
+            pages = extract_pdf_pages(document_name, pdf_doc, range(1, len(pdf_doc) + 1), new_timings())
+        finally:
+            pdf_doc.close()
     except Exception as e:
         logging.error(f"Failed to process the document {document_name}: {e}")
         raise e
     
-    return txt_content
+    return list(pages.values())
+
+def process_document_routed(document_name, document_content, page_numbers=None):
+    # Born-digital pages are extracted locally; only scanned or complex pages go to Document Intelligence.
+    # Returns the text of every page, or of the given 1-based page numbers, in page order
+    if not FAST_PATH_ENABLED or not is_pdf(document_head(document_content)):
+        return process_document_pages_DI(document_name, document_content, page_numbers)
+
+    try:
+        pdf_doc = open_pdf(document_content)
+    except Exception as e:
+        logging.warning(f"PyMuPDF could not open document {document_name}, using Document Intelligence: {e}")
+        return process_document_pages_DI(document_name, document_content, page_numbers)
+
+    try:
+        local_pages = []
+        remote_pages = []
+        reasons = {}
+        wanted_pages = set(page_numbers) if page_numbers is not None else None
+        for page in pdf_doc:
+            if wanted_pages is not None and page.number + 1 not in wanted_pages:
+                continue
+            route, reason = classify_page(page)
+            (local_pages if route == LOCAL else remote_pages).append(page.number + 1)
+            reasons[reason] = reasons.get(reason, 0) + 1
+        current_span().set_attributes(pages_local=len(local_pages), pages_remote=len(remote_pages))
+        logging.info(
+            f"Document '{document_name}': {len(local_pages)} pages extracted locally, "
+            f"{len(remote_pages)} sent to Document Intelligence ({reasons})."
+        )
+
+        if not local_pages:
+            pdf_doc.close()
+            pdf_doc = None
+            return process_document_pages_DI(document_name, document_content, page_numbers)
+
+        timings = new_timings()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # The remote analysis overlaps with the local extraction
+            remote_result = executor.submit(
+                in_current_context(analyze_document_layout), document_name, document_content, remote_pages
+            ) if remote_pages else None
+            extracted_pages = extract_pdf_pages(document_name, pdf_doc, local_pages, timings)
+            logging.info(
+                f"Document '{document_name}' local extraction: images uploaded={timings['figures_uploaded']} "
+                f"skipped={timings['figures_skipped']}"
+            )
+            if remote_result is not None:
+                extracted_pages.update(remote_result.result())
+    finally:
+        if pdf_doc is not None:
+            pdf_doc.close()
+
+    return [extracted_pages.get(page_number, "") for page_number in sorted(set(local_pages) | set(remote_pages))]
+
+def process_document(document_name, document_content):
+    return "".join(process_document_pages(document_name, document_content))
 
 def generate_prompt(txt_content):
     # Define your prompt with the extracted text
-    payload = {
-            "messages": [
-                {
-                "role": "system",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": "You are an AI assistant tasked with extracting all the questions and content from the interveners who submitted questions on a regulatory document. The questions and content may be embedded within paragraphs, listed directly, or mentioned in various sections. Ensure that all questions and content are identified and listed clearly in a hierarchical order. Additionally, provide the extracted questions or content in JSON.\n"
-                    }
-                ]
-                },
-                {
-                "role": "user",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": "XXXX, a leading North American energy infrastructure company, has a rich history of innovation and growth. Formed in 1998 through the merger of Pacific Enterprises and Enova Corporation, XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\n\nXXXXX’s Journey of Innovation and Growth\n\nTo:\n\nJohn Ivy, on behalf of XXXXX, Jivy@sdge.com\n\nJohn Appeased, on behalf of SCG, JAPP.com\n\nDate Sent: September 19, 2035\n\nResponse Due: October 3, 2045\n\nPlease provide a response to the following: XXXXX, a leading North American energy infrastructure company, has a rich history of innovation and growth. Formed in 1998 through the merger of Pacific Enterprises and Enova Corporation, XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\n\nFrom its inception, XXXXX aimed to deliver energy differently. The company quickly became a significant player in the energy sector, serving millions of consumers across Southern California. Over the years, XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.\n\nPlease note that the questions in this data request relate to both SoCalGas and SDG&E.\n\nGENERAL INSTRUCTIONS\n\n1. One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n2. Two of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n3. Three of One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n4. Four of One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n5. Responses to these data requests should be transmitted as they become available.\n\nDEFINITIONS A. ASSETS: Oil and gas companies often have extensive assets, including oil fields, refineries, pipelines, and storage facilities. B. AMERICAN GIANTS: Major U.S.-based oil companies include ExxonMobil and Chevron, both of which are leaders in exploration, production, and refining. C. ACQUISITIONS: The industry frequently sees mergers and acquisitions, as companies aim to expand their reserves and market share. D. ADVANCEMENTS: Technological advancements, such as hydraulic fracturing and deep-water drilling, have significantly increased oil and gas production capabilities. E. ALTERNATIVE ENERGY: Many oil and gas companies are investing in alternative energy sources, including wind, solar, and hydrogen, to diversify their energy portfolios. F. ASIA: Companies like PetroChina and Sinopec are major players in the Asian market, contributing significantly to global oil and gas production. G. ANALYSIS: Detailed geological and seismic analysis is crucial for identifying potential oil and gas reserves. H. AFFILIATES: Large oil companies often have numerous affiliates and subsidiaries involved in various aspects of the energy sector.\n\nI. AGRE J. EMENTS: International agreements and partnerships are common, allowing companies to explore and produce oil and gas in different regions. K. AUTOMATION: The use of automation and digital technologies is increasing in the oil and gas industry to improve efficiency and safety. L. ALLOCATIONS: Capital allocation strategies are critical for oil and gas companies to balance investments in traditional and renewable energy projects. TEST SET OF DATA REQUESTS For Fuel\n\nGiven XXXXX's historical emphasis on both traditional and renewable energy sources, it is essential to scrutinize the financial and operational aspects related to fuel procurement and distribution. Understanding these metrics will help evaluate the cost-effectiveness and sustainability of XXXXX's fuel-related operations.\n\nFuel Procurement and Cost Analysis a) Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: \"XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.\") i. What percentage of the total fuel procurement budget was allocated to renewable energy sources each year? ii. How has the cost per unit of fuel evolved over the years for both traditional and renewable sources? iii. What suppliers and partners have been involved in the procurement process for both types of fuel?\nOperational Efficiency and Environmental Impact a) Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: \"XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\") i. How have these measures impacted the overall fuel consumption and associated costs? ii. Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements. iii. What technologies or innovations have been implemented to achieve these efficiencies?\nFor Gas\n\nXXXXX's operations in natural gas, particularly with its notable Energía Costa Azul LNG terminal, necessitate a comprehensive understanding of the financial, operational, and environmental aspects related to gas infrastructure and distribution.\n\nLNG Terminal Operations a) Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: \"One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.\") i. What are the annual throughput volumes of LNG at the terminal? ii. What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources? iii. How has the terminal's operational efficiency evolved over the years?"
-                    }
-                ]
-                },
-                {
-                "role": "assistant",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": " { \"extracted_data\": [\n{\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.i\",\n\"question\": \"What percentage of the total fuel procurement budget was allocated to renewable energy sources each year?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n},\n{\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.ii\",\n\"question\": \"How has the cost per unit of fuel evolved over the years for both traditional and renewable sources?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n}, {\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.ii\",\n\"question\": \"What suppliers and partners have been involved in the procurement process for both types of fuel?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n},\n{\n\"section\": \"Operational Efficiency and Environmental Impact\",\n\"number\": \"2.a.i\",\n\"Question\": \"How have these measures impacted the overall fuel consumption and associated costs?\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n},\n{\n\"section\": \"Operational Efficiency and Environmental Impact\",\n\"number\": \"2.a.ii\",\n\"Question\": \"Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements.\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n}, {\n\"section\": \"What technologies or innovations have been implemented to achieve these efficiencies?\",\n\"number\": \"2.a.iii\",\n\"Question\": \"Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements.\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.i\",\n\"Question\": \"What are the annual throughput volumes of LNG at the terminal?\",\n\"context\": \"Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: 'One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.ii\",\n\"Question\": \"What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources?\",\n\"context\": \"Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: 'One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.iii\",\n\"Question\": \"What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources?\",\n\"context\": \"How has the terminal's operational efficiency evolved over the years?\"\n} ] }"
-                    }
-                ]
-                },
-                {
-                "role": "user",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": txt_content
-                    }
-                ]
-                }
-            ],
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "max_tokens": 4026
-            }  
-    
-    return payload
-
-    # Send request to Azure OpenAI
+    return DEFAULT_TEMPLATE.build(txt_content)
 
 def generate_prompt_url(txt_content):
-    payload = {
-        "messages": [
-            {
-            "role": "system",
-            "content": [
-                {
-                "type": "text",
-                "text": "You are an AI assistant tasked with extracting all the questions and content from the interveners who submitted questions on a regulatory document. The questions and content may be embedded within paragraphs, listed directly, or mentioned in various sections. Additionally, content may have image references like \"[Image](URL)\", make sure to extract the image URL and include in the image node.  Ensure that all questions and content are identified and listed clearly in a hierarchical order and do not include any subsections. Provide the extracted questions or content in JSON.\n"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "10. 1 \nAncient Discoveries and early observations of XXXXX and its electric supply \nevolution:  \n \n10. 1.1 \nStatic Electricity: Thales of Miletus discovered static electricity by \nrubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians \nand Greeks noted the electric shocks from fish like the electric eel. \nAmber Effect: The Greeks observed that amber, when rubbed, could \nattract light objects like feathers. \n \n10. 1.1.1 \nFor each Cultural Significance and Religious Sites: Natural \nelectric phenomena were often considered divine and used in \nreligious rituals. Mythology: Stories and myths were created \naround the mysterious properties of electricity. Healing \nPractices: Electric fish were used in ancient medicine to treat \nailments like gout and headaches. \n10. 1.1.2 \nScientific Advancements and 17th and 18th Centuries William \nGilbert: Coined the term “electricus” and studied the properties of \nelectricity and magnetism. Benjamin Franklin: Conducted \nexperiments with lightning, proving it was a form of electricity. \nLeyden Jar: Invented as the first device capable of storing \nelectrical charge. \n \n\n[Image](https://bpadocumentstorage.blob.core.windows.net/images/images/image_759641774e654bd0b9c78464c93db78d.png)\nTHE XXXXX TEST DATA FOR \nDATA REQUEST QUESTIONS \nTHEIR NON-UNIFORM FORMAT OF \nQUESTIONS RECEIVED FROM THE  \nINTERVENORS \nA.2202033 \n \n10. 2 \n 19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic \ninduction, leading to the development of electric motors. James Clerk Maxwell: \nFormulated the theory of electromagnetism, unifying electricity and magnetism. \n \n10.2.1 Page 5 states: “Industrial Revolution & Electrification of Cities Street \nLighting: Cities like London and New York began using electric \nstreetlights. Public Transport: Electric trams and subways \nrevolutionized urban transportation. Factories: Electricity powered \nmachinery, increasing production efficiency. Household Adoption \nAppliances: Introduction of electric appliances like refrigerators and \nwashing machines. \n \n10.2.1.1 Heating and Cooling: Electric heaters and air \nconditioners became common in homes. Communication: \nTelephones and radios became household staples, powered \nby electricity. \n \n \n \n10.2.1.2 Modern Era Technological Innovations \nSemiconductors: Development of transistors and integrated \ncircuits revolutionized electronics. Renewable Energy: \nAdvances in solar and wind power technologies. Smart Grids: \nImplementation of smart grid technology for efficient energy \ndistribution. Environmental Impact Cleaner Energy: Shift \ntowards cleaner energy sources to reduce carbon emissions. \nEnergy Efficiency: Development of energy-efficient appliances \nand lighting. Policy and Regulation: Governments \nimplementing policies to promote sustainable energy use. \nProspects & Emerging Technologies Quantum For each year, \n2022-2024, please break down forecast \n \n10.2.1.3 Computing: Potential to revolutionize computing with \nunprecedented processing power. Energy Storage: Advances \nin battery technology for better energy storage solutions. \nWireless Power: Development of wireless power transmission \ntechnologies. figures presented on page 5 by each of the \ncategories described in the quote from page 5. \n \n\nTHE XXXXX TEST DATA FOR \nDATA REQUEST QUESTIONS \nTHEIR NON-UNIFORM FORMAT OF \nQUESTIONS RECEIVED FROM THE  \nINTERVENORS \nA.2202033 \n10. 3 \nThe 21st century has witnessed a series of energy crises, beginning with the early \n2000s when oil prices surged due to geopolitical tensions in the Middle East. The \ninvasion of Iraq in 2003 and subsequent instability in the region disrupted oil \nsupplies, leading to significant price hikes. This period highlighted the world's heavy \ndependence on fossil fuels and the vulnerabilities associated with it. As economies \ngrew, the demand for energy soared, further straining the supply chains. The crisis \nunderscored the urgent need for diversifying energy sources and improving energy \nsecurity. Please provide reasons for the variation in the below graph: "
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{  \n    \"extracted_data\": [  \n        {  \n            \"section\": \"Ancient Discoveries and early observations of XXXXX and its electric supply evolution\",  \n            \"number\": \"10.1.1.1\",  \n            \"question\": \"For each Cultural Significance and Religious Sites: Natural electric phenomena were often considered divine and used in religious rituals. Mythology: Stories and myths were created around the mysterious properties of electricity. Healing Practices: Electric fish were used in ancient medicine to treat ailments like gout and headaches.\",  \n            \"context\": \"Static Electricity: Thales of Miletus discovered static electricity by rubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians and Greeks noted the electric shocks from fish like the electric eel. Amber Effect: The Greeks observed that amber, when rubbed, could attract light objects like feathers.\"  \n        },  \n        {  \n            \"section\": \"Ancient Discoveries and early observations of XXXXX and its electric supply evolution\",  \n            \"number\": \"10.1.1.2\",  \n            \"question\": \"Scientific Advancements and 17th and 18th Centuries William Gilbert: Coined the term “electricus” and studied the properties of electricity and magnetism. Benjamin Franklin: Conducted experiments with lightning, proving it was a form of electricity. Leyden Jar: Invented as the first device capable of storing electrical charge.\",  \n            \"image\": \"https://bpadocumentstorage.blob.core.windows.net/images/images/image_13de73d5935f485db77a3122a185c1f1.png\",\n            \"context\": \"Static Electricity: Thales of Miletus discovered static electricity by rubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians and Greeks noted the electric shocks from fish like the electric eel. Amber Effect: The Greeks observed that amber, when rubbed, could attract light objects like feathers.\"  \n        },    \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.1\",  \n            \"Question\": \"Heating and Cooling: Electric heaters and airconditioners became common in homes. Communication:Telephones and radios became household staples, poweredby electricity.\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.2\",  \n            \"question\": \"Modern Era Technological Innovations Semiconductors: Development of transistors and integrated circuits revolutionized electronics. Renewable Energy: Advances in solar and wind power technologies. Smart Grids: Implementation of smart grid technology for efficient energy distribution. Environmental Impact Cleaner Energy: Shift towards cleaner energy sources to reduce carbon emissions. Energy Efficiency: Development of energy-efficient appliances and lighting. Policy and Regulation: Governments implementing policies to promote sustainable energy use. Prospects & Emerging Technologies Quantum For each year, 2022-2024, please break down forecast\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.3\",  \n            \"question\": \"Computing: Potential to revolutionize computing with unprecedented processing power. Energy Storage: Advances in battery technology for better energy storage solutions.Wireless Power: Development of wireless power transmission technologies. figures presented on page 5 by each of the categories described in the quote from page 5\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section_name\": \"10.2.1.3 Prospects & Emerging Technologies\",  \n            \"number\": \"7\",  \n            \"text\": \"- Quantum Computing: Potential to revolutionize computing with unprecedented processing power.\\n- Energy Storage: Advances in battery technology for better energy storage solutions.\\n- Wireless Power: Development of wireless power transmission technologies.\",  \n            \"context\": \"Emerging technologies in the energy sector.\"  \n        },  \n        {  \n            \"section_name\": \"\",  \n            \"number\": \"10.3\",  \n            \"text\": \"The 21st century has witnessed a series of energy crises, beginning with the early 2000s when oil prices surged due to geopolitical tensions in the Middle East. The invasion of Iraq in 2003 and subsequent instability in the region disrupted oil supplies, leading to significant price hikes. This period highlighted the world's heavy dependence on fossil fuels and the vulnerabilities associated with it. As economies grew, the demand for energy soared, further straining the supply chains. The crisis underscored the urgent need for diversifying energy sources and improving energy security. Please provide reasons for the variation in the below graph:\",\n            \"image\": \"https://bpadocumentstorage.blob.core.windows.net/images/images/image_e13f2b39bb374146a36bd4ebcfe36ab0.png\",\n            \"context\": \"\"  \n        }  \n    ]  \n}"
-                }
-            ]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": txt_content
-                    }
-                ]
-            }
-        ],
-        "temperature": 0.7,
-        "top_p": 0.95,
-        "max_tokens": 4026
-        }
-    
-    return payload
-      
-def call_openai_api(payload):
-    ENDPOINT = os.environ["AZURE_OPENAI_API_ENDPOINT"]
-    API_KEY = os.environ["OPENAI_API_KEY"]
-
-    client = openai.AzureOpenAI(
-        api_key=API_KEY,
-        api_version="2024-02-15-preview",
-        azure_endpoint = ENDPOINT
+    with span("generate_prompt", template=URL_TEMPLATE.version) as prompt_span:
+        if prompt_span.recording:
+            prompt_span.set_attributes(text_bytes=len(txt_content.encode("utf-8")))
+        return URL_TEMPLATE.build(txt_content)
+
+def new_token_usage():
+    return {"prompt_tokens": 0, "completion_tokens": 0, "requests": 0}
+
+def response_headers(cache_status, token_usage):
+    headers = result_cache.headers(cache_status) if result_cache is not None else {}
+    headers["X-Prompt-Tokens"] = str(token_usage["prompt_tokens"])
+    headers["X-Completion-Tokens"] = str(token_usage["completion_tokens"])
+    headers["X-OpenAI-Requests"] = str(token_usage["requests"])
+    return headers
+
+def prompt_token_budget(payload):
+    # Estimated prompt tokens, reserved against the tokens-per-minute budget before the call
+    return sum(
+        estimate_tokens(part["text"])
+        for message in payload["messages"] for part in message["content"] if part.get("type") == "text"
     )
-    # Create and return a new chat completion request
-    return client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=payload['messages'],
-        stream=False
+
+def call_openai_api(payload, stream=False):
+    with span("openai_chat_completion", openai_model="gpt-4o-mini", openai_stream=stream) as openai_span:
+        # Create and return a new chat completion request on the first deployment with capacity
+        response = get_openai_scheduler().call(
+            lambda deployment: get_openai_client(deployment).chat.completions.create(
+                model=deployment.model,
+                messages=payload['messages'],
+                stream=stream
+            ),
+            tokens=prompt_token_budget(payload)
+        )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            openai_span.set_attributes(
+                openai_prompt_tokens=usage.prompt_tokens, openai_completion_tokens=usage.completion_tokens
+            )
+        return response
+
+def iter_completion_text(stream_response):
+    # Yields the content deltas of a streamed chat completion
+    for chunk in stream_response:
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def parse_openai_response(json_response):
+    # Returns a ModelOutput; its data is None when the model produced no content
+    return parse_model_output(json_response.choices[0].message.content or "")
+
+def stream_chunk_items(chunk_text, item_queue, token_usage):
+    # Runs on a worker thread: streams the completion for one chunk and puts
+    # ("item", item) on item_queue as each item completes, then ("done", counts) with the
+    # malformed items and whether the answer was truncated or empty
+    try:
+        parser = ExtractedDataParser()
+        deltas = []
+        with span("openai_stream") as stream_span:
+            for delta in iter_completion_text(call_openai_api(generate_prompt_url(chunk_text), stream=True)):
+                deltas.append(delta)
+                for item in parser.feed(delta):
+                    item_queue.put(("item", item))
+            parser.close()
+            stream_span.set_attributes(openai_completion_tokens=len(deltas), malformed_items=parser.malformed)
+
+        malformed, truncated, empty = parser.malformed, parser.truncated, False
+        if not parser.found_array:
+            # The answer did not have the expected shape; fall back to parsing it whole
+            output = parse_model_output("".join(deltas))
+            response_data = output.data
+            # Without content the chunk's pages are missing from the result
+            malformed, truncated = output.malformed, output.truncated
+            empty = response_data is None and not malformed
+            items = response_data.get("extracted_data", []) if isinstance(response_data, dict) else response_data or []
+            for item in items:
+                item_queue.put(("item", item))
+
+        with token_usage_lock:
+            token_usage["prompt_tokens"] += URL_TEMPLATE.count_prompt_tokens(chunk_text)
+            # Each streamed delta carries about one token
+            token_usage["completion_tokens"] += len(deltas)
+            token_usage["requests"] += 1
+        item_queue.put(("done", {"malformed": malformed, "truncated": truncated, "empty": empty}))
+    except Exception as e:
+        item_queue.put(("error", e))
+
+def iter_document_events(document_name):
+    # Streaming counterpart of process_document_request: yields an event per extracted
+    # item as soon as it is parsed, in document order, then a final "done" or "error" event
+    pages = []
+    document_hash = None
+    document_content = None
+    executor = None
+    try:
+        document_content = download_document(document_name)
+        document_hash = document_content_hash(document_content)
+
+        if result_cache is not None:
+            cached_response = result_cache.get(document_response_key(document_hash))
+            if cached_response is not None:
+                cached_items = cached_response.get("extracted_data", [])
+                for item in cached_items:
+                    yield {"type": "item", "item": item}
+                yield {"type": "done", "cached": True, "items": len(cached_items)}
+                return
+
+        pages = process_document_cached(document_name, document_content, document_hash)
+        prompt_pages = iter_compact_pages(pages) if PROMPT_COMPACTION_ENABLED else pages
+        chunks = list(iter_chunks(prompt_pages, OPENAI_CHUNK_MAX_TOKENS)) or [""]
+
+        # Every chunk streams concurrently into its own queue; queues are drained in document order
+        token_usage = new_token_usage()
+        executor = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY)
+        chunk_queues = []
+        for chunk_text in chunks:
+            chunk_queue = queue.Queue()
+            executor.submit(in_current_context(stream_chunk_items), chunk_text, chunk_queue, token_usage)
+            chunk_queues.append(chunk_queue)
+
+        extracted_data = []
+        seen = set()
+        malformed_items = 0
+        truncated_chunks = 0
+        empty_chunks = 0
+        for chunk_queue in chunk_queues:
+            while True:
+                kind, value = chunk_queue.get()
+                if kind == "error":
+                    raise value
+                if kind == "done":
+                    malformed_items += value["malformed"]
+                    truncated_chunks += value["truncated"]
+                    empty_chunks += value["empty"]
+                    break
+                key = dedupe_key(value)
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                extracted_data.append(value)
+                yield {"type": "item", "item": value}
+
+        response_data = {"extracted_data": extracted_data}
+        complete = not malformed_items and not truncated_chunks and not empty_chunks
+        store_response_in_cosmos(
+            status="success" if complete else "incomplete",
+            http_status_code=200,
+            document_name=document_name,
+            text_content=pages,
+            response_json=response_data,
+            document_hash=document_hash
+        )
+        if result_cache is not None and complete:
+            result_cache.set(document_response_key(document_hash), response_data)
+        yield {
+            "type": "done",
+            "cached": False,
+            "items": len(extracted_data),
+            "malformed_items": malformed_items,
+            "truncated_chunks": truncated_chunks,
+            "empty_chunks": empty_chunks,
+            "prompt_tokens": token_usage["prompt_tokens"],
+            "completion_tokens": token_usage["completion_tokens"]
+        }
+
+    except ServiceBusyError as e:
+        logging.warning(f"Processing of document {document_name} deferred: {e}")
+        yield {"type": "error", "error": "The service is busy, please retry later.", "retry_after": e.retry_after}
+    except Exception as e:
+        logging.error(f"An internal server error occurred: {e}")
+        store_response_in_cosmos(
+            status="failed",
+            http_status_code=500,
+            document_name=document_name,
+            text_content=pages,
+            response_json={"error": str(e)},
+            document_hash=document_hash
+        )
+        yield {"type": "error", "error": "An internal server error occurred."}
+    finally:
+        if executor is not None:
+            # Stop chunks that have not started when the client goes away or a chunk fails
+            executor.shutdown(wait=False, cancel_futures=True)
+        close_document(document_content)
+
+def format_event(event, event_format):
+    if event_format == "sse":
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+def extract_chunk_data(chunk_text, token_usage=None):
+    payload = generate_prompt_url(chunk_text)
+    json_response = call_openai_api(payload)
+    if token_usage is not None:
+        usage = getattr(json_response, "usage", None)
+        # Prefer the service's own count, fall back to counting locally
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or URL_TEMPLATE.count_prompt_tokens(chunk_text)
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        with token_usage_lock:
+            token_usage["prompt_tokens"] += prompt_tokens
+            token_usage["completion_tokens"] += completion_tokens
+            token_usage["requests"] += 1
+    return parse_openai_response(json_response)
+
+def map_in_order(executor, fn, iterable, max_pending):
+    # Like executor.map, but pulls from the iterable only as results are consumed,
+    # so at most max_pending inputs are held at a time
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+def extract_document_data(pages, token_usage=None, revision=None):
+    # Returns (response_data, incomplete_chunks): the merged result, None when no chunk had
+    # content, and the number of chunks that returned no content or lost items to malformed
+    # or truncated output
+    if revision is not None:
+        return extract_revised_document_data(pages, token_usage, revision)
+    # Chunks are produced lazily from the page iterator as request slots free up
+    chunks = iter_chunks(pages, OPENAI_CHUNK_MAX_TOKENS)
+    first_chunk = next(chunks, "")
+    second_chunk = next(chunks, None)
+    if second_chunk is None:
+        output = extract_chunk_data(first_chunk, token_usage)
+        # Merged like several chunks would be, so the items do not depend on the chunk size
+        response_data = merge_extracted_data([output.data]) if output.data is not None else None
+        return response_data, int(not output.complete)
+
+    with ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY) as executor:
+        # Results come back in submission order, i.e. document order
+        chunk_results = list(map_in_order(
+            executor, in_current_context(lambda chunk_text: extract_chunk_data(chunk_text, token_usage)),
+            chain([first_chunk, second_chunk], chunks), OPENAI_MAX_CONCURRENCY
+        ))
+    logging.info(f"Extracted {len(chunk_results)} chunks with concurrency {OPENAI_MAX_CONCURRENCY}.")
+
+    incomplete_chunks = sum(1 for output in chunk_results if not output.complete)
+    if all(output.data is None for output in chunk_results):
+        return None, incomplete_chunks
+    return merge_extracted_data(output.data for output in chunk_results), incomplete_chunks
+
+def extract_revised_document_data(pages, token_usage, revision):
+    # Pages are extracted in groups so their items can be reused by the next revision. Groups
+    # unchanged since the previous revision keep their items; only the others go to OpenAI
+    groups = revision.plan_groups(pages, OPENAI_CHUNK_MAX_TOKENS)
+    requests_to_send = [
+        (group, chunk_text)
+        for group in groups if group.items is None
+        for chunk_text in iter_chunks(pages[group.start:group.end], OPENAI_CHUNK_MAX_TOKENS)
+    ]
+    with ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY) as executor:
+        chunk_results = list(map_in_order(
+            executor, in_current_context(lambda request: extract_chunk_data(request[1], token_usage)),
+            requests_to_send, OPENAI_MAX_CONCURRENCY
+        ))
+
+    group_results = {}
+    for (group, _), result in zip(requests_to_send, chunk_results):
+        group_results.setdefault(group.start, []).append(result)
+    for group in groups:
+        results = group_results.get(group.start)
+        if results is not None:
+            group.items = merge_extracted_data(output.data for output in results)["extracted_data"]
+            # A chunk without content, or with items lost, leaves the group to be extracted again next time
+            group.complete = all(output.complete for output in results)
+    reused_pages = sum(group.end - group.start for group in groups if group.reused)
+    logging.info(
+        f"Extracted {len(requests_to_send)} chunks; {reused_pages} of {len(pages)} pages "
+        f"reused extracted_data from the previous revision."
     )
+    current_span().set_attributes(pages_reused=reused_pages)
+
+    incomplete_chunks = sum(1 for output in chunk_results if not output.complete)
+    if chunk_results and all(output.data is None for output in chunk_results) and not reused_pages:
+        return None, incomplete_chunks
+    return merge_extracted_data({"extracted_data": group.items or []} for group in groups), incomplete_chunks
 
 def call_openai_url(payload):
-    ENDPOINT = os.environ["AZURE_OPENAI_API_ENDPOINT"]
-    API_KEY = os.environ["OPENAI_API_KEY"]
+    # Raw REST alternative to call_openai_api; requests is only loaded when it is used
+    import requests
+    settings = get_openai_settings()
 
     headers = {
         "Content-Type": "application/json",
-        "api-key": API_KEY,
+        "api-key": settings["api_key"],
     }
 
     try:
-        response = requests.post(ENDPOINT, headers=headers, json=payload)
+        response = get_http_session().post(
+            settings["endpoint"], headers=headers, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        )
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
         logging.error(f"Failed to make the Azure OpenAI request. Error: {e}")
         raise e
     
-def store_response_in_cosmos(status, http_status_code, document_name, text_content, response_json):
-    try:
+def store_response_in_cosmos(status, http_status_code, document_name, text_content, response_json, document_hash=None):
+    # Items are buffered and written in batches by the results writer, which also
+    # handles Cosmos DB errors; see results_writer.py
+    results_writer = get_results_writer()
+    if results_writer is None:
+        return
+    if not isinstance(text_content, str):
+        # Callers pass the page texts; they are only joined when there is somewhere to write them
+        text_content = "".join(text_content)
+    with span("store_response", document_name=document_name, status=status) as store_span:
+        if store_span.recording:
+            store_span.set_attributes(text_bytes=len((text_content or "").encode("utf-8")))
         item = {
-            "id": f"{document_name}-{uuid.uuid4()}",
+            "id": result_item_id(document_name, document_hash or "", status, http_status_code),
             "status": status,
             "http_status_code": http_status_code,
             "document_name": document_name,
             "text_content": text_content,
             "response_json": response_json,
+            "document_hash": document_hash,
             "timestamp": datetime.utcnow().isoformat()
         }
-        #container.upsert_item(item)
-        logging.info("Response stored in Cosmos DB successfully.")
-    except exceptions.CosmosHttpResponseError as e:
-        logging.error(f"Failed to store response in Cosmos DB: {e}")
+        results_writer.add(item)
+    logging.info("Response queued for storage in Cosmos DB.")
@@ -0,0 +1,84 @@
+import os
+
+from result_cache import settings_version
+
+
+# Routing between the local PyMuPDF extractor and Document Intelligence
+FAST_PATH_ENABLED = os.environ.get("FAST_PATH_ENABLED", "true").lower() == "true"
+FAST_PATH_MIN_TEXT_CHARS = int(os.environ.get("FAST_PATH_MIN_TEXT_CHARS", "200"))
+FAST_PATH_MAX_IMAGES_PER_PAGE = int(os.environ.get("FAST_PATH_MAX_IMAGES_PER_PAGE", "3"))
+FAST_PATH_MAX_IMAGE_COVERAGE = float(os.environ.get("FAST_PATH_MAX_IMAGE_COVERAGE", "0.5"))
+FAST_PATH_MAX_UNREADABLE_RATIO = float(os.environ.get("FAST_PATH_MAX_UNREADABLE_RATIO", "0.05"))
+
+# Part of the cache keys: changes with any setting that decides which extractor reads a page.
+# Bump the name when the text produced by either extractor changes
+EXTRACTION_VERSION = settings_version(
+    "extraction-v1", FAST_PATH_ENABLED, FAST_PATH_MIN_TEXT_CHARS, FAST_PATH_MAX_IMAGES_PER_PAGE,
+    FAST_PATH_MAX_IMAGE_COVERAGE, FAST_PATH_MAX_UNREADABLE_RATIO
+)
+
+LOCAL = "local"
+DOCUMENT_INTELLIGENCE = "document_intelligence"
+
+
+def is_pdf(document_content):
+    return document_content[:1024].lstrip().startswith(b"%PDF")
+
+
+def _image_coverage(page, image_infos):
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in image_infos:
+        # Clip to the page so bleed-off images don't count twice
+        covered += abs(page.rect & info["bbox"])
+    return min(covered / page_area, 1.0)
+
+
+def classify_page(page):
+    """Decide whether a PDF page can be extracted locally.
+
+    Returns ``(route, reason)``. Pages go to Document Intelligence when
+    their text layer is missing or unreadable (scans), when images cover
+    most of the page with little text around them, or when they carry more
+    images than the local extractor can place reliably.
+    """
+    text = page.get_text()
+    text_chars = len(text.strip())
+    image_infos = page.get_image_info()
+
+    if text_chars < FAST_PATH_MIN_TEXT_CHARS:
+        if image_infos:
+            return DOCUMENT_INTELLIGENCE, "scanned"
+        # Cover, separator or blank page: nothing more for OCR to find
+        return LOCAL, "sparse text"
+
+    # Characters the font could not map to Unicode come out as U+FFFD
+    if text.count("\ufffd") / text_chars > FAST_PATH_MAX_UNREADABLE_RATIO:
+        return DOCUMENT_INTELLIGENCE, "unreadable text layer"
+
+    if len(image_infos) > FAST_PATH_MAX_IMAGES_PER_PAGE:
+        return DOCUMENT_INTELLIGENCE, "image heavy"
+
+    if _image_coverage(page, image_infos) > FAST_PATH_MAX_IMAGE_COVERAGE and text_chars < 4 * FAST_PATH_MIN_TEXT_CHARS:
+        return DOCUMENT_INTELLIGENCE, "figure dominated"
+
+    return LOCAL, "text layer"
+
+
+def page_ranges(page_numbers):
+    """Format 1-based page numbers the way Document Intelligence expects, e.g. ``1-3,7``."""
+    ranges = []
+    start = previous = None
+    for page_number in sorted(page_numbers):
+        if start is None:
+            start = previous = page_number
+        elif page_number == previous + 1:
+            previous = page_number
+        else:
+            ranges.append(f"{start}-{previous}" if previous != start else str(start))
+            start = previous = page_number
+    if start is not None:
+        ranges.append(f"{start}-{previous}" if previous != start else str(start))
+    return ",".join(ranges)
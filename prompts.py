@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import re
+import threading
+
+from chunking import SECTION_HEADING_PATTERN, estimate_tokens
+from result_cache import settings_version
+
+
+# Bump whenever a template or the compaction rules change so cached OpenAI results are not reused
+PROMPT_TEMPLATE_VERSION = "v2"
+
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Layout noise removed from the document text before it is embedded in the prompt
+PROMPT_COMPACTION_ENABLED = os.environ.get("PROMPT_COMPACTION_ENABLED", "true").lower() == "true"
+PAGE_MARGIN_LINES = int(os.environ.get("PAGE_MARGIN_LINES", "5"))
+HEADER_FOOTER_MIN_PAGES = int(os.environ.get("HEADER_FOOTER_MIN_PAGES", "3"))
+HEADER_FOOTER_MIN_SHARE = float(os.environ.get("HEADER_FOOTER_MIN_SHARE", "0.5"))
+# Part of the OpenAI cache keys, so results are not reused once the compaction settings change
+COMPACTION_VERSION = settings_version(
+    "compaction", PROMPT_COMPACTION_ENABLED, PAGE_MARGIN_LINES, HEADER_FOOTER_MIN_PAGES, HEADER_FOOTER_MIN_SHARE
+)
+
+SELECTION_MARK_PATTERN = re.compile(r":(un)?selected:")
+HORIZONTAL_SPACE_PATTERN = re.compile(r"[ \t\u00a0]+")
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+PAGE_NUMBER_PATTERN = re.compile(r"^(page\s+)?\d+(\s*(of|/)\s*\d+)?$", re.IGNORECASE)
+DIGITS_PATTERN = re.compile(r"\d+")
+PAGE_WORD_PATTERN = re.compile(r"\bpage\b")
+
+
+# Few-shot prompt text
+SYSTEM_TEXT = "You are an AI assistant tasked with extracting all the questions and content from the interveners who submitted questions on a regulatory document. The questions and content may be embedded within paragraphs, listed directly, or mentioned in various sections. Ensure that all questions and content are identified and listed clearly in a hierarchical order. Additionally, provide the extracted questions or content in JSON.\n"
+
+FEW_SHOT_USER_TEXT = "XXXX, a leading North American energy infrastructure company, has a rich history of innovation and growth. Formed in 1998 through the merger of Pacific Enterprises and Enova Corporation, XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\n\nXXXXX’s Journey of Innovation and Growth\n\nTo:\n\nJohn Ivy, on behalf of XXXXX, Jivy@sdge.com\n\nJohn Appeased, on behalf of SCG, JAPP.com\n\nDate Sent: September 19, 2035\n\nResponse Due: October 3, 2045\n\nPlease provide a response to the following: XXXXX, a leading North American energy infrastructure company, has a rich history of innovation and growth. Formed in 1998 through the merger of Pacific Enterprises and Enova Corporation, XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\n\nFrom its inception, XXXXX aimed to deliver energy differently. The company quickly became a significant player in the energy sector, serving millions of consumers across Southern California. Over the years, XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.\n\nPlease note that the questions in this data request relate to both SoCalGas and SDG&E.\n\nGENERAL INSTRUCTIONS\n\n1. One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n2. Two of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n3. Three of One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n4. Four of One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008, one of the first liquefied natural gas (LNG) receipt terminals on the West Coast of North America. This project marked a significant milestone in XXXXX’s commitment to providing reliable and clean energy solutions.\n\n5. Responses to these data requests should be transmitted as they become available.\n\nDEFINITIONS A. ASSETS: Oil and gas companies often have extensive assets, including oil fields, refineries, pipelines, and storage facilities. B. AMERICAN GIANTS: Major U.S.-based oil companies include ExxonMobil and Chevron, both of which are leaders in exploration, production, and refining. C. ACQUISITIONS: The industry frequently sees mergers and acquisitions, as companies aim to expand their reserves and market share. D. ADVANCEMENTS: Technological advancements, such as hydraulic fracturing and deep-water drilling, have significantly increased oil and gas production capabilities. E. ALTERNATIVE ENERGY: Many oil and gas companies are investing in alternative energy sources, including wind, solar, and hydrogen, to diversify their energy portfolios. F. ASIA: Companies like PetroChina and Sinopec are major players in the Asian market, contributing significantly to global oil and gas production. G. ANALYSIS: Detailed geological and seismic analysis is crucial for identifying potential oil and gas reserves. H. AFFILIATES: Large oil companies often have numerous affiliates and subsidiaries involved in various aspects of the energy sector.\n\nI. AGRE J. EMENTS: International agreements and partnerships are common, allowing companies to explore and produce oil and gas in different regions. K. AUTOMATION: The use of automation and digital technologies is increasing in the oil and gas industry to improve efficiency and safety. L. ALLOCATIONS: Capital allocation strategies are critical for oil and gas companies to balance investments in traditional and renewable energy projects. TEST SET OF DATA REQUESTS For Fuel\n\nGiven XXXXX's historical emphasis on both traditional and renewable energy sources, it is essential to scrutinize the financial and operational aspects related to fuel procurement and distribution. Understanding these metrics will help evaluate the cost-effectiveness and sustainability of XXXXX's fuel-related operations.\n\nFuel Procurement and Cost Analysis a) Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: \"XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.\") i. What percentage of the total fuel procurement budget was allocated to renewable energy sources each year? ii. How has the cost per unit of fuel evolved over the years for both traditional and renewable sources? iii. What suppliers and partners have been involved in the procurement process for both types of fuel?\nOperational Efficiency and Environmental Impact a) Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: \"XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.\") i. How have these measures impacted the overall fuel consumption and associated costs? ii. Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements. iii. What technologies or innovations have been implemented to achieve these efficiencies?\nFor Gas\n\nXXXXX's operations in natural gas, particularly with its notable Energía Costa Azul LNG terminal, necessitate a comprehensive understanding of the financial, operational, and environmental aspects related to gas infrastructure and distribution.\n\nLNG Terminal Operations a) Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: \"One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.\") i. What are the annual throughput volumes of LNG at the terminal? ii. What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources? iii. How has the terminal's operational efficiency evolved over the years?"
+
+FEW_SHOT_ASSISTANT_TEXT = " { \"extracted_data\": [\n{\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.i\",\n\"question\": \"What percentage of the total fuel procurement budget was allocated to renewable energy sources each year?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n},\n{\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.ii\",\n\"question\": \"How has the cost per unit of fuel evolved over the years for both traditional and renewable sources?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n}, {\n\"section\": \"Fuel Procurement and Cost Analysis\",\n\"number\": \"1.a.ii\",\n\"question\": \"What suppliers and partners have been involved in the procurement process for both types of fuel?\",\n\"context\": \"Please provide a detailed breakdown of the cost structure associated with fuel procurement over the past decade, specifically distinguishing between traditional fossil fuels and renewable energy sources. (Reference: 'XXXXX expanded its reach and capabilities, acquiring key assets and investing in renewable energy projects.')\"\n},\n{\n\"section\": \"Operational Efficiency and Environmental Impact\",\n\"number\": \"2.a.i\",\n\"Question\": \"How have these measures impacted the overall fuel consumption and associated costs?\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n},\n{\n\"section\": \"Operational Efficiency and Environmental Impact\",\n\"number\": \"2.a.ii\",\n\"Question\": \"Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements.\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n}, {\n\"section\": \"What technologies or innovations have been implemented to achieve these efficiencies?\",\n\"number\": \"2.a.iii\",\n\"Question\": \"Provide data on the reduction in greenhouse gas emissions resulting from these efficiency improvements.\",\n\"context\": \"Describe the measures taken by XXXXX to improve operational efficiency in fuel usage. (Reference: 'XXXXX has consistently pursued a path of technological advancement and community-focused initiatives.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.i\",\n\"Question\": \"What are the annual throughput volumes of LNG at the terminal?\",\n\"context\": \"Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: 'One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.ii\",\n\"Question\": \"What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources?\",\n\"context\": \"Provide a detailed operational report on the Energía Costa Azul LNG terminal since its inception in 2008. (Reference: 'One of XXXXX’s notable achievements was the launch of the Energía Costa Azul LNG terminal in Baja California in 2008.')\"\n}, {\n\"section\": \"LNG Terminal Operations\",\n\"number\": \"1.a.iii\",\n\"Question\": \"What are the main sources of LNG supplied to the terminal, and what percentage comes from renewable sources?\",\n\"context\": \"How has the terminal's operational efficiency evolved over the years?\"\n} ] }"
+
+URL_SYSTEM_TEXT = "You are an AI assistant tasked with extracting all the questions and content from the interveners who submitted questions on a regulatory document. The questions and content may be embedded within paragraphs, listed directly, or mentioned in various sections. Additionally, content may have image references like \"[Image](URL)\", make sure to extract the image URL and include in the image node.  Ensure that all questions and content are identified and listed clearly in a hierarchical order and do not include any subsections. Provide the extracted questions or content in JSON.\n"
+
+URL_FEW_SHOT_USER_TEXT = "10. 1 \nAncient Discoveries and early observations of XXXXX and its electric supply \nevolution:  \n \n10. 1.1 \nStatic Electricity: Thales of Miletus discovered static electricity by \nrubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians \nand Greeks noted the electric shocks from fish like the electric eel. \nAmber Effect: The Greeks observed that amber, when rubbed, could \nattract light objects like feathers. \n \n10. 1.1.1 \nFor each Cultural Significance and Religious Sites: Natural \nelectric phenomena were often considered divine and used in \nreligious rituals. Mythology: Stories and myths were created \naround the mysterious properties of electricity. Healing \nPractices: Electric fish were used in ancient medicine to treat \nailments like gout and headaches. \n10. 1.1.2 \nScientific Advancements and 17th and 18th Centuries William \nGilbert: Coined the term “electricus” and studied the properties of \nelectricity and magnetism. Benjamin Franklin: Conducted \nexperiments with lightning, proving it was a form of electricity. \nLeyden Jar: Invented as the first device capable of storing \nelectrical charge. \n \n\n[Image](https://bpadocumentstorage.blob.core.windows.net/images/images/image_759641774e654bd0b9c78464c93db78d.png)\nTHE XXXXX TEST DATA FOR \nDATA REQUEST QUESTIONS \nTHEIR NON-UNIFORM FORMAT OF \nQUESTIONS RECEIVED FROM THE  \nINTERVENORS \nA.2202033 \n \n10. 2 \n 19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic \ninduction, leading to the development of electric motors. James Clerk Maxwell: \nFormulated the theory of electromagnetism, unifying electricity and magnetism. \n \n10.2.1 Page 5 states: “Industrial Revolution & Electrification of Cities Street \nLighting: Cities like London and New York began using electric \nstreetlights. Public Transport: Electric trams and subways \nrevolutionized urban transportation. Factories: Electricity powered \nmachinery, increasing production efficiency. Household Adoption \nAppliances: Introduction of electric appliances like refrigerators and \nwashing machines. \n \n10.2.1.1 Heating and Cooling: Electric heaters and air \nconditioners became common in homes. Communication: \nTelephones and radios became household staples, powered \nby electricity. \n \n \n \n10.2.1.2 Modern Era Technological Innovations \nSemiconductors: Development of transistors and integrated \ncircuits revolutionized electronics. Renewable Energy: \nAdvances in solar and wind power technologies. Smart Grids: \nImplementation of smart grid technology for efficient energy \ndistribution. Environmental Impact Cleaner Energy: Shift \ntowards cleaner energy sources to reduce carbon emissions. \nEnergy Efficiency: Development of energy-efficient appliances \nand lighting. Policy and Regulation: Governments \nimplementing policies to promote sustainable energy use. \nProspects & Emerging Technologies Quantum For each year, \n2022-2024, please break down forecast \n \n10.2.1.3 Computing: Potential to revolutionize computing with \nunprecedented processing power. Energy Storage: Advances \nin battery technology for better energy storage solutions. \nWireless Power: Development of wireless power transmission \ntechnologies. figures presented on page 5 by each of the \ncategories described in the quote from page 5. \n \n\nTHE XXXXX TEST DATA FOR \nDATA REQUEST QUESTIONS \nTHEIR NON-UNIFORM FORMAT OF \nQUESTIONS RECEIVED FROM THE  \nINTERVENORS \nA.2202033 \n10. 3 \nThe 21st century has witnessed a series of energy crises, beginning with the early \n2000s when oil prices surged due to geopolitical tensions in the Middle East. The \ninvasion of Iraq in 2003 and subsequent instability in the region disrupted oil \nsupplies, leading to significant price hikes. This period highlighted the world's heavy \ndependence on fossil fuels and the vulnerabilities associated with it. As economies \ngrew, the demand for energy soared, further straining the supply chains. The crisis \nunderscored the urgent need for diversifying energy sources and improving energy \nsecurity. Please provide reasons for the variation in the below graph: "
+
+URL_FEW_SHOT_ASSISTANT_TEXT = "{  \n    \"extracted_data\": [  \n        {  \n            \"section\": \"Ancient Discoveries and early observations of XXXXX and its electric supply evolution\",  \n            \"number\": \"10.1.1.1\",  \n            \"question\": \"For each Cultural Significance and Religious Sites: Natural electric phenomena were often considered divine and used in religious rituals. Mythology: Stories and myths were created around the mysterious properties of electricity. Healing Practices: Electric fish were used in ancient medicine to treat ailments like gout and headaches.\",  \n            \"context\": \"Static Electricity: Thales of Miletus discovered static electricity by rubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians and Greeks noted the electric shocks from fish like the electric eel. Amber Effect: The Greeks observed that amber, when rubbed, could attract light objects like feathers.\"  \n        },  \n        {  \n            \"section\": \"Ancient Discoveries and early observations of XXXXX and its electric supply evolution\",  \n            \"number\": \"10.1.1.2\",  \n            \"question\": \"Scientific Advancements and 17th and 18th Centuries William Gilbert: Coined the term “electricus” and studied the properties of electricity and magnetism. Benjamin Franklin: Conducted experiments with lightning, proving it was a form of electricity. Leyden Jar: Invented as the first device capable of storing electrical charge.\",  \n            \"image\": \"https://bpadocumentstorage.blob.core.windows.net/images/images/image_13de73d5935f485db77a3122a185c1f1.png\",\n            \"context\": \"Static Electricity: Thales of Miletus discovered static electricity by rubbing amber with fur around 600 BCE. Electric Fish: Ancient Egyptians and Greeks noted the electric shocks from fish like the electric eel. Amber Effect: The Greeks observed that amber, when rubbed, could attract light objects like feathers.\"  \n        },    \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.1\",  \n            \"Question\": \"Heating and Cooling: Electric heaters and airconditioners became common in homes. Communication:Telephones and radios became household staples, poweredby electricity.\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.2\",  \n            \"question\": \"Modern Era Technological Innovations Semiconductors: Development of transistors and integrated circuits revolutionized electronics. Renewable Energy: Advances in solar and wind power technologies. Smart Grids: Implementation of smart grid technology for efficient energy distribution. Environmental Impact Cleaner Energy: Shift towards cleaner energy sources to reduce carbon emissions. Energy Efficiency: Development of energy-efficient appliances and lighting. Policy and Regulation: Governments implementing policies to promote sustainable energy use. Prospects & Emerging Technologies Quantum For each year, 2022-2024, please break down forecast\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section\": \"19th Century Breakthroughs and Michael Faraday: Discovered electromagnetic induction, leading to the development of electric motors. James Clerk Maxwell: Formulated the theory of electromagnetism, unifying electricity and magnetism.\",  \n            \"number\": \"10.2.1.3\",  \n            \"question\": \"Computing: Potential to revolutionize computing with unprecedented processing power. Energy Storage: Advances in battery technology for better energy storage solutions.Wireless Power: Development of wireless power transmission technologies. figures presented on page 5 by each of the categories described in the quote from page 5\",  \n            \"context\": \"Page 5 states: “Industrial Revolution & Electrification of Cities Street Lighting: Cities like London and New York began using electric streetlights. Public Transport: Electric trams and subways revolutionized urban transportation. Factories: Electricity powered machinery, increasing production efficiency. Household Adoption Appliances: Introduction of electric appliances like refrigerators and washing machines.\"  \n        },  \n        {  \n            \"section_name\": \"10.2.1.3 Prospects & Emerging Technologies\",  \n            \"number\": \"7\",  \n            \"text\": \"- Quantum Computing: Potential to revolutionize computing with unprecedented processing power.\\n- Energy Storage: Advances in battery technology for better energy storage solutions.\\n- Wireless Power: Development of wireless power transmission technologies.\",  \n            \"context\": \"Emerging technologies in the energy sector.\"  \n        },  \n        {  \n            \"section_name\": \"\",  \n            \"number\": \"10.3\",  \n            \"text\": \"The 21st century has witnessed a series of energy crises, beginning with the early 2000s when oil prices surged due to geopolitical tensions in the Middle East. The invasion of Iraq in 2003 and subsequent instability in the region disrupted oil supplies, leading to significant price hikes. This period highlighted the world's heavy dependence on fossil fuels and the vulnerabilities associated with it. As economies grew, the demand for energy soared, further straining the supply chains. The crisis underscored the urgent need for diversifying energy sources and improving energy security. Please provide reasons for the variation in the below graph:\",\n            \"image\": \"https://bpadocumentstorage.blob.core.windows.net/images/images/image_e13f2b39bb374146a36bd4ebcfe36ab0.png\",\n            \"context\": \"\"  \n        }  \n    ]  \n}"
+
+
+def compact_text(text):
+    """Strip selection marks and redundant whitespace from extracted text."""
+    text = SELECTION_MARK_PATTERN.sub("", text)
+    text = HORIZONTAL_SPACE_PATTERN.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    return BLANK_LINES_PATTERN.sub("\n\n", text)
+
+
+def _margin_key(line):
+    key = line.strip().lower()
+    # "Page 3 of 10" style footers differ from page to page only in their digits
+    if PAGE_WORD_PATTERN.search(key):
+        return DIGITS_PATTERN.sub("#", key)
+    return key
+
+
+def _margin_indexes(lines):
+    # Indexes of the first and last non-empty lines of a page, where headers and footers sit
+    non_empty = [i for i, line in enumerate(lines) if line.strip()]
+    return set(non_empty[:PAGE_MARGIN_LINES]) | set(non_empty[-PAGE_MARGIN_LINES:])
+
+
+def _repeated_margin_keys(pages):
+    # Margin lines, digits aside, that appear on enough pages to be running headers or footers
+    page_counts = {}
+    page_count = 0
+    for page in pages:
+        lines = page.split("\n")
+        for key in {_margin_key(lines[i]) for i in _margin_indexes(lines)}:
+            page_counts[key] = page_counts.get(key, 0) + 1
+        page_count += 1
+    min_pages = max(HEADER_FOOTER_MIN_PAGES, HEADER_FOOTER_MIN_SHARE * page_count)
+    return {key for key, count in page_counts.items() if count >= min_pages and key}
+
+
+def iter_compact_pages(pages):
+    """Lazily remove running headers, footers and page numbers, then compact each page.
+
+    A line near the top or bottom of a page counts as a running header or
+    footer when it appears, digits aside, in the margins of at least
+    HEADER_FOOTER_MIN_SHARE of the pages (and no fewer than
+    HEADER_FOOTER_MIN_PAGES pages). ``pages`` is read twice, so it must be
+    a sequence; compacted pages are produced one at a time as they are
+    consumed.
+    """
+    repeated = _repeated_margin_keys(pages)
+    for page in pages:
+        lines = page.split("\n")
+        margin = _margin_indexes(lines)
+        kept = [
+            line for i, line in enumerate(lines)
+            if i not in margin
+            or SECTION_HEADING_PATTERN.match(line)
+            or not (_margin_key(line) in repeated or PAGE_NUMBER_PATTERN.match(line.strip()))
+        ]
+        yield compact_text("\n".join(kept))
+
+
+def compact_pages(pages):
+    return list(iter_compact_pages(pages))
+
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    # tiktoken is optional; without it token counts are estimated from the text length
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+                except Exception as e:
+                    logging.info(f"Using estimated token counts, tiktoken is unavailable: {e}")
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages):
+    # Each chat message carries a few tokens of framing on top of its text
+    return sum(
+        4 + sum(count_tokens(part["text"]) for part in message["content"] if part.get("type") == "text")
+        for message in messages
+    )
+
+
+def _text_message(role, text):
+    return {"role": role, "content": [{"type": "text", "text": text}]}
+
+
+def _compact_json(text):
+    # Few-shot answers are sent without pretty-printing; the content is unchanged
+    try:
+        return json.dumps(json.loads(text), ensure_ascii=False)
+    except json.JSONDecodeError:
+        return text
+
+
+class PromptTemplate:
+    """A chat prompt whose system and few-shot messages are built once and shared."""
+
+    def __init__(self, name, system_text, examples, temperature=0.7, top_p=0.95, max_tokens=4026):
+        self.name = name
+        self.version = f"{name}-{PROMPT_TEMPLATE_VERSION}"
+        messages = [_text_message("system", system_text)]
+        for user_text, assistant_text in examples:
+            messages.append(_text_message("user", compact_text(user_text)))
+            messages.append(_text_message("assistant", _compact_json(assistant_text)))
+        self.messages = tuple(messages)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self._few_shot_tokens = None
+
+    @property
+    def few_shot_tokens(self):
+        # Counted on first use, so importing the module never loads a tokenizer
+        if self._few_shot_tokens is None:
+            self._few_shot_tokens = count_message_tokens(self.messages)
+        return self._few_shot_tokens
+
+    def build(self, txt_content):
+        return {
+            "messages": [*self.messages, _text_message("user", txt_content)],
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "max_tokens": self.max_tokens
+        }
+
+    def count_prompt_tokens(self, txt_content):
+        return self.few_shot_tokens + 4 + count_tokens(txt_content)
+
+
+DEFAULT_TEMPLATE = PromptTemplate("default", SYSTEM_TEXT, [(FEW_SHOT_USER_TEXT, FEW_SHOT_ASSISTANT_TEXT)])
+URL_TEMPLATE = PromptTemplate("url", URL_SYSTEM_TEXT, [(URL_FEW_SHOT_USER_TEXT, URL_FEW_SHOT_ASSISTANT_TEXT)])
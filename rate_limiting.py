@@ -0,0 +1,409 @@
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+
+# Client-side limits; 0 disables the corresponding bucket
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "0"))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "0"))
+OPENAI_DEPLOYMENTS = os.environ.get("OPENAI_DEPLOYMENTS", "")
+OPENAI_SPILLOVER_WAIT_SECONDS = float(os.environ.get("OPENAI_SPILLOVER_WAIT_SECONDS", "2"))
+DOCUMENT_INTELLIGENCE_RPM = int(os.environ.get("DOCUMENT_INTELLIGENCE_RPM", "0"))
+RATE_LIMIT_HEADROOM = float(os.environ.get("RATE_LIMIT_HEADROOM", "0.9"))
+
+# Retries and circuit breaking
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "6"))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get("RETRY_BASE_DELAY_SECONDS", "1"))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get("RETRY_MAX_DELAY_SECONDS", "60"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "30"))
+
+# Status codes worth retrying; everything else is raised at once
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Connection failures of the openai, azure-core and requests clients, matched by class name
+CONNECTION_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "ServiceRequestError", "ServiceResponseError",
+    "ConnectionError", "Timeout",
+}
+
+
+class ServiceBusyError(Exception):
+    """Raised when a call is still throttled, or every circuit is open, after all retries."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def error_status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def retry_after_seconds(error):
+    # Azure services send retry-after-ms or x-ms-retry-after-ms; the standard header is seconds or a date
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time()) if retry_at is not None else None
+
+
+def is_retryable(error):
+    status_code = error_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in CONNECTION_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    """Token bucket with an adaptive rate.
+
+    ``reserve`` takes tokens at once and returns how long the caller must
+    wait for them, so concurrent callers queue up in order instead of
+    polling. The rate starts at ``limit_per_minute * headroom``, drops by
+    ``decrease`` on every throttle and climbs back by ``increase`` of the
+    limit per success, so it settles just below the real quota. The burst
+    is one second's worth: a burst plus the refill over Azure's short
+    enforcement windows must stay within the quota of that window. A
+    reservation larger than the burst, such as a whole prompt against a
+    tokens-per-minute bucket, only waits for a full bucket; the rest is
+    taken as debt that later reservations wait for.
+    """
+
+    def __init__(self, limit_per_minute, headroom=RATE_LIMIT_HEADROOM, decrease=0.7, increase=0.02, min_share=0.1):
+        self.limit = limit_per_minute * headroom
+        self.min_rate = self.limit * min_share
+        self.rate = self.limit
+        self.decrease = decrease
+        self.increase = increase
+        self.capacity = max(1.0, self.limit / 60)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            shortfall = max(0.0, min(amount, self.capacity) - self._tokens)
+            return max(self._blocked_until - now, 0.0) + shortfall * 60 / self.rate
+
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Tokens may go negative; the caller waits for the debt up to one full bucket,
+            # anything beyond that is paid off by the next callers' waits
+            shortfall = max(0.0, min(amount, self.capacity) - self._tokens)
+            self._tokens -= amount
+            return max(self._blocked_until - now, 0.0) + shortfall * 60 / self.rate
+
+    def refund(self, amount):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def throttled(self, pause_seconds):
+        with self._lock:
+            now = time.monotonic()
+            # Calls that were already in flight get throttled together; back off once per pause
+            if now >= self._blocked_until:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._blocked_until = max(self._blocked_until, now + pause_seconds)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.limit, self.rate + self.limit * self.increase)
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; after ``reset_seconds`` one trial call is let through."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        # Like allow(), without claiming the half-open trial call
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_seconds
+            return self.state == self.CLOSED or not self._trial_running
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def retry_in(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning(f"Circuit opened after {self._failures} consecutive failures.")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class Deployment:
+    """One endpoint (an OpenAI deployment or a Document Intelligence resource) with its own limits."""
+
+    def __init__(self, name, model=None, endpoint=None, api_key=None, rpm=0, tpm=0, primary=False):
+        self.name = name
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.primary = primary
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.breaker = CircuitBreaker()
+        # Set from Retry-After even without configured limits, so throttled calls can spill over
+        self._blocked_until = 0.0
+
+    def wait_time(self, tokens):
+        waits = [self._blocked_until - time.monotonic()]
+        if self.requests is not None:
+            waits.append(self.requests.wait_time(1))
+        if self.tokens is not None and tokens:
+            waits.append(self.tokens.wait_time(tokens))
+        return max(0.0, *waits)
+
+    def reserve(self, tokens):
+        waits = [self._blocked_until - time.monotonic()]
+        if self.requests is not None:
+            waits.append(self.requests.reserve(1))
+        if self.tokens is not None and tokens:
+            waits.append(self.tokens.reserve(tokens))
+        return max(0.0, *waits)
+
+    def throttled(self, pause_seconds):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + pause_seconds)
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.throttled(pause_seconds)
+
+    def succeeded(self, reserved_tokens, used_tokens):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.succeeded()
+        if self.tokens is not None and used_tokens is not None:
+            # Gives back an over-estimate, or charges what the estimate missed
+            self.tokens.refund(reserved_tokens - used_tokens)
+
+
+class RetryScheduler:
+    """Runs calls against a list of deployments with rate limiting, retries and circuit breaking.
+
+    ``call(fn, tokens)`` invokes ``fn(deployment)``. Deployments are tried in
+    priority order; a call spills over to the next one when the preferred
+    deployment would make it wait longer than ``spillover_wait`` or its
+    circuit is open. Throttled and transient failures are retried with
+    exponential backoff and full jitter, never sooner than the service's
+    ``Retry-After``. ``usage(result)`` may return the tokens actually used,
+    so the bucket is charged for real usage rather than the estimate.
+    """
+
+    def __init__(self, deployments, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY_SECONDS,
+                 max_delay=RETRY_MAX_DELAY_SECONDS, spillover_wait=OPENAI_SPILLOVER_WAIT_SECONDS, usage=None):
+        self.deployments = deployments
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.spillover_wait = spillover_wait
+        self.usage = usage
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0, "spilled": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            # A little jitter on top keeps waiting clients from retrying in lockstep
+            delay = max(delay, retry_after + random.uniform(0, self.base_delay))
+        return delay
+
+    def choose(self, tokens):
+        available = [deployment for deployment in self.deployments if deployment.breaker.available()]
+        if not available:
+            return None
+        preferred = available[0]
+        if len(available) > 1 and preferred.wait_time(tokens) > self.spillover_wait:
+            available.sort(key=lambda deployment: deployment.wait_time(tokens))
+        for deployment in available:
+            if deployment.breaker.allow():
+                if deployment is not preferred:
+                    self._count("spilled")
+                return deployment
+        return None
+
+    def call(self, fn, tokens=0):
+        self._count("calls")
+        last_error = None
+        retry_after = None
+        for attempt in range(self.max_attempts):
+            deployment = self.choose(tokens)
+            if deployment is None:
+                retry_after = min(deployment.breaker.retry_in() for deployment in self.deployments)
+                if attempt + 1 == self.max_attempts:
+                    break
+                time.sleep(max(retry_after, self.backoff(attempt)))
+                continue
+
+            time.sleep(deployment.reserve(tokens))
+            try:
+                result = fn(deployment)
+            except Exception as e:
+                if not is_retryable(e):
+                    deployment.breaker.record_success()
+                    raise
+                last_error = e
+                retry_after = retry_after_seconds(e)
+                if error_status_code(e) == 429:
+                    # Throttling means the rate is too high, not that the deployment is down
+                    self._count("throttled")
+                    deployment.throttled(retry_after or self.base_delay)
+                    deployment.breaker.record_success()
+                else:
+                    deployment.breaker.record_failure()
+                if attempt + 1 == self.max_attempts:
+                    break
+                self._count("retries")
+                delay = self.backoff(attempt, retry_after)
+                logging.warning(
+                    f"Call to {deployment.name} failed with {type(e).__name__} "
+                    f"(status {error_status_code(e)}), retrying in {delay:.1f}s."
+                )
+                time.sleep(delay)
+                continue
+
+            deployment.breaker.record_success()
+            deployment.succeeded(tokens, self.usage(result) if self.usage is not None else None)
+            return result
+
+        self._count("failed")
+        raise ServiceBusyError(
+            f"Call failed after {self.max_attempts} attempts: {last_error or 'all circuits open'}",
+            retry_after=retry_after
+        ) from last_error
+
+
+def openai_deployments():
+    """Deployments from OPENAI_DEPLOYMENTS (a JSON list), or the single configured one.
+
+    Each entry may set ``name``, ``model``, ``endpoint``, ``api_key_env``
+    (the name of the variable holding its key), ``rpm`` and ``tpm``; the
+    first entry is the preferred one.
+    """
+    if not OPENAI_DEPLOYMENTS:
+        return [Deployment("primary", model="gpt-4o-mini", rpm=OPENAI_RPM, tpm=OPENAI_TPM, primary=True)]
+    deployments = []
+    for index, entry in enumerate(json.loads(OPENAI_DEPLOYMENTS)):
+        deployments.append(Deployment(
+            entry.get("name", f"deployment-{index}"),
+            model=entry.get("model", "gpt-4o-mini"),
+            endpoint=entry.get("endpoint"),
+            api_key=os.environ[entry["api_key_env"]] if entry.get("api_key_env") else None,
+            rpm=int(entry.get("rpm", OPENAI_RPM)),
+            tpm=int(entry.get("tpm", OPENAI_TPM)),
+            primary=index == 0
+        ))
+    return deployments
+
+
+def completion_tokens_used(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def _get_scheduler(name, factory):
+    scheduler = _schedulers.get(name)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(name)
+            if scheduler is None:
+                scheduler = factory()
+                _schedulers[name] = scheduler
+    return scheduler
+
+
+def get_openai_scheduler():
+    return _get_scheduler("openai", lambda: RetryScheduler(openai_deployments(), usage=completion_tokens_used))
+
+
+def get_document_intelligence_scheduler():
+    # The SDK retries throttled polls; submissions are sent without SDK retries and are
+    # bounded, spaced out and retried here
+    return _get_scheduler(
+        "document_intelligence",
+        lambda: RetryScheduler([Deployment("document_intelligence", rpm=DOCUMENT_INTELLIGENCE_RPM, primary=True)])
+    )
+
+
+def set_scheduler(name, scheduler):
+    with _schedulers_lock:
+        _schedulers[name] = scheduler
+
+
+def reset_schedulers():
+    with _schedulers_lock:
+        _schedulers.clear()
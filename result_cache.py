@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+# Cache configuration
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_BACKEND = os.environ.get("RESULT_CACHE_BACKEND", "sqlite")
+RESULT_CACHE_PATH = os.environ.get(
+    "RESULT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "bpa_result_cache.sqlite3")
+)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "128"))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", "86400"))
+# The SQLite tier holds full page texts, so it is bounded too; least recently used entries go first
+RESULT_CACHE_PERSISTENT_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_PERSISTENT_MAX_ENTRIES", "2000"))
+
+
+def content_hash(document_content):
+    return hashlib.sha256(document_content).hexdigest()
+
+
+def settings_version(name, *settings):
+    # Short, stable identifier of a group of settings, for use in cache keys
+    digest = hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+    return f"{name}-{digest[:12]}"
+
+
+def extraction_key(document_hash, extraction_version):
+    # Page texts depend on the document bytes and on the settings that decide how its pages are extracted
+    return f"di-pages:{document_hash}:{extraction_version}"
+
+
+def response_key(document_hash, prompt_version, extraction_version, compaction_version):
+    # The OpenAI output also depends on the prompt template and on the text the model was given
+    return f"openai:{document_hash}:{prompt_version}:{extraction_version}:{compaction_version}"
+
+
+class LRUCache:
+    """In-process tier: bounded, thread-safe, with per-entry expiry."""
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, ttl_seconds=RESULT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """Persistent tier backed by a local SQLite file, values stored as JSON."""
+
+    def __init__(self, path=RESULT_CACHE_PATH, ttl_seconds=RESULT_CACHE_TTL_SECONDS, max_entries=RESULT_CACHE_PERSISTENT_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS result_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        # Eviction walks the entries by last access
+        self._conn.execute("CREATE INDEX IF NOT EXISTS result_cache_accessed_at ON result_cache (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM result_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(value)
+
+    def set(self, key, value, ttl_seconds=None):
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM result_cache")
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute(
+            "DELETE FROM result_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        )
+        if self.max_entries:
+            # Least recently accessed entries go first
+            self._conn.execute(
+                "DELETE FROM result_cache WHERE key NOT IN ("
+                " SELECT key FROM result_cache ORDER BY accessed_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LayeredResultCache:
+    """Local LRU tier in front of an optional persistent tier.
+
+    Persistent hits are promoted into the local tier. Hit/miss counters are
+    process-wide and are surfaced in the HTTP response headers.
+    """
+
+    def __init__(self, local=None, persistent=None):
+        self.local = local if local is not None else LRUCache()
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "local_hits": 0, "persistent_hits": 0, "misses": 0}
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count("hits", "local_hits")
+            return value
+
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception as e:
+                logging.error(f"Failed to read result cache entry {key}: {e}")
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+                self._count("hits", "persistent_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, value)
+            except Exception as e:
+                logging.error(f"Failed to write result cache entry {key}: {e}")
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.persistent is not None:
+            self.persistent.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.persistent is not None:
+            self.persistent.clear()
+        with self._lock:
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def headers(self, status):
+        with self._lock:
+            return {
+                "X-Cache": status,
+                "X-Cache-Hits": str(self.stats["hits"]),
+                "X-Cache-Misses": str(self.stats["misses"]),
+            }
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                self.stats[name] += 1
+
+
+def build_result_cache():
+    if RESULT_CACHE_BACKEND == "sqlite":
+        try:
+            persistent = SQLiteCacheBackend(RESULT_CACHE_PATH, max_entries=RESULT_CACHE_PERSISTENT_MAX_ENTRIES)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to open result cache at {RESULT_CACHE_PATH}, using local tier only: {e}")
+            persistent = None
+    else:
+        persistent = None
+    return LayeredResultCache(LRUCache(), persistent)
@@ -0,0 +1,224 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+
+from telemetry import span
+
+
+# Results persistence configuration
+RESULTS_STORE = os.environ.get("RESULTS_STORE", "disabled")
+RESULTS_PARTITION_KEY = os.environ.get("RESULTS_PARTITION_KEY", "document_name")
+RESULTS_TEXT_CONTAINER = os.environ.get("RESULTS_TEXT_CONTAINER", "results-text")
+RESULTS_TEXT_INLINE_MAX_BYTES = int(os.environ.get("RESULTS_TEXT_INLINE_MAX_BYTES", "16384"))
+RESULTS_FLUSH_MAX_ITEMS = int(os.environ.get("RESULTS_FLUSH_MAX_ITEMS", "50"))
+RESULTS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("RESULTS_FLUSH_INTERVAL_SECONDS", "1"))
+
+# Cosmos DB transactional batches are limited to 100 operations
+MAX_BATCH_OPERATIONS = 100
+
+
+def result_item_id(document_name, *parts):
+    # The same outcome for the same document always maps to the same item, so retries overwrite.
+    # Only the digest is used: Cosmos DB ids may not contain "/", "\\", "?" or "#", which blob names can
+    digest = hashlib.sha256("|".join(str(part) for part in (document_name, *parts)).encode("utf-8")).hexdigest()
+    return digest[:32]
+
+
+class InMemoryContainer:
+    """Stand-in for a Cosmos DB container, for local runs and tests."""
+
+    def __init__(self, partition_key=RESULTS_PARTITION_KEY):
+        self.partition_key = partition_key
+        self.items = {}
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def upsert_item(self, body):
+        with self._lock:
+            self.items[(body[self.partition_key], body["id"])] = dict(body)
+        return body
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        with self._lock:
+            self.batches.append((partition_key, len(batch_operations)))
+        results = []
+        for operation, args in batch_operations:
+            if operation != "upsert":
+                raise ValueError(f"Unsupported batch operation {operation}")
+            results.append(self.upsert_item(args[0]))
+        return results
+
+    def read_item(self, item, partition_key):
+        with self._lock:
+            return dict(self.items[(partition_key, item)])
+
+
+class InMemoryTextStore:
+    """Stand-in for the blob container that holds large text_content values."""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, name, text):
+        self.blobs[name] = text
+        return f"memory://{RESULTS_TEXT_CONTAINER}/{name}"
+
+
+class BlobTextStore:
+    def __init__(self, blob_service_client, container_name=RESULTS_TEXT_CONTAINER):
+        self.container_client = blob_service_client.get_container_client(container_name)
+
+    def put(self, name, text):
+        from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+        blob_client = self.container_client.get_blob_client(name)
+        try:
+            blob_client.upload_blob(text.encode("utf-8"), overwrite=True)
+        except ResourceNotFoundError:
+            try:
+                self.container_client.create_container()
+            except ResourceExistsError:
+                pass
+            blob_client.upload_blob(text.encode("utf-8"), overwrite=True)
+        return blob_client.url
+
+
+class ResultsWriter:
+    """Buffers result items and writes them in per-partition batches.
+
+    Items are flushed by a background thread every ``flush_interval``
+    seconds, and as soon as ``max_items`` are pending. A
+    ``text_content`` larger than ``inline_max_bytes`` is moved to the text
+    store and replaced by ``text_content_ref``. Failed batches are retried
+    item by item.
+    """
+
+    def __init__(self, container, text_store=None, max_items=RESULTS_FLUSH_MAX_ITEMS,
+                 flush_interval=RESULTS_FLUSH_INTERVAL_SECONDS, inline_max_bytes=RESULTS_TEXT_INLINE_MAX_BYTES,
+                 partition_key=RESULTS_PARTITION_KEY):
+        self.container = container
+        self.text_store = text_store
+        self.max_items = max_items
+        self.flush_interval = flush_interval
+        self.inline_max_bytes = inline_max_bytes
+        self.partition_key = partition_key
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run, name="results-writer", daemon=True)
+        self._flusher.start()
+
+    def add(self, item):
+        with self._lock:
+            # A later item with the same id replaces the pending one
+            self._pending[item["id"]] = item
+            full = len(self._pending) >= self.max_items
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                items = list(self._pending.values())
+                self._pending = {}
+            if not items:
+                return 0
+
+            with span("cosmos_flush", cosmos_items=len(items)) as flush_span:
+                partitions = {}
+                for item in items:
+                    item = self._offload_text(item)
+                    partitions.setdefault(item[self.partition_key], []).append(item)
+
+                for partition_value, partition_items in partitions.items():
+                    for start in range(0, len(partition_items), MAX_BATCH_OPERATIONS):
+                        self._write_batch(partition_value, partition_items[start:start + MAX_BATCH_OPERATIONS])
+                flush_span.set_attributes(cosmos_partitions=len(partitions))
+            logging.info(f"Stored {len(items)} results in {len(partitions)} partitions.")
+            return len(items)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+
+    def _offload_text(self, item):
+        text_content = item.get("text_content")
+        if self.text_store is None or not text_content:
+            return item
+        encoded_size = len(text_content.encode("utf-8"))
+        if encoded_size <= self.inline_max_bytes:
+            return item
+        item = dict(item)
+        try:
+            item["text_content_ref"] = self.text_store.put(f"{item['id']}.txt", item.pop("text_content"))
+            item["text_content_bytes"] = encoded_size
+        except Exception as e:
+            # Keep the item writable even if the text could not be offloaded
+            logging.error(f"Failed to offload text_content of {item['id']}: {e}")
+            item["text_content"] = None
+        return item
+
+    def _write_batch(self, partition_value, items):
+        try:
+            if len(items) == 1:
+                self.container.upsert_item(items[0])
+            else:
+                self.container.execute_item_batch(
+                    batch_operations=[("upsert", (item,)) for item in items], partition_key=partition_value
+                )
+        except Exception as e:
+            logging.error(f"Batch write to partition {partition_value} failed, retrying items one by one: {e}")
+            for item in items:
+                try:
+                    self.container.upsert_item(item)
+                except Exception as item_error:
+                    logging.error(f"Failed to store result {item['id']}: {item_error}")
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush results: {e}")
+
+
+def build_results_writer():
+    if RESULTS_STORE == "cosmos":
+        from clients import get_blob_service_client, get_cosmos_container
+        writer = ResultsWriter(get_cosmos_container(), BlobTextStore(get_blob_service_client()))
+    elif RESULTS_STORE == "memory":
+        writer = ResultsWriter(InMemoryContainer(), InMemoryTextStore())
+    else:
+        return None
+    atexit.register(writer.close)
+    return writer
+
+
+_writer = None
+_writer_built = False
+_writer_lock = threading.Lock()
+
+
+def get_results_writer():
+    # Built on first use so importing the app does not connect to Cosmos DB
+    global _writer, _writer_built
+    if not _writer_built:
+        with _writer_lock:
+            if not _writer_built:
+                _writer = build_results_writer()
+                _writer_built = True
+    return _writer
+
+
+def set_results_writer(writer):
+    global _writer, _writer_built
+    with _writer_lock:
+        _writer = writer
+        _writer_built = True
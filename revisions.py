@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+from chunking import group_pages
+from document_io import open_pdf
+from results_writer import RESULTS_STORE, RESULTS_TEXT_CONTAINER
+
+
+# Where the page fingerprint index of each document lineage is kept: blob, memory or disabled.
+# By default it follows RESULTS_STORE, so the index sits next to the results
+PAGE_INDEX_STORE = os.environ.get("PAGE_INDEX_STORE", {"cosmos": "blob", "memory": "memory"}.get(RESULTS_STORE, "disabled"))
+PAGE_INDEX_PREFIX = os.environ.get("PAGE_INDEX_PREFIX", "page-index/")
+# Revision markers removed from a document name to find its lineage, e.g. "filing_v2.pdf" -> "filing.pdf"
+REVISION_SUFFIX_PATTERN = re.compile(
+    os.environ.get("REVISION_SUFFIX_PATTERN", r"([ _.-]*(v|rev|revision)[ _.-]?\d+|\s*\(\d+\))$"), re.IGNORECASE
+)
+
+
+def lineage_key(document_name):
+    # Revisions of a document share the name without its revision marker
+    stem, extension = os.path.splitext(document_name)
+    return (REVISION_SUFFIX_PATTERN.sub("", stem) or stem) + extension
+
+
+def page_fingerprint(page):
+    # A PyMuPDF page keeps its fingerprint as long as its text and images do not change
+    digest = hashlib.sha256(page.get_text("text").encode("utf-8"))
+    for info in page.get_image_info(hashes=True):
+        digest.update(info.get("digest") or b"")
+        digest.update(json.dumps([round(value, 1) for value in info["bbox"]]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def document_fingerprints(document_content):
+    pdf_doc = open_pdf(document_content)
+    try:
+        return [page_fingerprint(page) for page in pdf_doc]
+    finally:
+        pdf_doc.close()
+
+
+class PageGroup:
+    """Consecutive pages extracted together; ``items`` is None until they are extracted.
+
+    Only ``complete`` groups, whose every chunk returned its items whole, are offered
+    to the next revision.
+    """
+
+    def __init__(self, start, end, fingerprints, items=None):
+        self.start = start
+        self.end = end
+        self.fingerprints = fingerprints
+        self.items = items
+        self.reused = items is not None
+        self.complete = items is not None
+
+
+class PageRevision:
+    """The page fingerprints of a document and what the previous revision of its lineage can supply.
+
+    Page texts are reused by fingerprint. ``extracted_data`` items are reused
+    per page group, when the group's pages appear unchanged and in the same
+    order, and the prompt template has not changed since.
+    """
+
+    def __init__(self, lineage, fingerprints, previous=None, template_version=None):
+        self.lineage = lineage
+        self.fingerprints = fingerprints
+        self.template_version = template_version
+        self.previous_document_name = (previous or {}).get("document_name")
+        self.groups = []
+        self._texts = {page["fingerprint"]: page["text"] for page in (previous or {}).get("pages", [])}
+        self._groups = {}
+        if previous and previous.get("template_version") == template_version:
+            for group in previous.get("groups", []):
+                self._groups.setdefault(group["fingerprints"][0], []).append(group)
+
+    @property
+    def has_previous(self):
+        return bool(self._texts)
+
+    @property
+    def changed_pages(self):
+        # 1-based numbers of the pages whose text is not known from the previous revision
+        return [number for number, fingerprint in enumerate(self.fingerprints, 1) if fingerprint not in self._texts]
+
+    def previous_text(self, page_number):
+        return self._texts.get(self.fingerprints[page_number - 1])
+
+    def _previous_group(self, start):
+        for group in self._groups.get(self.fingerprints[start], []):
+            if self.fingerprints[start:start + len(group["fingerprints"])] == group["fingerprints"]:
+                return group
+        return None
+
+    def plan_groups(self, pages, max_tokens):
+        """Split the pages into groups, reusing the previous revision's groups where they still match.
+
+        Pages outside a reused group are packed into new groups of at most
+        ``max_tokens`` estimated tokens; their ``items`` are left to fill in.
+        """
+        groups = []
+        run_start = None
+
+        def close_run(end):
+            for start, stop in group_pages(pages[run_start:end], max_tokens):
+                groups.append(PageGroup(run_start + start, run_start + stop, self.fingerprints[run_start + start:run_start + stop]))
+
+        index = 0
+        while index < len(pages):
+            previous = self._previous_group(index)
+            if previous is None:
+                if run_start is None:
+                    run_start = index
+                index += 1
+                continue
+            if run_start is not None:
+                close_run(index)
+                run_start = None
+            end = index + len(previous["fingerprints"])
+            groups.append(PageGroup(index, end, self.fingerprints[index:end], previous["items"]))
+            index = end
+        if run_start is not None:
+            close_run(len(pages))
+        self.groups = groups
+        return groups
+
+    def record(self, document_name, document_hash, pages):
+        return {
+            "lineage": self.lineage,
+            "document_name": document_name,
+            "document_hash": document_hash,
+            "template_version": self.template_version,
+            "pages": [{"fingerprint": fingerprint, "text": text} for fingerprint, text in zip(self.fingerprints, pages)],
+            "groups": [
+                {"fingerprints": group.fingerprints, "items": group.items}
+                for group in self.groups if group.complete
+            ],
+        }
+
+
+class InMemoryPageIndexStore:
+    """Stand-in for the blob container that holds the page indexes, for local runs."""
+
+    def __init__(self):
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, lineage):
+        with self._lock:
+            return self.indexes.get(lineage)
+
+    def put(self, lineage, index):
+        with self._lock:
+            self.indexes[lineage] = index
+
+
+class BlobPageIndexStore:
+    """Page indexes as JSON blobs in the container that holds large result texts."""
+
+    def __init__(self, blob_service_client, container_name=RESULTS_TEXT_CONTAINER):
+        self.container_client = blob_service_client.get_container_client(container_name)
+
+    def get(self, lineage):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            data = self.container_client.get_blob_client(f"{PAGE_INDEX_PREFIX}{lineage}.json").download_blob().readall()
+        except ResourceNotFoundError:
+            return None
+        return json.loads(data)
+
+    def put(self, lineage, index):
+        from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+        blob_client = self.container_client.get_blob_client(f"{PAGE_INDEX_PREFIX}{lineage}.json")
+        data = json.dumps(index).encode("utf-8")
+        try:
+            blob_client.upload_blob(data, overwrite=True)
+        except ResourceNotFoundError:
+            try:
+                self.container_client.create_container()
+            except ResourceExistsError:
+                pass
+            blob_client.upload_blob(data, overwrite=True)
+
+
+def build_page_index_store():
+    if PAGE_INDEX_STORE == "blob":
+        from clients import get_blob_service_client
+        return BlobPageIndexStore(get_blob_service_client())
+    if PAGE_INDEX_STORE == "memory":
+        return InMemoryPageIndexStore()
+    if PAGE_INDEX_STORE != "disabled":
+        logging.warning(f"Unknown PAGE_INDEX_STORE '{PAGE_INDEX_STORE}', incremental processing is disabled.")
+    return None
+
+
+_store = None
+_store_built = False
+_store_lock = threading.Lock()
+
+
+def get_page_index_store():
+    # Built on first use so importing the app does not connect to Blob Storage
+    global _store, _store_built
+    if not _store_built:
+        with _store_lock:
+            if not _store_built:
+                _store = build_page_index_store()
+                _store_built = True
+    return _store
+
+
+def set_page_index_store(store):
+    global _store, _store_built
+    with _store_lock:
+        _store = store
+        _store_built = True
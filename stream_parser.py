@@ -0,0 +1,158 @@
+import json
+import logging
+import re
+from collections import namedtuple
+
+
+EXTRACTED_DATA_PATTERN = re.compile(r'"extracted_data"\s*:\s*\[')
+CODE_FENCE_PATTERN = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+
+# Characters kept from the unsearched tail, so a key split across deltas is still found
+_SEEK_OVERLAP = 32
+
+
+class ExtractedDataParser:
+    """Incrementally parses ``extracted_data`` items out of streamed model output.
+
+    Text is fed as it arrives and every complete item object is returned as
+    soon as its closing brace is seen. The output may be wrapped in a code
+    fence and may be a bare JSON array. Items that are not valid JSON are
+    counted in ``malformed`` and skipped; an unterminated trailing item is
+    dropped when the parser is closed.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self.malformed = 0
+        self.truncated = False
+        self._text = ""
+        self._in_array = False
+        self._searched = 0
+        self._pos = 0
+        self._depth = 0
+        self._item_start = None
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, delta):
+        if self.complete or not delta:
+            return []
+        self._text += delta
+        if not self._in_array and not self._seek_array():
+            return []
+        return self._scan()
+
+    @property
+    def found_array(self):
+        return self._in_array
+
+    def close(self):
+        if not self.complete and self._item_start is not None:
+            self.truncated = True
+            logging.warning("Model output ended inside an extracted_data item; the item was dropped.")
+
+    def _seek_array(self):
+        match = EXTRACTED_DATA_PATTERN.search(self._text, max(0, self._searched - _SEEK_OVERLAP))
+        if match:
+            start = match.end()
+        else:
+            # A bare array, possibly inside a code fence
+            stripped = CODE_FENCE_PATTERN.sub("", self._text, count=1).lstrip()
+            if not stripped.startswith("["):
+                self._searched = len(self._text)
+                return False
+            start = self._text.index("[") + 1
+        self._in_array = True
+        self._text = self._text[start:]
+        self._pos = 0
+        return True
+
+    def _scan(self):
+        items = []
+        text = self._text
+        pos = self._pos
+        while pos < len(text):
+            char = text[pos]
+            if self._item_start is None:
+                if char == "{":
+                    self._item_start = pos
+                    self._depth = 1
+                elif char == "]":
+                    self.complete = True
+                    break
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    item = self._decode(text[self._item_start:pos + 1])
+                    if item is not None:
+                        items.append(item)
+                    self._item_start = None
+            pos += 1
+
+        # Drop consumed text so the buffer only holds the item in progress
+        keep_from = self._item_start if self._item_start is not None else pos
+        self._text = text[keep_from:]
+        self._pos = pos - keep_from
+        if self._item_start is not None:
+            self._item_start = 0
+        return items
+
+    def _decode(self, item_text):
+        try:
+            return json.loads(item_text)
+        except json.JSONDecodeError as e:
+            self.malformed += 1
+            logging.warning(f"Skipping malformed extracted_data item: {e}")
+            return None
+
+
+class ModelOutput(namedtuple("ModelOutput", ["data", "malformed", "truncated"])):
+    """A parsed model answer, with the items lost to malformed JSON or truncation."""
+
+    __slots__ = ()
+
+    @property
+    def complete(self):
+        # Only a complete answer may be cached or reused by the next revision
+        return self.data is not None and not self.malformed and not self.truncated
+
+
+def strip_code_fence(content):
+    return CODE_FENCE_PATTERN.sub("", content)
+
+
+def parse_model_output(content):
+    """Parse a complete model answer, salvaging whole items if the JSON is broken.
+
+    Returns a ``ModelOutput`` whose data is None for empty output, and also
+    when not a single item could be recovered; the unparseable answer then
+    counts as one malformed item, so one bad chunk does not fail a document.
+    """
+    cleaned_content = strip_code_fence(content).strip()
+    if not cleaned_content:
+        return ModelOutput(None, 0, False)
+    try:
+        return ModelOutput(json.loads(cleaned_content), 0, False)
+    except json.JSONDecodeError as e:
+        parser = ExtractedDataParser()
+        items = parser.feed(cleaned_content)
+        parser.close()
+        if not items:
+            logging.warning(f"No extracted_data items could be recovered from the model output: {e}")
+            return ModelOutput(None, parser.malformed or int(not parser.truncated), parser.truncated)
+        logging.warning(
+            f"Recovered {len(items)} extracted_data items from malformed model output "
+            f"({parser.malformed} malformed, truncated={parser.truncated}): {e}"
+        )
+        return ModelOutput({"extracted_data": items}, parser.malformed, parser.truncated)
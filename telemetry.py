@@ -0,0 +1,284 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+
+# Where spans and histograms go: none, console, file, otel or azure_monitor
+TELEMETRY_EXPORTER = os.environ.get("TELEMETRY_EXPORTER", "none").lower()
+TELEMETRY_FILE = os.environ.get("TELEMETRY_FILE", "telemetry.jsonl")
+TELEMETRY_ENABLED = TELEMETRY_EXPORTER != "none"
+
+# Histogram bucket upper bounds, per unit
+DURATION_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000]
+SIZE_BUCKETS = [2 ** exponent for exponent in range(0, 31, 2)]
+
+# Numeric span attributes that are also recorded as histograms, with their unit
+HISTOGRAM_ATTRIBUTES = {
+    "document.bytes": "By",
+    "document.pages": "{page}",
+    "document.figures": "{figure}",
+    "figure.bytes": "By",
+    "text.bytes": "By",
+    "openai.prompt_tokens": "{token}",
+    "openai.completion_tokens": "{token}",
+    "cosmos.items": "{item}",
+}
+DURATION_METRIC = "pipeline.stage.duration"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``counts[i]`` holds values up to ``bounds[i]``, the last bucket the rest."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "min": self.min,
+            "max": self.max,
+            "bounds": self.bounds,
+            "counts": list(self.counts),
+        }
+
+
+class LocalExporter:
+    """Writes finished spans as JSON lines and keeps histograms per (metric, stage) in process."""
+
+    def __init__(self, stream=None, path=None):
+        self._stream = stream
+        self._path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self.histograms = {}
+
+    def _write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._path is not None and self._file is None:
+                self._file = open(self._path, "a", encoding="utf-8")
+            (self._file or self._stream).write(line)
+
+    def export_span(self, span):
+        self._write({
+            "type": "span",
+            "name": span.name,
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "start": span.start_time,
+            "duration_ms": round(span.duration * 1000, 3),
+            "status": span.status,
+            "attributes": span.attributes,
+        })
+
+    def record(self, metric, value, unit, stage):
+        bounds = DURATION_BUCKETS_MS if unit == "ms" else SIZE_BUCKETS
+        with self._lock:
+            histogram = self.histograms.get((metric, stage))
+            if histogram is None:
+                histogram = self.histograms[(metric, stage)] = Histogram(bounds)
+            histogram.record(value)
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                dict(histogram.snapshot(), metric=metric, stage=stage)
+                for (metric, stage), histogram in sorted(self.histograms.items())
+            ]
+
+    def flush(self):
+        for histogram in self.snapshot():
+            self._write(dict(histogram, type="histogram"))
+        with self._lock:
+            (self._file or self._stream or sys.stderr).flush()
+
+
+class OpenTelemetryExporter:
+    """Forwards spans and histograms to the OpenTelemetry API, e.g. to Application Insights."""
+
+    def __init__(self):
+        from opentelemetry import metrics, trace
+        self.tracer = trace.get_tracer("document_processing")
+        self._meter = metrics.get_meter("document_processing")
+        self._instruments = {}
+        self._lock = threading.Lock()
+
+    def record(self, metric, value, unit, stage):
+        instrument = self._instruments.get(metric)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.get(metric)
+                if instrument is None:
+                    instrument = self._meter.create_histogram(metric, unit=unit)
+                    self._instruments[metric] = instrument
+        instrument.record(value, attributes={"stage": stage})
+
+    def flush(self):
+        pass
+
+
+class Span:
+    """A timed pipeline stage; numeric size attributes also feed the histograms when it ends."""
+
+    recording = True
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = {}
+        self.status = "ok"
+        self.start_time = None
+        self.duration = 0.0
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self._otel_context = None
+        self._otel_span = None
+        self._token = None
+        self.set_attributes(**attributes)
+
+    def set_attribute(self, key, value):
+        if value is None:
+            return
+        self.attributes[key] = value
+        if self._otel_span is not None:
+            self._otel_span.set_attribute(key, value)
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            # Keyword arguments cannot contain dots, e.g. document_bytes -> document.bytes
+            self.set_attribute(key.replace("_", ".", 1) if "." not in key else key, value)
+
+    def __enter__(self):
+        if _otel is not None:
+            self._otel_context = _otel.tracer.start_as_current_span(self.name, attributes=self.attributes)
+            self._otel_span = self._otel_context.__enter__()
+        self._token = _current_span.set(self)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.status = "error"
+            self.set_attribute("error.type", exc_type.__name__)
+        if self._otel_context is not None:
+            self._otel_context.__exit__(exc_type, exc, tb)
+        for exporter in _exporters:
+            exporter.record(DURATION_METRIC, self.duration * 1000, "ms", self.name)
+            for key, unit in HISTOGRAM_ATTRIBUTES.items():
+                value = self.attributes.get(key)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    exporter.record(f"pipeline.{key}", value, unit, self.name)
+        if _local is not None:
+            _local.export_span(self)
+        return False
+
+
+class _NoopSpan:
+    recording = False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attributes):
+    """Context manager timing one stage; ``with span("download_document", document_name=name) as s:``.
+
+    Keyword attributes get a dot after their first word (``document_bytes``
+    becomes ``document.bytes``). With telemetry disabled a shared no-op span
+    is returned, so callers should only compute costly attributes when
+    ``s.recording`` is true.
+    """
+    if not TELEMETRY_ENABLED:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def in_current_context(fn):
+    # Worker threads do not inherit context variables; this keeps their spans under the caller's
+    if not TELEMETRY_ENABLED:
+        return fn
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def histogram_snapshot():
+    return _local.snapshot() if _local is not None else []
+
+
+def flush():
+    for exporter in _exporters:
+        exporter.flush()
+
+
+def _build_exporters():
+    local = None
+    otel = None
+    if TELEMETRY_EXPORTER == "console":
+        local = LocalExporter(stream=sys.stderr)
+    elif TELEMETRY_EXPORTER == "file":
+        local = LocalExporter(path=TELEMETRY_FILE)
+    elif TELEMETRY_EXPORTER in ("otel", "azure_monitor"):
+        try:
+            if TELEMETRY_EXPORTER == "azure_monitor":
+                # Reads APPLICATIONINSIGHTS_CONNECTION_STRING
+                from azure.monitor.opentelemetry import configure_azure_monitor
+                configure_azure_monitor()
+            otel = OpenTelemetryExporter()
+        except ImportError as e:
+            logging.warning(f"Telemetry exporter '{TELEMETRY_EXPORTER}' is unavailable, spans are not exported: {e}")
+    elif TELEMETRY_ENABLED:
+        logging.warning(f"Unknown TELEMETRY_EXPORTER '{TELEMETRY_EXPORTER}', spans are not exported.")
+    return local, otel
+
+
+_local, _otel = _build_exporters() if TELEMETRY_ENABLED else (None, None)
+_exporters = [exporter for exporter in (_local, _otel) if exporter is not None]
+TELEMETRY_ENABLED = bool(_exporters)
+if _local is not None:
+    atexit.register(flush)